@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Throughput / latency benchmarks for the logger and plotter, run against the simulated DAQ
+(sim_daq.py) so they work anywhere, no board needed.
+
+Logger: runs a_in_main for every channel count x scan rate combination and reports sustained
+scans/s, scans missing (overrun / queue full), queue and buffer high-water marks, and CPU per
+second of acquisition for the polling thread, the whole process and each pipeline stage.
+Note the simulated board's fill thread runs inside the logger process, so "process" CPU
+includes it. With --boards N every simulated board scans the channel count, merged into
+one session (channel count x N columns).
+
+Plotter: writes synthetic sessions of the given lengths (1000 Hz, the 7 default channels)
+and times plotter.save_final_plots on each in a fresh process, with its peak memory.
+
+    python3 benchmark.py                       # everything, default matrix
+    python3 benchmark.py --skip-plotter --rates 1000,10000 --channels 7 --duration 10
+    python3 benchmark.py --skip-plotter --boards 2 --channels 16 --rates 10000
+    python3 benchmark.py --skip-logger --plot-minutes 1,10,60 --plot-format binary
+'''
+import sys
+import os
+import io
+import argparse
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import redirect_stdout
+from time import time
+import numpy as np
+
+import logger
+import sim_daq
+from calibration import (compile_calibration, apply_calibration, load_calibration_config, load_channel_table,
+                         channel_spec)
+from recording import CsvRecordingWriter, BinaryRecordingWriter
+from sim_daq import synthetic_scans, input_sensors
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Default queue first, then the spare inputs, for channel counts above 7
+BENCH_CHANNELS = [5, 6, 13, 14, 4, 12, 1, 0, 2, 3, 7, 8, 9, 10, 11, 15]
+
+
+def parse_list(text, cast=int):
+    return [cast(v) for v in text.split(',') if v.strip()]
+
+
+#-------------------
+# LOGGER BENCHMARK
+#-------------------
+def bench_channels(channel_count, boards):
+    '''
+    Channels of a benchmark run: the first channel_count inputs of every board, numbered
+    board * 100 + input on the boards after the first.
+    '''
+    if boards == 1:
+        return BENCH_CHANNELS[:channel_count]
+    return [channel_spec([], board * 100 + chan)._replace(device=board, input=chan)
+            for board in range(boards) for chan in BENCH_CHANNELS[:channel_count]]
+
+
+def bench_logger(rate, channel_count, duration, settings, work_dir, boards=1):
+    '''
+    Runs one simulated logging session and returns the stats dict from a_in_main.
+    '''
+    sim_daq.simulated_device_count = boards
+    stop_event = threading.Event()
+    timer = threading.Timer(duration, stop_event.set)
+    timer.start()
+    try:
+        with redirect_stdout(io.StringIO()):
+            stats = logger.a_in_main(settings, base_dir=work_dir, stop_event=stop_event,
+                                     rate=rate, channels=bench_channels(channel_count, boards))
+    finally:
+        timer.cancel()
+    return stats
+
+
+def run_logger_benchmarks(args, work_dir):
+    settings = logger.load_logger_config()
+    settings.update(backend='sim', console=False, metrics_file='', metrics_port=0,
+                    record_format=args.record_format)
+    if args.wait_mode:
+        settings['wait_mode'] = args.wait_mode
+
+    print(f"\nLOGGER  ({settings['record_format']}, wait_mode {settings['wait_mode']}, "
+          f"{settings['worker_threads']} worker thread(s), {args.boards} board(s), {args.duration:.0f} s per run)")
+    print(f"{'chans':>5} {'rate Hz':>8} {'scans/s':>9} {'missing':>8} {'max q':>6} {'max buf':>8} "
+          f"{'poll cpu':>9} {'proc cpu':>9} {'status':>7} {'calib':>7} {'write':>7}")
+
+    for channel_count in args.channels:
+        for rate in args.rates:
+            stats = bench_logger(rate, channel_count, args.duration, settings, work_dir, args.boards)
+            if stats is None:
+                print(f'{channel_count:>5} {rate:>8} failed to start')
+                continue
+            print(f"{channel_count:>5} {rate:>8} {stats['scans_written'] / stats['elapsed']:>9.1f} "
+                  f"{stats['scans_missing']:>8} {stats['max_queue_depth']:>6} {stats['max_buffer_fill'] * 100:>7.1f}% "
+                  f"{stats['poll_cpu']:>9.3f} {stats['process_cpu']:>9.3f} {stats['scan_status_time']:>7.3f} "
+                  f"{stats['calibration_time']:>7.3f} {stats['write_time']:>7.3f}")
+    print('poll cpu, proc cpu: CPU seconds per second of acquisition')
+    print('status, calib, write: wall-clock seconds per second of acquisition (including sleeps and lock waits)')
+
+
+#--------------------
+# PLOTTER BENCHMARK
+#--------------------
+def write_synthetic_session(path_base, minutes, record_format, rate=1000, chunk_scans=100000):
+    '''
+    Writes a synthetic session the way the logger would and returns the path to plot.
+    '''
+    channels = BENCH_CHANNELS[:7]
+    gain, offset = compile_calibration(channels)
+    if record_format == 'binary':
+        path = f'{path_base}_RAW.bin'
+        writer = BinaryRecordingWriter(path, {'channels': channels, 'rate': rate, 'start_time': 'benchmark',
+                                              'calibration': load_calibration_config()})
+    else:
+        path = f'{path_base}_MAPPPED.csv'
+        writer = CsvRecordingWriter(path, f'{path_base}_RAW.csv', channels)
+
+    sensors = input_sensors(load_channel_table(), 0, channels)
+    total_scans = int(minutes * 60 * rate)
+    try:
+        for start in range(0, total_scans, chunk_scans):
+            raw_block = synthetic_scans(channels, sensors, start, min(chunk_scans, total_scans - start), rate)
+            scan_times = (start + np.arange(len(raw_block))) / rate
+            writer.write(start, scan_times, raw_block, apply_calibration(raw_block, gain, offset))
+    finally:
+        writer.close()
+    return path
+
+
+def bench_plot(path):
+    '''
+    Times save_final_plots on one session in a fresh interpreter.
+
+    @return: (wall seconds, peak RSS of the plotting process in MB)
+    '''
+    code = 'import sys, plotter; plotter.save_final_plots(sys.argv[1])'
+    start = time()
+    subprocess.run([sys.executable, '-c', code, path], cwd=SCRIPT_DIR, check=True,
+                   stdout=subprocess.DEVNULL)
+    elapsed = time() - start
+    # ru_maxrss is in KB on Linux and the max over all children so far (sizes only grow here)
+    peak_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return elapsed, peak_mb
+
+
+def run_plotter_benchmarks(args, work_dir):
+    print(f'\nPLOTTER  ({args.plot_format} input, 1000 Hz x 7 channels)')
+    print(f"{'minutes':>7} {'scans':>9} {'file MB':>8} {'plot s':>7} {'peak MB':>8}")
+    for minutes in args.plot_minutes:
+        path = write_synthetic_session(os.path.join(work_dir, f'bench_{minutes:g}min'), minutes, args.plot_format)
+        size_mb = os.path.getsize(path) / 1e6
+        elapsed, peak_mb = bench_plot(path)
+        print(f'{minutes:>7g} {int(minutes * 60000):>9} {size_mb:>8.1f} {elapsed:>7.2f} {peak_mb:>8.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Logger / plotter benchmarks on the simulated DAQ')
+    parser.add_argument('--rates', type=parse_list, default=[1000, 5000, 10000], help='scan rates in Hz, e.g. 1000,5000')
+    parser.add_argument('--channels', type=parse_list, default=[4, 7, 16], help='channel counts, e.g. 4,7,16')
+    parser.add_argument('--boards', type=int, default=1, help='simulated DAQ boards, each scanning the channel count')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per logger run')
+    parser.add_argument('--record-format', default='csv', choices=['csv', 'binary', 'both'])
+    parser.add_argument('--wait-mode', choices=logger.ScanWaiter.modes, help='override wait_mode from test.yaml')
+    parser.add_argument('--plot-minutes', type=lambda text: parse_list(text, float), default=[1, 10, 60],
+                        help='synthetic session lengths in minutes, e.g. 1,10,60')
+    parser.add_argument('--plot-format', default='csv', choices=['csv', 'binary'])
+    parser.add_argument('--skip-logger', action='store_true')
+    parser.add_argument('--skip-plotter', action='store_true')
+    parser.add_argument('--keep', action='store_true', help='keep the generated files')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='daq_bench_')
+    try:
+        if not args.skip_logger:
+            run_logger_benchmarks(args, work_dir)
+        if not args.skip_plotter:
+            run_plotter_benchmarks(args, work_dir)
+    finally:
+        if args.keep:
+            print(f'\nfiles kept in {work_dir}')
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
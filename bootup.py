@@ -1,10 +1,13 @@
-
 #!/usr/bin/python3
 
 import RPi.GPIO as GPIO
+import asyncio
+import signal
 import time
-import threading
-import subprocess
+import json
+import os
+import shutil
+import yaml
 
 # To verify the script runs @ pi bootup, execute the following commands on the terminal:
 # 1. 'sudo reboot'
@@ -12,6 +15,10 @@ import subprocess
 
 # NOTE: Press button on RaspPi to start collecting data.
 
+# Everything below runs on one asyncio event loop: the button is an edge interrupt
+# (GPIO.add_event_detect) instead of a 20 ms polling loop, and the LED, logger and plotting
+# jobs are coroutines that sleep until something happens, so the Pi is idle between presses.
+
 print("Program starting...")
 
 # GPIO setup
@@ -19,133 +26,383 @@ GPIO.setmode(GPIO.BCM)
 BUTTON_PIN = 16
 LED_PIN = 21
 
+# Edges closer together than this are contact bounce, not presses
+DEBOUNCE_MS = 50
+
 GPIO.setup(BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 GPIO.setup(LED_PIN, GPIO.OUT)
 
-# Global flag to indicate if logging is active
-actively_logging = threading.Event()
+# asyncio Events and the plot queue, made by controller() inside the running loop (on
+# Python <= 3.9 ones made at import time bind to another loop than the one asyncio.run starts)
+class ControllerState:
+    def __init__(self):
+        # Flag to indicate if logging is active
+        self.actively_logging = asyncio.Event()
+
+        # Set whenever logging is toggled, wakes log_data; led_changed wakes the LED pattern
+        self.logging_changed = asyncio.Event()
+        self.led_changed = asyncio.Event()
+
+        # Finished sessions waiting for plot_worker
+        self.plot_jobs = asyncio.Queue()
+
+        # logger_daemon.py process, once controller() has started it
+        self.logger_daemon = None
+
+# time.time() of the button press that started logging, for the daemon's start latency
+button_press_time = None
+
+# Persistent logger service (logger_daemon.py) and the socket it takes commands on
+LOGGER = '/home/pi/TESTING_DATA/logger.py'
+LOGGER_DAEMON = '/home/pi/TESTING_DATA/logger_daemon.py'
+
+# The daemon only opens its socket once it has connected to the DAQ; a start request waits this
+# long for it before falling back to logger.py (which would fight a starting daemon for the board)
+DAEMON_START_TIMEOUT = 30.0
+
+def load_logger_socket():
+    # Same path logger_daemon.py listens on: the 'daemon_socket' setting in the logger section of
+    # its test.yaml, relative to its directory (the base dir)
+    base_dir = os.path.dirname(LOGGER_DAEMON)
+    try:
+        with open(os.path.join(base_dir, 'test.yaml'), 'r') as f:
+            settings = (yaml.safe_load(f) or {}).get('logger') or {}
+    except (OSError, yaml.YAMLError) as e:
+        print(f"Could not read the logger settings, using the default socket: {e}")
+        settings = {}
+    return os.path.join(base_dir, settings.get('daemon_socket') or 'logger.sock')
+
+LOGGER_SOCKET = load_logger_socket()
+
+# ---------------------------
+# Logger daemon commands
+# ---------------------------
+# - Sends one command (start/stop/status) to logger_daemon.py and returns its JSON reply
+# - Returns None if the daemon isn't running (yet), so the caller can fall back to logger.py
+async def send_logger_command(command, timeout=15.0):
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(LOGGER_SOCKET), timeout)
+        try:
+            writer.write((command + '\n').encode('utf-8'))
+            await writer.drain()
+            line = await asyncio.wait_for(reader.readline(), timeout)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        return json.loads(line)
+    except (OSError, ValueError, asyncio.TimeoutError) as e:
+        print(f"Logger daemon not reachable: {e!r}")
+        return None
+
+# ---------------------------
+# Post-session plotting queue
+# ---------------------------
+# - Finished sessions are queued and plotted one at a time by plot_worker, so stopping a
+#   session never blocks the next one from starting, however long plotting takes
+# - Plotting runs at the lowest CPU (nice 19) and idle IO (ionice -c 3) priority so it
+#   doesn't compete with a running logger
+# - Queue state goes to PLOT_STATUS_FILE, and the LED flashes briefly while plots are pending
+PLOTTER = '/home/pi/TESTING_DATA/plotter.py'
+CONTROL_FILE = '/home/pi/TESTING_DATA/latest_csv_path.txt'
+PLOT_STATUS_FILE = '/home/pi/TESTING_DATA/plot_status.json'
+
+plot_status = {'pending': 0, 'running': None, 'done': 0, 'failed': 0, 'last_error': None}
+
+def low_priority_command(command):
+    prefix = ['nice', '-n', '19']
+    if shutil.which('ionice'):
+        prefix = ['ionice', '-c', '3'] + prefix
+    return prefix + command
+
+def write_plot_status(state):
+    # Replaced atomically so readers never see half a file
+    try:
+        tmp_path = f'{PLOT_STATUS_FILE}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(plot_status, f)
+        os.replace(tmp_path, PLOT_STATUS_FILE)
+    except OSError as e:
+        print(f"Could not write plot status file: {e}")
+    state.led_changed.set()
+
+def plots_pending():
+    return plot_status['pending'] > 0 or plot_status['running'] is not None
+
+def read_latest_session():
+    # The control file names the session the logger is (or was last) writing
+    try:
+        with open(CONTROL_FILE, 'r') as f:
+            return f.read().strip() or None
+    except OSError as e:
+        print(f"Error reading control file: {e}")
+        return None
+
+def queue_plot(state, session_path):
+    if not session_path:
+        print("No session path to plot.")
+        return
+    plot_status['pending'] += 1
+    write_plot_status(state)
+    state.plot_jobs.put_nowait(session_path)
+    print(f"Queued final plots for {session_path}")
+
+async def run_plotter(session_path):
+    try:
+        # Run the plotting script for one finished session
+        print(f"Starting final plot generation for {session_path} ...")
+        process = await asyncio.create_subprocess_exec(
+            *low_priority_command(['python3', PLOTTER, session_path]),
+            cwd=os.path.dirname(PLOTTER) # plotter reads test.yaml / sense_config.yaml from its own directory
+        )
+        returncode = await process.wait()
+        if returncode != 0: # any exit code other than zero indicates subprocess failure
+            print(f"Error executing plotter.py: exit status {returncode}")
+            return f'exit status {returncode}'
+        print("Final plots generated.")
+        return None
+    except Exception as e:
+        print(f'Unecpected error while plotting: {e}')
+        return str(e)
+
+async def plot_worker(state):
+    while True:
+        session_path = await state.plot_jobs.get()
+        plot_status['pending'] -= 1
+        plot_status['running'] = session_path
+        write_plot_status(state)
+
+        error = await run_plotter(session_path)
+
+        plot_status['running'] = None
+        if error is None:
+            plot_status['done'] += 1
+        else:
+            plot_status['failed'] += 1
+            plot_status['last_error'] = f'{session_path}: {error}'
+        write_plot_status(state)
 
 # ---------------------------
-# LED blinking thread function
+# LED blinking task
 # ---------------------------
 # - LED blinks when actively logging data
-# - LED is OFF when not logging data
+# - LED flashes briefly every 2 seconds when not logging but final plots are still being made
+# - LED is OFF when not logging data, and the task sleeps until something changes
 #
 # ... aka led go BLINK BLINK BLINK while data is being LOGGED LOGGED LOGGED
-def led_blinky():
+async def wait_for_led_change(state, timeout=None):
+    try:
+        await asyncio.wait_for(state.led_changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    state.led_changed.clear()
+
+async def led_blinky(state):
     while True:
-        if actively_logging.is_set():
+        if state.actively_logging.is_set():
             GPIO.output(LED_PIN, GPIO.HIGH)
-            time.sleep(0.8)
+            await asyncio.sleep(0.8)
             GPIO.output(LED_PIN, GPIO.LOW)
-            time.sleep(0.5)
+            await asyncio.sleep(0.5)
+        elif plots_pending():
+            GPIO.output(LED_PIN, GPIO.HIGH)
+            await asyncio.sleep(0.1)
+            GPIO.output(LED_PIN, GPIO.LOW)
+            await wait_for_led_change(state, 1.9)
         else:
             GPIO.output(LED_PIN, GPIO.LOW)
-            actively_logging.wait()
+            await wait_for_led_change(state)
 
 # ---------------------------
-# Data logging thread function
+# Data logging task
 # ---------------------------
-# - Starts/stops the data logging script based on actively_logging flag
-# - Defines a single "process" to ensure only one instance of the data logging script runs at a time
-def log_data():
+# - Starts/stops logging sessions on the logger daemon whenever actively_logging changes
+# - Falls back to running logger.py as its own process if the daemon can't be reached
+#   (restarted if it exits while logging should be happening)
+# - Only one session (daemon or process) runs at a time
+async def watch_process(state, process):
+    await process.wait()
+    state.logging_changed.set()
 
-    process = None
+async def stop_logging(state, session):
+    daemon_session, process = session
 
-    while True:
+    if daemon_session:
 
-        if actively_logging.is_set():
+        print("Stopping data logging session...")
 
-            # The data logging flag is set aka TRUE aka DATA LOGGING SHOULD BE HAPPENING.
-            # Therefore, if the logging process is not already running, start it.
+        reply = await send_logger_command('stop')
+        if reply is not None and reply.get('ok'):
+            print(f"Data logging session stopped ({reply.get('scans_written')} scans written).")
+            queue_plot(state, reply.get('plot_path'))
+        else:
+            print(f"Logger daemon did not stop cleanly: {reply.get('error') if reply else 'no reply'}")
 
-            if process is None or process.poll() is not None:
+    if process is not None and process.returncode is None:
 
-                print("Starting data logging process...")
+        print("Stopping data logging process...")
 
-                process = subprocess.Popen(
-                    ['python3', '/home/pi/TESTING_DATA/logger.py']
-                )
+        # Read which session this was now, the next one overwrites the control file
+        session_path = read_latest_session()
 
-                time.sleep(1)
-        else:
+        process.terminate() # send SIGTERM to process
 
-            # The data logging flag is not set aka FALSE aka DATA LOGGING SHOULD NOT BE HAPPENING.
-            # Therefore, if the logging process is running, terminate it.
+        try:
+            await asyncio.wait_for(process.wait(), 2)
+            print("Data logging process terminated gracefully.")
+            queue_plot(state, session_path)
 
-            if process is not None and process.poll() is None:
+        except asyncio.TimeoutError:
+            print("Data logging process did not terminate in time (2 seconds). Killing it...")
+            process.kill()
+            await process.wait()
 
-                print("Stopping data logging process...")
+    return False, None
 
-                process.terminate() # send SIGTERM to process
+async def log_data(state, session):
+    # session = [daemon session running, fallback logger.py process]; shared with the controller
+    # so it can stop whatever is running on shutdown
+    while True:
 
-                try:
-                    process.wait(timeout=2)
-                    print("Data logging process terminated gracefully.")
+        await state.logging_changed.wait()
+        state.logging_changed.clear()
 
-                    # Run the plotting script after logging thread has terminated
-                    print("Starting final plot generation ...")
-                    subprocess.run(
-                        ['python3', '/home/pi/TESTING_DATA/plotter.py'],
-                        check=True #any exit code other than zero will raise error (indicating subprocess failure)
-                    )
-                    print("Final plots generated.")
+        daemon_session, process = session
 
-                except subprocess.TimeoutExpired:
-                    print("Data logging process did not terminate in time (2 seconds). Killing it...")
-                    process.kill()
-                    process.wait()
-                except subprocess.CalledProcessError as e:
-                    print(f"Error executing plotter.py: {e}")
-                except Exception as e:
-                    print(f'Unecpected error while plotting: {e}')
+        if state.actively_logging.is_set():
 
-                process = None
+            # The data logging flag is set aka TRUE aka DATA LOGGING SHOULD BE HAPPENING.
+            # Therefore, if no session is running, start one.
 
-            if process is None:
-                actively_logging.wait()
+            if daemon_session or (process is not None and process.returncode is None):
                 continue
 
-        time.sleep(0.1)
+            print("Starting data logging session...")
 
-# ---------------------------
-# Main function
-# ---------------------------
-def main():
+            reply = await send_logger_command(f'start {button_press_time}')
 
-    # Initial button state
-    previous_button_state = GPIO.input(BUTTON_PIN) # HIGH = not pressed, LOW = pressed
-    print(f"Initial button state: {'unpressed' if previous_button_state else 'pressed'}")
+            # No socket yet while the daemon is still starting up: wait for it rather than race it for the DAQ
+            deadline = time.monotonic() + DAEMON_START_TIMEOUT
+            if reply is None and state.logger_daemon is not None and state.logger_daemon.returncode is None:
+                print("Waiting for the logger daemon to start...")
+            while (reply is None and state.actively_logging.is_set() and time.monotonic() < deadline
+                   and state.logger_daemon is not None and state.logger_daemon.returncode is None):
+                await asyncio.sleep(0.5)
+                reply = await send_logger_command(f'start {button_press_time}')
 
-    # Start threads (LED blinker & data logger)
-    # NOTE: daemon=True means the daemon-thread will automatically be killed exit when the main program exits
-    threading.Thread(target=led_blinky, daemon=True).start()
-    threading.Thread(target=log_data, daemon=True).start()
+            if not state.actively_logging.is_set():
+                # Stopped again while waiting; stop whatever got started
+                session[:] = [reply is not None and bool(reply.get('ok')), None]
+                state.logging_changed.set()
+                continue
 
-    # --- Toggle variable for logging ---
-    toggle_logging = False
+            if reply is not None and (reply.get('ok') or reply.get('error') == 'session already running'):
+                session[:] = [True, None]
+                print(f"Data logging started: {reply.get('scan_start_ms')} ms from button press to first sample")
 
-    print("Bootup complete. Waiting for button press...")
+            elif reply is not None:
+                print(f"Logger daemon could not start a session: {reply.get('error')}")
+                # Try again in a second while logging is still wanted
+                await asyncio.sleep(1)
+                state.logging_changed.set()
 
-    # Main loop: monitor button state
-    try:
-        while True:
+            else:
+                print("Starting data logging process...")
+                process = await asyncio.create_subprocess_exec('python3', LOGGER, cwd=os.path.dirname(LOGGER))
+                session[:] = [False, process]
+                asyncio.create_task(watch_process(state, process))
+                await asyncio.sleep(1)
+        else:
 
-            current_button_state = GPIO.input(BUTTON_PIN)
+            # The data logging flag is not set aka FALSE aka DATA LOGGING SHOULD NOT BE HAPPENING.
+            # Therefore, if a session is running, stop it.
 
-            if previous_button_state == GPIO.HIGH and current_button_state == GPIO.LOW:
-                # Button has just been pressed (HIGH -> LOW)
-                toggle_logging = not toggle_logging  # flip logging state
-                if toggle_logging:
-                    print("Button pressed: Starting data logging...")
-                    actively_logging.set()
-                else:
-                    print("Button pressed: Stopping data logging...")
-                    actively_logging.clear()
+            session[:] = await stop_logging(state, session)
 
-            previous_button_state = current_button_state
+# ---------------------------
+# Button handling
+# ---------------------------
+# - GPIO.add_event_detect calls on_button_edge from RPi.GPIO's own thread on every falling
+#   edge (HIGH = not pressed, LOW = pressed), with edges within DEBOUNCE_MS dropped as bounce
+# - The edge is handed over to the event loop, which toggles logging
+def on_button_edge(loop, state, channel):
+    press_time = time.time()
+    # A real press is still held down; a spike that is already gone again is noise
+    if GPIO.input(BUTTON_PIN) != GPIO.LOW:
+        return
+    loop.call_soon_threadsafe(toggle_logging, state, press_time)
+
+def toggle_logging(state, press_time):
+    global button_press_time
+
+    if not state.actively_logging.is_set():
+        print("Button pressed: Starting data logging...")
+        button_press_time = press_time
+        state.actively_logging.set()
+    else:
+        print("Button pressed: Stopping data logging...")
+        state.actively_logging.clear()
+
+    state.logging_changed.set()
+    state.led_changed.set()
+
+# ---------------------------
+# Main function
+# ---------------------------
+async def controller():
+    loop = asyncio.get_running_loop()
+    state = ControllerState()
+
+    # Stop cleanly (finishing any session) when the service manager sends SIGTERM
+    shutdown = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, shutdown.set)
+
+    # Start the logger daemon now so it is warm (imports loaded, DAQ connected) by the first press
+    print("Starting logger daemon...")
+    logger_daemon = await asyncio.create_subprocess_exec(
+        'python3', LOGGER_DAEMON,
+        cwd=os.path.dirname(LOGGER_DAEMON) # the daemon reads test.yaml / sense_config.yaml from its own directory
+    )
+    state.logger_daemon = logger_daemon
+
+    # Start tasks (LED blinker, data logger & plot queue)
+    session = [False, None]
+    tasks = [
+        asyncio.create_task(led_blinky(state)),
+        asyncio.create_task(log_data(state, session)),
+        asyncio.create_task(plot_worker(state)),
+    ]
+
+    print(f"Initial button state: {'unpressed' if GPIO.input(BUTTON_PIN) else 'pressed'}")
+    GPIO.add_event_detect(BUTTON_PIN, GPIO.FALLING, callback=lambda channel: on_button_edge(loop, state, channel),
+                          bouncetime=DEBOUNCE_MS)
+
+    print("Bootup complete. Waiting for button press...")
 
-            time.sleep(0.02) # 20ms debounce ==> press + release of button must be held at least 0.02 seconds.
+    try:
+        await shutdown.wait()
+        print("Exiting program...")
+
+    finally:
+        GPIO.remove_event_detect(BUTTON_PIN)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Finish a running session so its files are closed properly
+        await stop_logging(state, session)
+
+        try:
+            logger_daemon.terminate() # the daemon closes any open session on SIGTERM
+            await asyncio.wait_for(logger_daemon.wait(), 10)
+        except ProcessLookupError:
+            pass # already exited
+        except asyncio.TimeoutError:
+            logger_daemon.kill()
+            await logger_daemon.wait()
+
+def main():
+    try:
+        asyncio.run(controller())
 
     except KeyboardInterrupt:
         print("Exiting program...")
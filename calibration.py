@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Sensor calibration for the logger: maps raw voltages from the shock pots / brake pressure
+sensors to inches / psi using the calibration in sense_config.yaml.
+
+The channel table (the 'channels' section of sense_config.yaml) is the one place that says
+which inputs are scanned, in what order, with what range / input mode, which calibration maps
+each one and what it is called; the logger, plotter and simulated DAQ all read it.
+
+The per-sample functions (map, get_*_length, get_*_pressure) are kept for one-off
+conversions. The logger uses compile_calibration / apply_calibration instead, which turn
+the same calibration into per-channel gain/offset arrays and map a whole block of scans
+at once, and CalibrationWatcher to pick up edits to sense_config.yaml mid-session.
+'''
+import os
+import threading
+from collections import namedtuple
+import yaml
+import numpy as np
+
+#--------------------------------
+# LOAD CAL DATA FROM CONFIG FILE
+#--------------------------------
+def load_calibration_config(filename='sense_config.yaml'):
+    '''
+    Loads the whole calibration config file (shock pot and brake pressure sections).
+    '''
+    with open(filename, 'r') as f:
+        config = yaml.safe_load(f)
+    return config
+
+def load_shock_config(filename='sense_config.yaml'):
+    '''
+    Loads shock pot config data from the config file. Hardcoded to always call the config file "SchockPotConfig.yaml".
+    '''
+    return load_calibration_config(filename)['shock_pot_calibration']
+
+def load_brake_config(filename='sense_config.yaml'):
+    '''
+    Loads brake pressure sensor config data from the config file. Hardcoded to always call the config file "ShockPotConfig.yaml"
+    '''
+    return load_calibration_config(filename)['brake_pressure_calibration']
+
+# sense_config.yaml as parsed on first use by the per-sample functions below
+_cached_config = {}
+
+def cached_calibration_config():
+    '''
+    Parses sense_config.yaml once, on first use, instead of at import.
+    '''
+    if not _cached_config:
+        _cached_config.update(load_calibration_config())
+    return _cached_config
+
+#--------------------
+# MAPPING FUNCTIONS
+#--------------------
+
+def map(current_voltage, min_voltage, max_voltage, min_target, max_target):
+    '''
+    accept voltage value from shock pots / brake pressure sensors and map it to a length in inches / pressure in psi.
+
+    @param current_voltage: voltage from sensor
+
+    @param min_voltage: minimum voltage of voltage mapping range
+
+    @param max_voltage: maximum voltage of voltage mapping range
+
+    @param min_target: minimum value of target unit (either inches or psi)
+
+    @param max_target: maximum value of target unit (either inches or psi)
+    '''
+
+    # make sure all inputs are floats
+    current_voltage = float(current_voltage)
+    min_voltage = float(min_voltage)
+    max_voltage = float(max_voltage)
+    min_target = float(min_target)
+    max_target = float(max_target)
+
+    # linear mapping formula to determine length form current voltage
+    mapped = ((current_voltage - min_voltage)/(max_voltage - min_voltage))*(max_target - min_target)+ min_target
+    return mapped
+
+
+def get_short_shock_length(current_voltage):
+    '''
+    maps voltage to length in inches for the short shock pots (rear) and returns the value.
+    '''
+    short_pot_length = map(current_voltage, *get_sensor_mapping(cached_calibration_config(), 'short_shock'))
+    return short_pot_length
+
+def get_long_shock_length(current_voltage):
+    '''
+    maps voltage to length in inches for the long shock pots (front) and returns the value.
+    '''
+    long_pot_length = map(current_voltage, *get_sensor_mapping(cached_calibration_config(), 'long_shock'))
+    return long_pot_length
+
+def get_front_brake_pressure(front_brake_v):
+    '''
+    maps voltage to pressure in psi for the front brake pressure sensor and returns the value.
+    '''
+    front_brake_psi = map(front_brake_v, *get_sensor_mapping(cached_calibration_config(), 'front_brake'))
+    return front_brake_psi
+
+
+def get_rear_brake_pressure(rear_brake_v):
+    '''
+    maps voltage to pressure in psi for the rear brake pressure sensor and returns the value.
+    '''
+    rear_brake_psi = map(rear_brake_v, *get_sensor_mapping(cached_calibration_config(), 'rear_brake'))
+    return rear_brake_psi
+
+def map_y(v):
+    return v
+
+
+#------------------------------
+# CHANNEL TABLE CONFIGURATION
+#------------------------------
+
+# One recorded channel: channel number (the column in the recording), short name (plot legends),
+# label with units (axis labels), sensor type (key into sensor_cal_keys, None = passed through
+# unmapped), range and input mode (uldaq Range / AiInputMode names), the DAQ board it is wired to
+# (index into the boards found, ordered by serial number) and the input on that board (None =
+# same as channel)
+ChannelSpec = namedtuple('ChannelSpec', ['channel', 'name', 'label', 'sensor', 'range', 'input_mode', 'device', 'input'],
+                         defaults=(0, None))
+
+# Used when sense_config.yaml has no 'channels' section (older configs and recordings).
+# Brake channels are on the 2 V range because their voltage stays under 2 V (resistor value
+# on Owen's breakout board).
+default_channel_table = [
+        ChannelSpec(5, 'FR Shockpot', 'Front Right Shock Pot (Inches)', 'long_shock', 'BIP10VOLTS', 'SINGLE_ENDED'),
+        ChannelSpec(6, 'RL Shockpot', 'Rear Left Shock Pot (Inches)', 'short_shock', 'BIP10VOLTS', 'SINGLE_ENDED'),
+        ChannelSpec(13, 'RR Shockpot', 'Rear Right Shock Pot (Inches)', 'short_shock', 'BIP10VOLTS', 'SINGLE_ENDED'),
+        ChannelSpec(14, 'FL Shockpot', 'Front Left Shock Pot (Inches)', 'long_shock', 'BIP10VOLTS', 'SINGLE_ENDED'),
+        ChannelSpec(4, 'Front Brake', 'Front Brake Pressure Sensor (PSI)', 'front_brake', 'BIP2VOLTS', 'SINGLE_ENDED'),
+        ChannelSpec(12, 'Rear Brake', 'Rear Brake Pressure Sensor (PSI)', 'rear_brake', 'BIP2VOLTS', 'SINGLE_ENDED'),
+        ChannelSpec(1, 'Y Force', 'Y Force (V)', None, 'BIP10VOLTS', 'SINGLE_ENDED'),
+        ]
+
+
+def load_channel_table(config=None):
+    '''
+    Reads the channel table from the 'channels' section of the calibration config.
+
+    @param config: full calibration config, loads sense_config.yaml if not given
+
+    @return: list of ChannelSpec in scan (queue) order
+    '''
+    if config is None:
+        config = load_calibration_config()
+    entries = config.get('channels')
+    if not entries:
+        return list(default_channel_table)
+
+    table = []
+    for entry in entries:
+        chan = int(entry['channel'])
+        sensor = entry.get('sensor')
+        if sensor in ('none', ''):
+            sensor = None
+        if sensor is not None and sensor not in sensor_cal_keys:
+            raise ValueError(f"channel {chan}: unknown sensor '{sensor}', expected one of {', '.join(sensor_cal_keys)} or none")
+        table.append(ChannelSpec(chan, entry.get('name', f'Channel {chan}'), entry.get('label', entry.get('name', f'Channel {chan}')),
+                                 sensor, entry.get('range', 'BIP10VOLTS'), entry.get('input_mode', 'SINGLE_ENDED'),
+                                 int(entry.get('device', 0)), int(entry.get('input', chan))))
+
+    # Channel numbers name the columns of the recording, so they have to be unique even across boards
+    seen = {}
+    for spec in table:
+        for key, what in ((spec.channel, 'channel'), ((spec.device, spec.input), 'device / input')):
+            if (what, key) in seen:
+                raise ValueError(f'{what} {key} is used by more than one entry of the channel table')
+            seen[(what, key)] = spec
+    return table
+
+
+def channel_spec(table, chan):
+    '''
+    Looks up a channel in the table; channels not in it are unmapped, +/-10 V, single ended.
+    '''
+    for spec in table:
+        if spec.channel == chan:
+            return spec
+    return ChannelSpec(chan, f'Channel {chan}', f'Channel {chan} (V)', None, 'BIP10VOLTS', 'SINGLE_ENDED', 0, chan)
+
+
+def channel_input(spec):
+    '''
+    Physical input a channel is wired to on its board.
+    '''
+    return spec.channel if spec.input is None else spec.input
+
+
+# Where each sensor type's calibration lives in sense_config.yaml:
+# (section, sensor, key prefix, target key) -> keys like 'long_min_voltage' / 'long_max_length'
+sensor_cal_keys = {
+        'short_shock': ('shock_pot_calibration', 'short_shock_pots', 'short', 'length'),
+        'long_shock': ('shock_pot_calibration', 'long_shock_pots', 'long', 'length'),
+        'front_brake': ('brake_pressure_calibration', 'front_brake_sensor', 'front', 'brake_pressure'),
+        'rear_brake': ('brake_pressure_calibration', 'rear_brake_sensor', 'rear', 'brake_pressure'),
+        }
+
+#-------------------------------
+# VECTORIZED BLOCK CALIBRATION
+#-------------------------------
+
+def get_sensor_mapping(config, sensor):
+    '''
+    Looks up the voltage and target ranges for one sensor type.
+
+    @param config: full calibration config (see load_calibration_config)
+
+    @param sensor: key into sensor_cal_keys, e.g. 'long_shock'
+
+    @return: (min_voltage, max_voltage, min_target, max_target) as floats
+    '''
+    section, name, prefix, target = sensor_cal_keys[sensor]
+    cal = config[section][name]
+    return (float(cal[f'{prefix}_min_voltage']), float(cal[f'{prefix}_max_voltage']),
+            float(cal[f'{prefix}_min_{target}']), float(cal[f'{prefix}_max_{target}']))
+
+
+def compile_calibration(channels, config=None):
+    '''
+    Compiles the calibration into gain/offset arrays in queue order, so that
+    mapped = raw * gain + offset gives the same result as map() for every channel.
+
+    @param channels: channel numbers in queue order (same order as the scan data)
+
+    @param config: full calibration config, loads sense_config.yaml if not given
+
+    @return: (gain, offset) float64 arrays, one entry per channel
+    '''
+    if config is None:
+        config = load_calibration_config()
+    table = load_channel_table(config)
+
+    gain = np.ones(len(channels))
+    offset = np.zeros(len(channels))
+
+    for i, chan in enumerate(channels):
+        sensor = channel_spec(table, chan).sensor
+        if sensor is None:
+            continue
+        min_voltage, max_voltage, min_target, max_target = get_sensor_mapping(config, sensor)
+        gain[i] = (max_target - min_target) / (max_voltage - min_voltage)
+        offset[i] = min_target - min_voltage * gain[i]
+
+    return gain, offset
+
+
+def apply_calibration(raw_block, gain, offset, out=None):
+    '''
+    Maps a block of scans to physical units in one multiply-add.
+
+    @param raw_block: (scans, channels) array of voltages, may be a view into the DAQ buffer
+
+    @param gain, offset: arrays from compile_calibration
+
+    @param out: optional array to write the result into instead of allocating one
+    '''
+    out = np.multiply(raw_block, gain, out=out)
+    out += offset
+    return out
+
+
+#--------------------------
+# CALIBRATION HOT-RELOAD
+#--------------------------
+class CalibrationWatcher:
+    '''
+    Watches sense_config.yaml while the logger runs and recompiles the calibration when the
+    file's mtime changes, so a sensor can be recalibrated in the pits without restarting.
+
+    current is a (gain, offset, version) tuple that is replaced as a whole, never modified,
+    so a reader always gets a consistent set in a single attribute read. A file that fails to
+    load (e.g. caught mid-save) keeps the old calibration and is retried on its next change.
+
+    @param channels: channel numbers in queue order, as for compile_calibration
+
+    @param check_interval: seconds between mtime checks
+    '''
+    def __init__(self, channels, filename='sense_config.yaml', check_interval=1.0):
+        self.channels = list(channels)
+        self.filename = filename
+        self.check_interval = check_interval
+        self.mtime = self._mtime()
+        self.config = load_calibration_config(filename)
+        gain, offset = compile_calibration(self.channels, self.config)
+        self.current = (gain, offset, 0)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self):
+        '''
+        Reloads the calibration if the file changed.
+
+        @return: True if new coefficients were swapped in
+        '''
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        try:
+            config = load_calibration_config(self.filename)
+            gain, offset = compile_calibration(self.channels, config)
+        except Exception as e:
+            print(f'WARNING: could not reload {self.filename}, keeping the old calibration: {e}')
+            return False
+        if np.array_equal(gain, self.current[0]) and np.array_equal(offset, self.current[1]):
+            return False
+        self.config = config
+        self.current = (gain, offset, self.current[2] + 1)
+        return True
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='calibration-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.wait(self.check_interval):
+            self.check()
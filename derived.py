@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Streaming derived channels (filtered travel, damper velocity, brake balance), computed from the
+calibrated data block by block as the logger writes it, instead of over whole files afterwards.
+
+Each filter keeps only the last window of samples it needs between blocks, so the output is the
+same however the session is split into blocks and memory use doesn't grow with the session.
+Everything is vectorized over the block (cumulative sums / shifted differences, no per-sample loop).
+
+Derived channels are configured in test.yaml (logger: derived_channels:), one entry each:
+    {name: fl_travel_lp, type: lowpass, source: 5, window: 0.02}
+    {name: fl_velocity, type: velocity, source: 5, window: 0.01, smooth: 0.02}
+    {name: brake_balance, type: balance, front: 4, rear: 12, min_total: 50}
+types:
+    lowpass     moving average of the source over window seconds
+    velocity    slope of the source over window seconds, in source units per second; smooth
+                (seconds, optional) applies a moving average first
+    balance     front / (front + rear) in percent, NaN while front + rear is below min_total
+'''
+import numpy as np
+
+derived_types = {
+        'lowpass': {'source': None, 'window': 0.02},
+        'velocity': {'source': None, 'window': 0.01, 'smooth': 0.0},
+        'balance': {'front': 4, 'rear': 12, 'min_total': 0.0},
+        }
+
+
+def parse_derived_channels(config, channels):
+    '''
+    Checks the derived_channels setting against the scanned channels.
+
+    @param config: list of dicts from test.yaml (None or empty for no derived channels)
+
+    @param channels: channels in scan order
+
+    @return: list of dicts with 'name', 'type' and every parameter of the type filled in
+    '''
+    specs = []
+    names = {str(chan) for chan in channels}
+    for entry in config or []:
+        entry = dict(entry)
+        name = str(entry.pop('name', ''))
+        kind = entry.pop('type', None)
+        if not name:
+            raise ValueError(f'derived channel {entry} has no name')
+        if name in names:
+            raise ValueError(f"derived channel name '{name}' is already used")
+        if kind not in derived_types:
+            raise ValueError(f"derived channel '{name}': unknown type '{kind}', expected one of {', '.join(derived_types)}")
+        unknown = set(entry) - set(derived_types[kind])
+        if unknown:
+            raise ValueError(f"derived channel '{name}': unknown parameter(s) {', '.join(sorted(unknown))} for {kind}")
+
+        spec = dict(derived_types[kind])
+        spec.update(entry)
+        for key in ('source', 'front', 'rear'):
+            if key in spec and spec[key] not in channels:
+                raise ValueError(f"derived channel '{name}': {key} channel {spec[key]} is not scanned")
+        for key in ('window', 'smooth'):
+            if key in spec and not spec[key] >= 0:
+                raise ValueError(f"derived channel '{name}': {key} must be >= 0 seconds")
+        spec.update(name=name, type=kind)
+        specs.append(spec)
+        names.add(name)
+    return specs
+
+
+class MovingAverage:
+    '''
+    Moving average over the last width samples, carried across blocks.
+    '''
+    def __init__(self, width):
+        self.width = max(1, int(width))
+        self.history = None
+
+    def reset(self):
+        self.history = None
+
+    def process(self, x):
+        if self.history is None:
+            # No history yet (start or after a gap): hold the first sample
+            self.history = np.full(self.width - 1, x[0])
+        padded = np.concatenate((self.history, x))
+        sums = np.cumsum(padded)
+        out = (sums[self.width - 1:] - np.concatenate(([0.0], sums[:-self.width]))) / self.width
+        self.history = padded[len(padded) - (self.width - 1):]
+        return out
+
+
+class WindowSlope:
+    '''
+    Slope over the last width samples, (x[n] - x[n - width]) * rate / width, carried across blocks.
+    '''
+    def __init__(self, width, rate):
+        self.width = max(1, int(width))
+        self.scale = rate / self.width
+        self.history = None
+
+    def reset(self):
+        self.history = None
+
+    def process(self, x):
+        if self.history is None:
+            self.history = np.full(self.width, x[0])
+        padded = np.concatenate((self.history, x))
+        out = (padded[self.width:] - padded[:-self.width]) * self.scale
+        self.history = padded[-self.width:]
+        return out
+
+
+class DerivedChannels:
+    '''
+    Computes the derived channels of a block of calibrated scans. Blocks have to be passed in
+    scan order (the logger calls it from the pipeline's commit step); a gap in the scan index
+    restarts the filters rather than running them across the missing scans.
+
+    @param specs: from parse_derived_channels
+
+    @param channels: channels in scan order, i.e. the columns of the mapped blocks
+
+    @param rate: scan rate in Hz, turns the windows in seconds into samples
+    '''
+    def __init__(self, specs, channels, rate):
+        self.specs = specs
+        self.names = [spec['name'] for spec in specs]
+        self.next_scan = None
+        self.stages = []
+        for spec in specs:
+            if spec['type'] == 'lowpass':
+                filters = [MovingAverage(round(spec['window'] * rate))]
+            elif spec['type'] == 'velocity':
+                filters = [WindowSlope(round(spec['window'] * rate), rate)]
+                if spec['smooth'] > 0:
+                    filters.insert(0, MovingAverage(round(spec['smooth'] * rate)))
+            else:
+                filters = []
+            columns = [channels.index(spec[key]) for key in ('source', 'front', 'rear') if key in spec]
+            self.stages.append((spec, columns, filters))
+
+    def reset(self):
+        for spec, columns, filters in self.stages:
+            for f in filters:
+                f.reset()
+
+    def process(self, start_scan, mapped_block):
+        '''
+        @return: (scans, derived channels) array, columns in the order of names
+        '''
+        if self.next_scan is not None and start_scan != self.next_scan:
+            self.reset()
+        self.next_scan = start_scan + len(mapped_block)
+
+        out = np.empty((len(mapped_block), len(self.stages)))
+        for i, (spec, columns, filters) in enumerate(self.stages):
+            if spec['type'] == 'balance':
+                front, rear = mapped_block[:, columns[0]], mapped_block[:, columns[1]]
+                total = front + rear
+                out[:, i] = np.nan
+                np.divide(front * 100.0, total, out=out[:, i], where=total > max(spec['min_total'], 0.0))
+                continue
+            x = mapped_block[:, columns[0]]
+            for f in filters:
+                x = f.process(x)
+            out[:, i] = x
+        return out
+
+    def process_records(self, scan_index, mapped_block):
+        '''
+        Like process, for a block of records that can skip scans (a recording with gaps): each run
+        of consecutive scans is processed in turn, so the filters restart after every gap.
+
+        @param scan_index: scan index of each record, increasing
+        '''
+        runs = np.split(np.arange(len(scan_index)), np.flatnonzero(np.diff(scan_index) != 1) + 1)
+        return np.concatenate([self.process(scan_index[run[0]], mapped_block[run]) for run in runs])
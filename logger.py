@@ -35,17 +35,34 @@ Steps:
 from __future__ import print_function
 from os import system
 from sys import stdout
-from time import time, strftime
-import csv
+from time import time, strftime, sleep, process_time, clock_gettime, pthread_getcpuclockid
+import threading
+import signal
+import math
 import yaml
-#from plotter import LivePlotter
 import os
+import numpy as np
 
 #import shutil
 
-from uldaq import (get_daq_device_inventory, DaqDevice, AInScanFlag,
-                   AiInputMode, AiQueueElement, create_float_buffer,
-                   ScanOption, ScanStatus, InterfaceType, Range)
+from calibration import (load_channel_table, channel_spec, channel_input, apply_calibration, CalibrationWatcher,
+                         ChannelSpec)
+from recording import (CsvRecordingWriter, BinaryRecordingWriter, SegmentedRecordingWriter, SummaryWriter, GapLog,
+                       CalibrationLog, EventLog, write_end_marker, segment_path, SEGMENT_INDEX_SUFFIX)
+from pipeline import AcquisitionPipeline, ScanBlock, StreamMerger
+from derived import parse_derived_channels, DerivedChannels
+from trigger import parse_trigger_conditions, TriggerRecorder
+from metrics import MetricsRegistry, MetricsReporter
+import sim_daq
+# Enums, queue elements and buffers are uldaq's own when it is installed (see sim_daq.py)
+from sim_daq import (AInScanFlag, AiInputMode, AiQueueElement, create_float_buffer,
+                     ScanOption, ScanStatus, InterfaceType, Range, DaqEventType,
+                     ULException)
+try:
+    import uldaq
+except ImportError:
+    # No MCC library on this machine, only the simulated backend is available
+    uldaq = None
 #-----------------------------------------------
 # SAVE CONFIG FILE WITH SAME NAME AS SCRIPT
 #-----------------------------------------------
@@ -68,35 +85,6 @@ def save_config_copy(ogconfigfile, csv_name, dir_name):
         copy_file.write(config)
 
 
-
-
-#--------------------------------
-# LOAD CAL DATA FROM CONFIG FILE
-#--------------------------------
-def load_shock_config(filename='sense_config.yaml'):
-    '''
-    Loads shock pot config data from the config file. Hardcoded to always call the config file "SchockPotConfig.yaml".
-    '''
-    with open(filename, 'r') as f:
-        config = yaml.safe_load(f)
-    return config['shock_pot_calibration']
-
-def load_brake_config(filename='sense_config.yaml'):
-    '''
-    Loads brake pressure sensor config data from the config file. Hardcoded to always call the config file "ShockPotConfig.yaml"
-    '''
-    with open(filename, 'r') as f:
-        config = yaml.safe_load(f)
-    return config['brake_pressure_calibration']
-
-shock_cal = load_shock_config()
-short_cal = shock_cal['short_shock_pots']
-long_cal = shock_cal['long_shock_pots']
-
-brake_cal = load_brake_config()
-front_cal = brake_cal['front_brake_sensor']
-rear_cal = brake_cal['rear_brake_sensor']
-
 def load_fp_save_config(filename='test.yaml'):
     with open(filename, 'r') as f:
         config_fp = yaml.safe_load(f)
@@ -104,141 +92,185 @@ def load_fp_save_config(filename='test.yaml'):
 
 date_filepath = load_fp_save_config()
 print(date_filepath)
-#--------------------
-# MAPPING FUNCTIONS
-#--------------------
-
-def map(current_voltage, min_voltage, max_voltage, min_target, max_target):
-    '''
-    accept voltage value from shock pots / brake pressure sensors and map it to a length in inches / pressure in psi.
-
-    @param current_voltage: voltage from sensor
-
-    @param min_voltage: minimum voltage of voltage mapping range
 
-    @param max_voltage: maximum voltage of voltage mapping range
+# Defaults for the optional 'logger' section of test.yaml
+logger_defaults = {
+        'backend': 'uldaq', # uldaq (MCC board) or sim (simulated board, see sim_daq.py)
+        'console': True, # print the status summary to the terminal
+        'record_format': 'csv', # csv (_MAPPPED/_RAW.csv pair), binary (_RAW.bin) or both
+        'queue_blocks': 256, # blocks waiting for the writer before new ones get dropped
+        'worker_threads': 1, # threads calibrating blocks; files are still written in order
+        'wait_mode': 'sleep', # spin (busy poll), sleep (rate based) or event (uldaq data-available event)
+        'wait_scans': 50, # scans to wait for before draining the buffer (latency vs CPU)
+        'metrics_file': 'logger_metrics.prom', # Prometheus text file in the base dir, '' to disable
+        'metrics_port': 0, # serve metrics on http://127.0.0.1:<port>/metrics, 0 to disable
+        'console_interval': 1.0, # seconds between console status summaries
+        'live_plot': False, # publish a rolling live view of the last live_window seconds as a PNG
+        'live_plot_file': 'live_plot.png', # live view image in the base dir
+        'live_window': 10.0, # seconds shown in the live view
+        'live_fps': 2.0, # max live view redraws per second
+        'daemon_socket': 'logger.sock', # Unix socket logger_daemon.py listens on, in the base dir
+        'write_buffer_kb': 1024, # output file buffer, i.e. the size of each batch written to the SD card
+        'fsync_interval': 5.0, # max seconds between fsyncs of the recording, 0 for only at the end
+        'fsync_mb': 8, # max MB written between fsyncs, 0 for no size threshold
+        'segment_seconds': 0, # start a new segment of the session's files this often, 0 = one file per session
+        'segment_mb': 0, # also start a new segment once a file reaches this size, 0 = no size limit
+        'derived_channels': [], # filtered / velocity / brake balance channels computed while logging, see derived.py
+        'summary_levels': [0.01, 0.1, 1.0], # bucket lengths (s) of the min/max/mean summary pyramid, [] for none
+        'trigger_conditions': [], # store only event windows around these conditions (see trigger.py), [] = record everything
+        'pre_trigger': 1.0, # seconds stored before the trigger fires
+        'post_trigger': 2.0, # seconds stored after the last trigger of an event
+        'calibration_reload': True, # apply sense_config.yaml edits mid-session
+        'calibration_check_interval': 1.0, # seconds between sense_config.yaml mtime checks
+        'profile': 'standard', # acquisition profile to run, from default_profiles or 'profiles'
+        'profiles': {}, # acquisition profiles added to / overriding default_profiles
+        }
 
-    @param min_target: minimum value of target unit (either inches or psi)
+# Settings of an acquisition profile; anything a profile leaves out comes from here
+profile_defaults = {
+        'rate': 1000, # requested scan rate per channel in Hz
+        'channels': None, # channels to scan in queue order, None = the whole channel table
+        'ranges': {}, # range overrides per channel, e.g. {4: BIP1VOLTS}
+        'latency_budget': 2.0, # longest polling / writer stall (s) the DAQ buffer has to ride out
+        'rate_tolerance': 0.001, # max relative difference between the requested and actual scan rate
+        'self_test_seconds': 0, # startup self-test length, 0 to skip it (it delays the session start)
+        }
 
-    @param max_target: maximum value of target unit (either inches or psi)
-    '''
+default_profiles = {
+        'standard': {},
+        'high_rate': {'rate': 10000, 'latency_budget': 1.0},
+        }
 
-    # make sure all inputs are floats
-    current_voltage = float(current_voltage)
-    min_voltage = float(min_voltage)
-    max_voltage = float(max_voltage)
-    min_target = float(min_target)
-    max_target = float(max_target)
+# Largest DAQ buffer a latency budget may ask for, per board
+MAX_BUFFER_BYTES = 64 * 1024 * 1024
 
-    # linear mapping formula to determine length form current voltage
-    mapped = ((current_voltage - min_voltage)/(max_voltage - min_voltage))*(max_target - min_target)+ min_target
-    return mapped
+# A self-test fails if calibrating and writing a second of data takes longer than this
+SELF_TEST_MAX_LOAD = 0.5
+# or the board's scan rate measured against the host clock is further off than this
+SELF_TEST_RATE_TOLERANCE = 0.02
 
+# Profiles that already passed the self-test in this process (the daemon runs many sessions)
+self_tests_passed = set()
 
-def get_short_shock_length(current_voltage):
+def get_daq_backend(name):
     '''
-    maps voltage to length in inches for the short shock pots (rear) and returns the value.
+    Returns the module providing get_daq_device_inventory / DaqDevice for the 'backend' setting.
     '''
-    short_pot_length = map(current_voltage, short_cal['short_min_voltage'], short_cal['short_max_voltage'], short_cal['short_min_length'], short_cal['short_max_length'])
-    return short_pot_length
+    if name == 'sim':
+        return sim_daq
+    if name == 'uldaq':
+        if uldaq is None:
+            raise RuntimeError("Error: uldaq is not installed, set 'backend: sim' in test.yaml to use the simulated DAQ")
+        return uldaq
+    raise RuntimeError(f"Error: unknown backend '{name}' in test.yaml, expected uldaq or sim")
 
-def get_long_shock_length(current_voltage):
-    '''
-    maps voltage to length in inches for the long shock pots (front) and returns the value.
-    '''
-    long_pot_length = map(current_voltage, long_cal['long_min_voltage'], long_cal['long_max_voltage'], long_cal['long_min_length'], long_cal['long_max_length'])
-    return long_pot_length
 
-def get_front_brake_pressure(front_brake_v):
+def load_logger_config(filename='test.yaml'):
     '''
-    maps voltage to pressure in psi for the front brake pressure sensor and returns the value.
+    Loads the logger settings from the 'logger' section of test.yaml, filling in defaults for anything not set.
     '''
-    front_brake_psi = map(front_brake_v, front_cal['front_min_voltage'], front_cal['front_max_voltage'], front_cal['front_min_brake_pressure'], front_cal['front_max_brake_pressure'])
-    return front_brake_psi
+    with open(filename, 'r') as f:
+        config = yaml.safe_load(f)
+    settings = dict(logger_defaults)
+    settings.update(config.get('logger') or {})
+    return settings
 
+def a_in_main(settings=None, base_dir='/home/pi/TESTING_DATA', stop_event=None, rate=None, channels=None,
+              daq_devices=None, started=None):
+    """Analog input scan with queue example.
 
-def get_rear_brake_pressure(rear_brake_v):
-    '''
-    maps voltage to pressure in psi for the rear brake pressure sensor and returns the value.
-    '''
-    rear_brake_psi = map(rear_brake_v, rear_cal['rear_min_voltage'], rear_cal['rear_max_voltage'], rear_cal['rear_min_brake_pressure'], rear_cal['rear_max_brake_pressure'])
-    return rear_brake_psi
-
-def map_y(v):
-    return v
-
-
-#------------------------------
-# CHANNEL MAP CONFIGURATION
-#------------------------------
-
-channel_map = {5: get_long_shock_length, #front right shock pot
-               13: get_short_shock_length, #rear right shock pot
-               6: get_short_shock_length, #rear left shock pot
-               14: get_long_shock_length, #front left shock pot
-               12: get_rear_brake_pressure, #rear brake pressure sensor
-               4: get_front_brake_pressure, #front brake pressure sensor
-               1: map_y
-               }
-
-#------------------------------
-# CHANNEL NAME CONFIGURATION
-#------------------------------
-
-channel_name = {
-        5: 'Front right shock pot',
-        13: 'Rear right shock pot',
-        6: 'Rear left shock pot',
-        14: 'Front left shock pot',
-        12: 'Rear brake pressure sensor',
-        4: 'Front brake pressure sensor',
-        1: 'y force'
-        }
+    Runs until Ctrl+C / stop_event is set. All arguments are optional, for driving the logger
+    from other scripts (benchmark.py):
 
+    @param settings: logger settings, defaults to the logger section of test.yaml
 
-channel_name_mapped = {
-        5: 'Front right shock pot (inches)',
-        13: 'Rear right shock pot (inches)',
-        6: 'Rear left shock pot (inches)',
-        14: 'Front left shock pot (inches)',
-        12: 'Rear brake pressure (PSI)',
-        4: 'Front brake pressure (PSI)',
-        1: 'y force'
-        }
+    @param base_dir: directory the save_fp directory and the control file live in
 
-channel_name_raw = {
-        5: 'Front right shock pot (V)',
-        14: 'Front left shock pot (V)',
-        12: 'Rear brake sensor (V)',
-        4: 'Front brake sensor (V)'
-        }
+    @param stop_event: threading.Event that ends the session when set
+
+    @param rate: requested scan rate in Hz, defaults to the profile's
+
+    @param channels: channels to scan in queue order, defaults to the profile's or else the channel
+                     table in sense_config.yaml. Channel numbers are looked up in the table;
+                     ChannelSpecs are used as they are.
+
+    @param daq_devices: already connected DaqDevices to use (logger_daemon.py), one per board in
+                        the channel table; they are left connected at the end. None finds and connects
+                        to the boards, and releases them after.
+
+    @param started: callable(scan_start_time, first_block_time) called once from the polling thread
+                    when the first block has been read, e.g. to measure start latency
 
-def a_in_main():
-    print('I')
-    """Analog input scan with queue example."""
-    daq_device = None
-    ai_device = None
-    status = ScanStatus.IDLE
+    @return: dict of session stats (scans written / dropped, per stage timings, cpu), None on setup errors
+    """
+    owns_devices = daq_devices is None
+    devices = []
+    session_stats = None
 
     interface_type = InterfaceType.ANY
-    samples_per_channel = 1000
-    rate = 1000
     scan_options = ScanOption.DEFAULTIO | ScanOption.CONTINUOUS
     flags = AInScanFlag.DEFAULT
 
-    channels = [5,6,13,14,4,12, 1]
-    short_channels = [6,13]
-    long_channels = [5,14]
+    if settings is None:
+        settings = load_logger_config()
+    if stop_event is None:
+        stop_event = threading.Event()
+
+    # Rate, channel set, ranges and buffer latency budget come from the acquisition profile
+    try:
+        profile = load_profile(settings)
+    except RuntimeError as e:
+        print(f'ERROR: {e}')
+        return
+    if rate is None:
+        rate = profile['rate']
+    if channels is None:
+        channels = profile['channels']
+
+    # Names, sensors, ranges and input modes of every input come from the channel table
+    try:
+        channel_table = load_channel_table()
+    except Exception as e:
+        print(f'ERROR: could not load the channel table from sense_config.yaml: {e}')
+        return
+    if channels is None:
+        channels = [spec.channel for spec in channel_table]
+    channel_specs = [chan if isinstance(chan, ChannelSpec) else channel_spec(channel_table, chan) for chan in channels]
+    range_overrides = {int(chan): name for chan, name in (profile['ranges'] or {}).items()}
+    channel_specs = [spec._replace(range=range_overrides.get(spec.channel, spec.range)) for spec in channel_specs]
+    channels = [spec.channel for spec in channel_specs]
     channel_count = len(channels)
-    low_channel=0
-    high_channel=3
+    # Boards the channels are spread over, and the positions of each board's channels in a scan
+    device_columns = [[i for i, spec in enumerate(channel_specs) if spec.device == device]
+                      for device in range(boards_needed(channel_specs))]
+
+    # DAQ buffer sized to ride out latency_budget seconds without a drain (same size on every board)
+    samples_per_channel = buffer_scans(rate, max(len(columns) for columns in device_columns),
+                                       profile['latency_budget'], settings['wait_scans'])
 
     print('assigned channels')
+    record_format = settings['record_format']
+    if record_format not in ('csv', 'binary', 'both'):
+        print(f"ERROR: unknown record_format '{record_format}' in test.yaml, expected csv, binary or both")
+        return
+    if settings['wait_mode'] not in ScanWaiter.modes:
+        print(f"ERROR: unknown wait_mode '{settings['wait_mode']}' in test.yaml, expected {', '.join(ScanWaiter.modes)}")
+        return
+    try:
+        derived_specs = parse_derived_channels(settings['derived_channels'], channels)
+    except ValueError as e:
+        print(f"ERROR: {e} (derived_channels in test.yaml)")
+        return
+    try:
+        trigger_conditions = parse_trigger_conditions(settings['trigger_conditions'],
+                                                      channels + [spec['name'] for spec in derived_specs])
+    except ValueError as e:
+        print(f"ERROR: {e} (trigger_conditions in test.yaml)")
+        return
 
     #--------------
     # FILE NAMING
     #--------------
-    base_dir = '/home/pi/TESTING_DATA'
     date_filepath = str(load_fp_save_config())
     #file_dir = os.path.join(base_dir, date_filepath)
 
@@ -259,15 +291,32 @@ def a_in_main():
 
     timestr = strftime("%m-%d-%Y_%H-%M-%S")
     filename = timestr + "_MCC_DAQ_DATA"
-    filename_mapped = os.path.join(file_dir, f'{filename}_MAPPPED.csv')
-    filename_raw = os.path.join(file_dir, f'{filename}_RAW.csv')
+    file_base = os.path.join(file_dir, filename)
+    filename_mapped = segment_path(file_base, None, 'mapped')
+    filename_raw = segment_path(file_base, None, 'raw')
+    filename_bin = segment_path(file_base, None, 'binary')
+    filename_segments = os.path.join(file_dir, f'{filename}{SEGMENT_INDEX_SUFFIX}')
+    filename_gaps = os.path.join(file_dir, f'{filename}_GAPS.csv')
+    filename_end = os.path.join(file_dir, f'{filename}_END.json')
+    filename_calib = os.path.join(file_dir, f'{filename}_CALIB.csv')
+    filename_summary = os.path.join(file_dir, f'{filename}_SUMMARY.bin')
+    filename_events = os.path.join(file_dir, f'{filename}_EVENTS.csv')
+
+    # Plot from the mapped CSV when there is one, otherwise straight from the binary recording;
+    # a segmented session is plotted through its segment index. Trigger mode stores every event
+    # as its own segment(s).
+    segmented = settings['segment_seconds'] > 0 or settings['segment_mb'] > 0 or bool(trigger_conditions)
+    if segmented:
+        filename_plot = filename_segments
+    else:
+        filename_plot = filename_bin if record_format == 'binary' else filename_mapped
 
     # Write the path to a control file for the plotter to be able to access when naming plots
     CONTROL_FILE = os.path.join(base_dir, 'latest_csv_path.txt')
     try:
         with open(CONTROL_FILE, 'w') as f:
-            f.write(filename_mapped)
-        print(f"Control file updated with: {filename_mapped}")
+            f.write(filename_plot)
+        print(f"Control file updated with: {filename_plot}")
     except Exception as e:
         print(f"ERROR: Could not write control file {CONTROL_FILE}: {e}")
 
@@ -291,77 +340,26 @@ def a_in_main():
         print(f'ERROR: Could not create copy of config file: {e}')
 
     try:
-        # Get descriptors for all the available DAQ devices.
-        devices = get_daq_device_inventory(interface_type)
-        number_of_devices = len(devices)
-        if number_of_devices == 0:
-            raise RuntimeError('Error: No DAQ devices found')
-
-        # Create the DAQ device from the descriptor at the specified index.
-        daq_device = DaqDevice(devices[0])
-
-        # Get the AiDevice object and verify that it is valid.
-        ai_device = daq_device.get_ai_device()
-
-        # Verify the specified device supports hardware pacing for analog input.
-        ai_info = ai_device.get_info()
-
-        # Establish a connection to the DAQ device.
-        descriptor = daq_device.get_descriptor()
-        print('\nConnecting to', descriptor.dev_string, '- please wait...')
-        # For Ethernet devices using a connection_code other than the default
-        # value of zero, change the line below to enter the desired code.
-        daq_device.connect(connection_code=0)
-
-        # The default input mode is SINGLE_ENDED.
-        input_mode = [AiInputMode.SINGLE_ENDED,AiInputMode.SINGLE_ENDED,AiInputMode.SINGLE_ENDED,AiInputMode.SINGLE_ENDED,AiInputMode.SINGLE_ENDED,AiInputMode.SINGLE_ENDED,AiInputMode.SINGLE_ENDED,AiInputMode.SINGLE_ENDED,AiInputMode.SINGLE_ENDED,AiInputMode.SINGLE_ENDED, AiInputMode.DIFFERENTIAL]
-        print(input_mode)
-
-        # Get the number of channels and validate the high channel number.
-        number_of_channels = ai_info.get_num_chans_by_mode(input_mode[0])
-
-        # Get a list of supported ranges and validate the range index.
-        ranges = ai_info.get_ranges(input_mode[0])
-
-        # 0 = BIP10VOLTS, 1 = BIP5VOLTS, 2 = BIP2VOLTS, 3 = BIP1VOLTS
-        #channel_ranges = [0, 1, 2, 3]
-
-        # set brake pressure channels to 2V because the voltage range is under 2V (due to incorrect resistor value on Owen's breakout board)
-        channel_ranges = [0, 0, 0, 0, 2, 2, 0]
-
-        # Get a list of supported queue types.
-        queue_types = ai_info.get_queue_types()
-
-        # Assign each channel in the queue an input mode (SE/DIFF) and a range.
-        # If multiple ranges are supported, we will cycle through them and
-        # repeat ranges if the number of channels exceeds the number of ranges.
-        #
-        # This block of code could be used to set other queue elements such as
-        # the input mode and channel list.
-        queue_list = []
-        #print(range(len(channels)))
-        for i, n in enumerate(channels):
-            queue_element = AiQueueElement()
-            queue_element.channel = n
-            queue_element.input_mode = input_mode[i]
-            print(i, channels[i], n)
-            queue_element.range = ranges[channel_ranges[i]]
-
-            queue_list.append(queue_element)
-
-        # Load the queue.
-        ai_device.a_in_load_queue(queue_list)
-
-        data = create_float_buffer(channel_count, samples_per_channel)
-
-        print('\n', descriptor.dev_string, ' ready', sep='')
-        print('    Function demonstrated: ai_device.a_in_load_queue()')
-        print('    Channels: ', channels)
-        for i in range(channel_count):
-            print('        Channel:', queue_list[i].channel,
-                  ', Input mode:', AiInputMode(queue_list[i].input_mode).name,
-                  ', Range:', Range(queue_list[i].range).name)
-        print('    Samples per channel: ', samples_per_channel)
+        if owns_devices:
+            daq_devices = open_daq_devices(get_daq_backend(settings['backend']), len(device_columns), interface_type)
+        elif len(daq_devices) < len(device_columns):
+            raise RuntimeError(f'Error: the channel table uses {len(device_columns)} DAQ boards, {len(daq_devices)} connected')
+
+        # Load every board's queue and buffer first, so the scans can be started back to back
+        for device, columns in enumerate(device_columns):
+            if not columns:
+                raise RuntimeError(f'Error: no channels on DAQ board {device} in the channel table')
+            devices.append(DeviceScan(device, daq_devices[device], [channel_specs[i] for i in columns],
+                                      columns, samples_per_channel))
+        for device in devices:
+            device.load_queue()
+
+        # Calibration compiled into per-channel gain/offset arrays in queue order (recompiled by
+        # the watcher when sense_config.yaml changes).
+        calibration_watcher = CalibrationWatcher(channels, check_interval=settings['calibration_check_interval'])
+
+        print('    Profile: ', profile['name'])
+        print('    Samples per channel: ', samples_per_channel, f"({samples_per_channel / rate:.2f} s of buffer)")
         print('    Rate: ', rate, 'Hz')
         print('    Scan options:', display_scan_options(scan_options))
         '''
@@ -370,179 +368,841 @@ def a_in_main():
         except (NameError, SyntaxError):
             pass
         '''
-        # Start the acquisition.
-        #
-        # When using the queue, the low_channel, high_channel, input_mode, and
-        # range parameters are ignored since they are specified in queue_array.
-        rate = ai_device.a_in_scan(low_channel, high_channel, input_mode[0],
-                                   ranges[0], samples_per_channel,
-                                   rate, scan_options, flags, data)
-
-        system('clear')
+        # matplotlib is only imported when the live view is on, and before the scan starts
+        # since the import takes longer than the DAQ buffer lasts.
+        if settings['live_plot']:
+            from plotter import LivePlotter
+
+        # Data-available events have to be enabled before the scan starts.
+        for device in devices:
+            device.check_rate(rate)
+            device.enable_waiter(settings['wait_mode'], settings['wait_scans'])
+        print('    Wait mode:', devices[0].waiter.mode, '(', devices[0].waiter.wait_scans, 'scans )')
+
+        # Big buffered batches to the SD card, fsync'ed on an interval / byte threshold
+        sync_options = {
+            'buffer_bytes': int(settings['write_buffer_kb'] * 1024),
+            'fsync_interval': settings['fsync_interval'],
+            'fsync_bytes': int(settings['fsync_mb'] * 1024 * 1024),
+            }
+
+        # Make sure the boards and this host keep up with the profile before the session starts
+        self_test_key = (profile['name'], rate, tuple(channels), record_format, settings['backend'],
+                         tuple(spec['name'] for spec in derived_specs), tuple(settings['summary_levels']))
+        if profile['self_test_seconds'] > 0 and self_test_key not in self_tests_passed:
+            def self_test_writers():
+                test_base = os.path.join(file_dir, f'.{filename}_SELFTEST')
+                paths = [f'{test_base}_MAPPPED.csv', f'{test_base}_RAW.csv', f'{test_base}_RAW.bin',
+                         f'{test_base}_SUMMARY.bin']
+                test_writers = []
+                if record_format in ('csv', 'both'):
+                    test_writers.append(CsvRecordingWriter(paths[0], paths[1], channels,
+                                                           [spec['name'] for spec in derived_specs], **sync_options))
+                if record_format in ('binary', 'both'):
+                    test_writers.append(BinaryRecordingWriter(paths[2], {'channels': channels, 'rate': rate},
+                                                              **sync_options))
+                if settings['summary_levels']:
+                    test_writers.append(SummaryWriter(paths[3], channels + [spec['name'] for spec in derived_specs], rate,
+                                                      [round(level * rate) for level in settings['summary_levels']],
+                                                      **sync_options))
+                return test_writers, paths
+
+            gain, offset, _ = calibration_watcher.current
+            passed, report = run_self_test(devices, rate, scan_options, flags, profile, gain, offset,
+                                           self_test_writers, DerivedChannels(derived_specs, channels, rate))
+            for line in report:
+                print('    Self-test:', line)
+            if not passed:
+                raise RuntimeError(f"Error: self-test failed for profile '{profile['name']}', lower the rate / "
+                                   f"channel count or raise latency_budget")
+            self_tests_passed.add(self_test_key)
+
+        # Start the acquisition on every board, as close together as possible.
+        rates = [device.start_scan(rate, scan_options, flags) for device in devices]
+        requested_rate, rate = rate, rates[0]
+        check_actual_rate(requested_rate, rates, profile['rate_tolerance'])
+
+        # Derived channels, computed in scan order as blocks are committed (windows set by the actual rate)
+        derived = DerivedChannels(derived_specs, channels, rate)
+
+        # Scans the boards that started first recorded before the last one started; dropping them
+        # lines scan 0 of every board up (to within a scan period plus the a_in_scan call time)
+        common_start = max(device.scan_start for device in devices)
+        shifts = [round((common_start - device.scan_start) * rate) for device in devices]
+        if len(devices) > 1:
+            print(f'    Boards started within {(common_start - min(device.scan_start for device in devices)) * 1000:.2f} ms, '
+                  f'aligned by dropping {shifts} scans')
+
+        if settings['console']:
+            system('clear')
 
         starttime = time()
 
-        with open(filename_mapped, mode="w", newline="") as mapped_file, open(filename_raw, mode='w', newline="") as raw_file:
-            mapped_writer = csv.writer(mapped_file)
-            raw_writer = csv.writer(raw_file)
+        def open_writers(segment=None, first_scan=0):
+            # Output files of the session, or of one segment of it: list of (kind, path, writer)
+            files = []
+            if record_format in ('csv', 'both'):
+                paths = segment_path(file_base, segment, 'mapped'), segment_path(file_base, segment, 'raw')
+                files.append(('mapped', paths[0], CsvRecordingWriter(paths[0], paths[1], channels, derived.names,
+                                                                     **sync_options)))
+                files.append(('raw', paths[1], files[-1][2]))
+            if record_format in ('binary', 'both'):
+                path = segment_path(file_base, segment, 'binary')
+                # Calibration snapshot as of the segment's start, later changes are in _CALIB.csv
+                header = dict(binary_header, first_scan=first_scan, calibration=calibration_watcher.config)
+                if segment is not None:
+                    header['segment'] = segment
+                files.append(('binary', path, BinaryRecordingWriter(path, header, **sync_options)))
+            return files
+
+        binary_header = {
+                'channels': channels,
+                'ranges': [spec.range for spec in channel_specs],
+                'input_modes': [spec.input_mode for spec in channel_specs],
+                'devices': [{
+                    'dev_string': device.descriptor.dev_string,
+                    'unique_id': device.descriptor.unique_id,
+                    'channels': [channels[i] for i in device.columns],
+                    'aligned_scans': shift,
+                    } for device, shift in zip(devices, shifts)],
+                'rate': rate,
+                'requested_rate': requested_rate,
+                'profile': profile['name'],
+                'buffer_scans': samples_per_channel,
+                'start_time': timestr,
+                'calibration': calibration_watcher.config,
+                # Recomputed by recording.export_csv
+                'derived': derived_specs,
+                }
+
+        if segmented:
+            writers = [SegmentedRecordingWriter(filename_segments, open_writers, rate,
+                                                segment_scans=round(settings['segment_seconds'] * rate),
+                                                segment_bytes=int(settings['segment_mb'] * 1024 * 1024))]
+        else:
+            writers = list({id(writer): writer for kind, path, writer in open_writers()}.values())
+        trigger_recorder = None
+        if trigger_conditions:
+            trigger_recorder = TriggerRecorder(writers, EventLog(filename_events, rate), trigger_conditions, rate,
+                                               settings['pre_trigger'], settings['post_trigger'])
+            writers = [trigger_recorder]
+        if settings['summary_levels']:
+            # Whole-session overview (idle time between events included), so plots don't have to read the full-rate data
+            writers.append(SummaryWriter(filename_summary, channels + derived.names, rate,
+                                         [round(level * rate) for level in settings['summary_levels']],
+                                         **sync_options))
+
+        # Scans the board / writer queue lost, so the recording's time base can be trusted
+        gap_log = GapLog(filename_gaps, rate)
+        # Scans each calibration applies from (first row = calibration at start)
+        calibration_log = CalibrationLog(filename_calib, channels, rate)
+
+        #-----------------------
+        # HOT PATH INSTRUMENTATION
+        #-----------------------
+        metrics = MetricsRegistry()
+        poll_interval = metrics.histogram('poll_interval_seconds', 'Time between buffer drains')
+        status_time = metrics.histogram('scan_status_seconds', 'Time spent in get_scan_status')
+        scans_per_drain = metrics.histogram('scans_per_drain', 'Scans copied out of the DAQ buffer per drain',
+                                            (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000))
+        buffer_fill = metrics.histogram('buffer_fill_ratio', 'Fraction of the DAQ buffer holding unread scans at each drain',
+                                        (0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0))
+        calibration_time = metrics.histogram('calibration_seconds', 'Time to timestamp and calibrate one block')
+        write_time = metrics.histogram('write_seconds', 'Time to write one block to every output file')
+        derived_time = metrics.histogram('derived_seconds', 'Time to compute the derived channels of one block')
+        scans_acquired = metrics.counter('scans_acquired_total', 'Scans copied out of the DAQ buffer')
+        scans_written = metrics.counter('scans_written_total', 'Scans written to the recording')
+        scans_missing = metrics.counter('scans_missing_total', 'Scans lost to buffer overruns or a full writer queue')
+        queue_depth = metrics.gauge('queue_depth_blocks', 'Blocks waiting for the writer')
+        effective_rate = metrics.gauge('effective_scan_rate_hz', 'Scans written per second over the last interval')
+        poll_cpu = metrics.gauge('poll_thread_cpu_ratio', 'CPU seconds per second used by the polling thread')
+        process_cpu = metrics.gauge('process_cpu_ratio', 'CPU seconds per second used by the whole logger process')
+        metrics.gauge('scan_rate_hz', 'Actual scan rate returned by a_in_scan').set(rate)
+        metrics.gauge('channels', 'Channels per scan').set(channel_count)
+
+        def prepare_block(block):
+            with calibration_time.time():
+                # Timestamps come from the hardware sample clock: scan index / actual scan rate
+                scan_times = (block.start_scan + np.arange(len(block))) / rate
+                gain, offset, version = block.calibration
+                return scan_times, apply_calibration(block.raw, gain, offset)
+
+        def commit_block(block, prepared):
+            scan_times, mapped_block = prepared
+            # Commits run in scan order, so this is the exact scan a new calibration starts at
+            if block.calibration[2] != calibration_log.version:
+                calibration_log.record(block.start_scan, *block.calibration)
+                if calibration_log.changes > 1:
+                    print(f'\nCalibration reloaded from sense_config.yaml at scan {block.start_scan} '
+                          f'({block.start_scan / rate:.3f} s)')
+            if derived.names:
+                # Filter state carries over from the previous block, so this runs here in scan order
+                with derived_time.time():
+                    output_block = np.column_stack((mapped_block, derived.process(block.start_scan, mapped_block)))
+            else:
+                output_block = mapped_block
+            with write_time.time():
+                for writer in writers:
+                    writer.write(block.start_scan, scan_times, block.raw, output_block)
+            scans_written.inc(len(block))
+            if live_plotter is not None:
+                live_plotter.push(block.start_scan, mapped_block)
+            latest['time'] = scan_times[-1]
+            latest['raw'] = block.raw[-1]
+            latest['mapped'] = mapped_block[-1]
+
+        def trigger_stats():
+            # Trigger mode: events stored so far and how many scans they kept
+            if trigger_recorder is None:
+                return {}
+            return {'events': trigger_recorder.events, 'scans_stored': trigger_recorder.scans_stored}
+
+        # Newest scan written, for the console summary
+        latest = {'time': 0.0, 'raw': None, 'mapped': None}
+
+        # CPU time of the polling threads (one per board), and the marks the per-interval rates are taken from
+        def polling_cpu():
+            return sum(device.cpu_seconds() for device in devices)
+
+        marks = {'time': time(), 'written': 0, 'poll_cpu': polling_cpu(), 'process_cpu': process_time()}
+        start_marks = dict(marks)
+
+        def status_summary():
+            now = time()
+            interval = max(now - marks['time'], 1e-9)
+            effective_rate.set((scans_written.value - marks['written']) / interval)
+            poll_cpu.set((polling_cpu() - marks['poll_cpu']) / interval)
+            process_cpu.set((process_time() - marks['process_cpu']) / interval)
+            queue_depth.set(pipeline.depth())
+            marks.update(time=now, written=scans_written.value, poll_cpu=polling_cpu(),
+                         process_cpu=process_time())
+
+            lines = [
+                f"time = {latest['time']:.3f} s, scans written = {scans_written.value}",
+                f"effective rate = {effective_rate.value:.1f} Hz (requested {rate:.1f} Hz)",
+                f"poll interval = {poll_interval.mean() * 1000:.2f} ms mean / {poll_interval.max * 1000:.2f} ms max, "
+                f"scans per drain = {scans_per_drain.mean():.1f}",
+                f"buffer fill = {buffer_fill.mean() * 100:.1f} % mean / {buffer_fill.max * 100:.1f} % max",
+                f"calibration = {calibration_time.mean() * 1000:.3f} ms, write = {write_time.mean() * 1000:.3f} ms per block",
+                f"queue depth = {pipeline.depth()} / {settings['queue_blocks']} blocks (max {pipeline.max_depth}), "
+                f"dropped = {pipeline.scans_dropped} scans, gaps = {gap_log.gap_count} ({gap_log.scans_missing} scans)",
+                f"cpu per s = {poll_cpu.value:.3f} s polling thread / {process_cpu.value:.3f} s process",
+                ]
+            if trigger_recorder is not None:
+                lines.append(f"events = {trigger_recorder.events}, scans stored = {trigger_recorder.scans_stored} "
+                             f"of {scans_written.value}{' (event open)' if trigger_recorder.event else ''}")
+            lines += [
+                '',
+                'channel: raw v | mapped val',
+                ]
+            if latest['raw'] is not None:
+                for i in range(channel_count):
+                    lines.append(f"chan = {channels[i]}: {latest['raw'][i]:.6f} | {latest['mapped'][i]:.6f}")
+
+            if not settings['console']:
+                return None
+            reset_cursor()
+            return '\n'.join('\x1b[2K' + line for line in lines)
+
+        metrics_file = settings['metrics_file']
+        if metrics_file:
+            metrics_file = os.path.join(base_dir, metrics_file)
+        reporter = MetricsReporter(metrics, interval=settings['console_interval'], textfile=metrics_file,
+                                   port=settings['metrics_port'], summary=status_summary)
+
+        # The polling threads only poll their boards and copy new blocks into the queue; calibration,
+        # console output and file writes all happen on the pipeline's worker threads.
+        pipeline = AcquisitionPipeline(prepare_block, commit_block,
+                                       queue_blocks=settings['queue_blocks'],
+                                       worker_threads=settings['worker_threads'])
+        # Live view fed straight from the writer thread
+        live_plotter = None
+        if settings['live_plot']:
+            live_frame_time = metrics.histogram('live_frame_seconds', 'Time to draw and publish one live view frame')
+            live_plotter = LivePlotter(channels, rate, os.path.join(base_dir, settings['live_plot_file']),
+                                       window=settings['live_window'], fps=settings['live_fps'],
+                                       frame_time=live_frame_time)
+
+        pipeline.start()
+        reporter.start()
+        if settings['calibration_reload']:
+            calibration_watcher.start()
+        if live_plotter is not None:
+            live_plotter.start()
+
+        def queue_block(start_scan, poll_time, raw_block):
+            if started is not None and scans_acquired.value == 0:
+                started(starttime, time())
+            scans_per_drain.observe(len(raw_block))
+            scans_acquired.inc(len(raw_block))
+            return pipeline.put(ScanBlock(start_scan, poll_time, raw_block, calibration_watcher.current))
+
+        def record_gap(start_scan, scan_count, reason):
+            gap_log.record(start_scan, scan_count, reason)
+            scans_missing.inc(scan_count)
+
+        # Joins the boards' blocks into whole scans (passes them straight on with one board)
+        merger = StreamMerger([device.columns for device in devices], channel_count, queue_block, record_gap,
+                              shifts=shifts, max_pending=4 * samples_per_channel)
+
+        # Set by the first polling thread to stop (stop_event, a failed board or a failed writer),
+        # which stops the others
+        halt = threading.Event()
+
+        def poll_device(device):
+            '''
+            Polling loop of one board, on its own thread.
+            '''
+            device.cpu_clock = pthread_getcpuclockid(threading.get_ident())
+            # Number of samples (all channels) already copied out of the circular buffer.
+            # Compared against transfer_status.current_total_count so every scan gets written,
+            # not just the newest one at poll time.
+            samples_read = 0
+            wait_samples = device.waiter.wait_scans * device.channel_count
+            buffer_samples = device.channel_count * samples_per_channel
+            last_drain = time()
 
-            # header for mapped CSV
-            mapped_header_list = []
-            mapped_header_list.append("Time")
-            for i in range(channel_count):
-                mapped_header_list.append(str(channels[i]))
+            try:
+                while pipeline.error is None and not stop_event.is_set() and not halt.is_set():
+                    # Get the status of the background operation
+                    with status_time.time():
+                        device.status, transfer_status = device.ai_device.get_scan_status()
+
+                    total_count = transfer_status.current_total_count
+
+                    if total_count - samples_read < wait_samples:
+                        device.waiter.wait(wait_samples - (total_count - samples_read))
+                        continue
+
+                    now = time()
+                    poll_interval.observe(now - last_drain)
+                    last_drain = now
+                    buffer_fill.observe(min(total_count - samples_read, buffer_samples) / buffer_samples)
+
+                    raw_block, start_scan, samples_read = read_new_samples(device.data_view, samples_read, total_count,
+                                                                           device.channel_count)
+                    merger.add(device.index, start_scan, now - starttime, raw_block)
+
+                # Stopping: drain what is already in the buffer (up to wait_scans scans), stop the
+                # board, then drain what it put in since, so every scan up to its final count is written
+                if pipeline.error is None:
+                    for stopped in (False, True):
+                        if stopped:
+                            device.stop()
+                        device.status, transfer_status = device.ai_device.get_scan_status()
+                        total_count = transfer_status.current_total_count
+                        if total_count - samples_read >= device.channel_count:
+                            raw_block, start_scan, samples_read = read_new_samples(device.data_view, samples_read,
+                                                                                   total_count, device.channel_count)
+                            merger.add(device.index, start_scan, time() - starttime, raw_block)
+
+            except ULException as e:
+                print(f'\nERROR: scan stopped on {device.descriptor.dev_string}: {e}')
+                device.error = e
+            except Exception as e:
+                print(f'\nERROR: polling {device.descriptor.dev_string} failed: {e}')
+                device.error = e
+            finally:
+                device.cpu_time = clock_gettime(device.cpu_clock)
+                device.cpu_clock = None
+                halt.set()
+
+        for device in devices:
+            device.thread = threading.Thread(target=poll_device, args=(device,), name=f'daq-poll-{device.index}', daemon=True)
+            device.thread.start()
 
-            mapped_writer.writerow(mapped_header_list)
-            mapped_file.flush()
+        try:
+            end_reason = 'stopped'
+            try:
+                halt.wait()
+            except KeyboardInterrupt:
+                end_reason = 'interrupted'
+            halt.set()
+            for device in devices:
+                device.thread.join()
+            if any(device.error is not None for device in devices):
+                end_reason = 'scan error'
+
+        finally:
+            # Let the workers write out everything already queued before closing the files.
+            finalize_start = time()
+            calibration_watcher.stop()
+            pipeline.stop()
+            reporter.stop()
+            if live_plotter is not None:
+                live_plotter.stop()
+            for writer in writers:
+                writer.close()
+            gap_log.close()
+            calibration_log.close()
+
+            if pipeline.error is not None:
+                print(f'ERROR: writer thread failed: {pipeline.error}')
+                end_reason = 'writer error'
+
+            # Only written once everything before it is on disk: no marker means the tail may be missing
+            try:
+                write_end_marker(filename_end, {
+                    'reason': end_reason,
+                    'scans_written': scans_written.value,
+                    'scans_missing': gap_log.scans_missing,
+                    'gaps': gap_log.gap_count,
+                    'calibrations': calibration_log.changes,
+                    **trigger_stats(),
+                    })
+            except OSError as e:
+                print(f'ERROR: could not write end marker {filename_end}: {e}')
+            print(f'Session finalized ({end_reason}) in {(time() - finalize_start) * 1000:.0f} ms')
+            elapsed = time() - starttime
+            poll_cpu_total = polling_cpu() - start_marks['poll_cpu']
+            process_cpu_total = process_time() - start_marks['process_cpu']
+            print(f'CPU per second of acquisition: {process_cpu_total / elapsed:.3f} s (whole process, {elapsed:.1f} s run)')
+            print(f'Scans queued: {pipeline.scans_queued}, written: {pipeline.scans_committed}, '
+                  f'dropped: {pipeline.scans_dropped} ({pipeline.blocks_dropped} blocks), '
+                  f'max queue depth: {pipeline.max_depth}, gaps: {gap_log.gap_count} '
+                  f'({gap_log.scans_missing} scans)')
+            if trigger_recorder is not None:
+                print(f'Events: {trigger_recorder.events}, scans stored: {trigger_recorder.scans_stored} '
+                      f'of {scans_written.value}')
+
+            session_stats = {
+                'plot_path': filename_plot,
+                'rate': rate,
+                'profile': profile['name'],
+                'buffer_scans': samples_per_channel,
+                'channels': channel_count,
+                'devices': len(devices),
+                'elapsed': elapsed,
+                'scans_acquired': scans_acquired.value,
+                'scans_written': scans_written.value,
+                'scans_missing': gap_log.scans_missing,
+                'max_queue_depth': pipeline.max_depth,
+                'max_buffer_fill': buffer_fill.max,
+                'poll_cpu': poll_cpu_total / elapsed,
+                'process_cpu': process_cpu_total / elapsed,
+                'scan_status_time': status_time.sum / elapsed,
+                'calibration_time': calibration_time.sum / elapsed,
+                'write_time': write_time.sum / elapsed,
+                **trigger_stats(),
+                }
 
-            # header for raw CSV
-            raw_header_list = []
-            raw_header_list.append("Time")
-            for i in range(channel_count):
-                raw_header_list = []
-                raw_header_list.append("Time")
-            for i in range(channel_count):
-                raw_header_list.append(str(channels[i]))
+    except RuntimeError as error:
+        print('\n', error)
 
-            raw_writer.writerow(raw_header_list)
-            raw_file.flush()
+    finally:
+        for device in devices:
+            device.stop()
+        # Devices passed in by the caller stay connected for their next session
+        if owns_devices and daq_devices:
+            release_daq_devices(daq_devices)
 
-            #lp = LivePlotter(filename_mapped, base_dir=base_dir)
-            #lp.start()
+    return session_stats
 
-            data_list_mapped = []
-            data_list_raw = []
-            index_old = 10
 
-            try:
-                while True:
-                    try:
-                        # Get the status of the background operation
-                        status, transfer_status = ai_device.get_scan_status()
+def load_profile(settings):
+    '''
+    Looks up the acquisition profile named by the 'profile' setting.
 
-                        reset_cursor()
+    @return: dict with every key of profile_defaults, plus its 'name'
+    '''
+    profiles = dict(default_profiles)
+    profiles.update(settings.get('profiles') or {})
+    name = settings['profile']
+    if name not in profiles:
+        raise RuntimeError(f"unknown profile '{name}' in test.yaml, expected one of {', '.join(profiles)}")
+    profile = dict(profile_defaults)
+    profile.update(profiles[name] or {})
+    profile['name'] = name
+    return profile
+
+
+def buffer_scans(rate, channel_count, latency_budget, wait_scans):
+    '''
+    Size of a board's circular buffer in scans: latency_budget seconds at the scan rate (how long
+    polling or the writer may stall before unread scans get overwritten), and at least a few
+    drains' worth.
+    '''
+    scans = max(int(math.ceil(rate * latency_budget)), 4 * int(wait_scans), 256)
+    max_scans = MAX_BUFFER_BYTES // (8 * channel_count)
+    if scans > max_scans:
+        print(f'WARNING: latency_budget {latency_budget} s needs a {scans * channel_count * 8 / 2**20:.0f} MB buffer, '
+              f'capped to {max_scans / rate:.2f} s')
+        scans = max_scans
+    return scans
 
-                        #print('actual scan rate = ', '{:.6f}'.format(rate), 'Hz\n')
 
-                        index = transfer_status.current_index
+def check_actual_rate(requested, actual_rates, tolerance):
+    '''
+    Checks the scan rate every board actually runs at (a_in_scan's return value) against the request.
+    '''
+    rate = actual_rates[0]
+    if any(abs(board_rate - rate) > 1e-9 * rate for board_rate in actual_rates):
+        raise RuntimeError(f'Error: the DAQ boards run at different scan rates ({actual_rates}), their scans can\'t be merged')
+    if abs(rate - requested) > tolerance * requested:
+        raise RuntimeError(f'Error: requested {requested} Hz but the board runs at {rate} Hz, '
+                           f'more than rate_tolerance ({tolerance}) off; pick a rate the pacer clock divides into')
 
 
+def run_self_test(devices, rate, scan_options, flags, profile, gain, offset, make_writers, derived=None):
+    '''
+    Startup self-test: scans every board for self_test_seconds and checks that
+      - the actual scan rate is within rate_tolerance of the request,
+      - the boards deliver that rate measured against the host clock,
+      - no buffer overruns, and the buffers stay under half full between drains,
+      - calibrating the data, computing its derived channels and writing it (to throwaway files,
+        with the session's record format and fsync settings) takes under SELF_TEST_MAX_LOAD seconds
+        per second of acquisition.
+    The scans are stopped again afterwards.
 
-                        if(index_old < index):
+    @param make_writers: callable() -> (writers, their file paths), deleted after the test
 
-                            print('currentTotalCount = ',
-                                  transfer_status.current_total_count)
-                            print('currentScanCount = ',
-                                  transfer_status.current_scan_count)
-                            print('currentIndex = ', index, '\n')
+    @param derived: DerivedChannels of the session, None for none
 
-                            '''
-                            data_list_mapped.append(time() - starttime)
-                            data_list_raw.append(time() - starttime)
+    @return: (passed, list of report lines)
+    '''
+    report = []
+    passed = True
+    rates = [device.start_scan(rate, scan_options, flags) for device in devices]
+    try:
+        check_actual_rate(rate, rates, profile['rate_tolerance'])
+        rate = rates[0]
+
+        blocks = [[] for _ in devices]
+        samples_read = [0] * len(devices)
+        overruns = 0
+        max_fill = 0.0
+        drain_period = max(devices[0].waiter.wait_scans / rate, 0.001)
+        end = time() + profile['self_test_seconds']
+        while time() < end:
+            sleep(drain_period)
+            for i, device in enumerate(devices):
+                status, transfer_status = device.ai_device.get_scan_status()
+                total_count = transfer_status.current_total_count
+                buffer_samples = device.channel_count * device.samples_per_channel
+                max_fill = max(max_fill, (total_count - samples_read[i]) / buffer_samples)
+                next_scan = samples_read[i] // device.channel_count
+                raw_block, start_scan, samples_read[i] = read_new_samples(device.data_view, samples_read[i],
+                                                                          total_count, device.channel_count)
+                overruns += start_scan - next_scan
+                blocks[i].append(raw_block)
+        now = time()
+    finally:
+        for device in devices:
+            device.stop()
+
+    for device, read in zip(devices, samples_read):
+        achieved = read // device.channel_count / (now - device.scan_start)
+        ok = abs(achieved - rate) <= SELF_TEST_RATE_TOLERANCE * rate
+        passed &= ok
+        report.append(f'{device.descriptor.dev_string}: {achieved:.0f} scans/s measured at {rate:.1f} Hz'
+                      f"{'' if ok else ' FAILED'}")
+    ok = overruns == 0 and max_fill < 0.5
+    passed &= ok
+    report.append(f'buffer fill {max_fill * 100:.1f} % max, {overruns} scans overrun{"" if ok else " FAILED"}')
+
+    # Same work per block as the session: calibrate, derived channels, then write every output file
+    scans = min(sum(len(block) for block in device_blocks) for device_blocks in blocks)
+    merged = np.empty((scans, sum(device.channel_count for device in devices)))
+    for device, device_blocks in zip(devices, blocks):
+        merged[:, device.columns] = np.concatenate(device_blocks)[:scans]
+    writers, paths = make_writers()
+    try:
+        start = time()
+        step = devices[0].waiter.wait_scans
+        for first in range(0, scans, step):
+            raw_block = merged[first:first + step]
+            mapped_block = apply_calibration(raw_block, gain, offset)
+            if derived is not None and derived.names:
+                mapped_block = np.column_stack((mapped_block, derived.process(first, mapped_block)))
+            scan_times = (first + np.arange(len(raw_block))) / rate
+            for writer in writers:
+                writer.write(first, scan_times, raw_block, mapped_block)
+        for writer in writers:
+            writer.close()
+        load = (time() - start) / max(scans / rate, 1e-9)
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    ok = load < SELF_TEST_MAX_LOAD
+    passed &= ok
+    work = 'calibrate + derived + write' if derived is not None and derived.names else 'calibrate + write'
+    report.append(f'{work}: {load:.3f} s per second of data{"" if ok else " FAILED"}')
+    return passed, report
 
-                            # Display the data.
-                            print('channel: raw voltage | mapped_value')
-                            for i in range(channel_count):
-                                chan = channels[i]
-                                raw_data = data[index + i]
-                                mapped_data = channel_map[chan](raw_data)
-                                formatted_raw_data = '{:.6f}'.format(data[index + i])
-                                formatted_mapped_data = '{:.6f}'.format(mapped_data)
-                                print(f'chan = {chan}: {formatted_raw_data} | {formatted_mapped_data}' )
-                                data_list_mapped.append(mapped_data)
-                                data_list_raw.append(raw_data)
 
-                            # write to CSV
-                            mapped_writer.writerow(data_list_mapped)
-                            raw_writer.writerow(data_list_raw)
+def boards_needed(channel_specs):
+    '''
+    Number of DAQ boards a list of ChannelSpecs is spread over.
+    '''
+    return max(spec.device for spec in channel_specs) + 1 if channel_specs else 1
 
 
-                            data_list_mapped.append(index)
-                            data_list_raw.append(index)
+def open_daq_devices(backend, count=1, interface_type=InterfaceType.ANY):
+    '''
+    Creates the first count DAQ devices the backend finds and connects to them.
 
-                            index_old = index
-                            data_list_mapped.clear()
-                            data_list_raw.clear()
-                            '''
+    Boards are numbered in serial number (unique_id) order, so the 'device' column of the
+    channel table means the same board whichever order the bus lists them in.
 
-                            data_list_mapped = [time() - starttime]
-                            data_list_raw = [time() - starttime]
+    @param backend: module from get_daq_backend
 
-                            print('channel: raw v | mapped val')
-                            for i in range(channel_count):
-                                chan = channels[i]
-                                raw_data = data[index + i]
-                                mapped_data = channel_map[chan](raw_data)
+    @return: list of connected DaqDevices
+    '''
+    # Get descriptors for all the available DAQ devices.
+    descriptors = backend.get_daq_device_inventory(interface_type)
+    number_of_devices = len(descriptors)
+    if number_of_devices == 0:
+        raise RuntimeError('Error: No DAQ devices found')
+    if number_of_devices < count:
+        raise RuntimeError(f'Error: the channel table uses {count} DAQ boards, only {number_of_devices} found')
+    descriptors = sorted(descriptors, key=lambda descriptor: str(descriptor.unique_id))
+
+    daq_devices = []
+    try:
+        for descriptor in descriptors[:count]:
+            # Create the DAQ device from the descriptor.
+            daq_device = backend.DaqDevice(descriptor)
+            daq_devices.append(daq_device)
+
+            # Establish a connection to the DAQ device.
+            print('\nConnecting to', descriptor.dev_string, '- please wait...')
+            # For Ethernet devices using a connection_code other than the default
+            # value of zero, change the line below to enter the desired code.
+            daq_device.connect(connection_code=0)
+    except Exception:
+        release_daq_devices(daq_devices)
+        raise
+    return daq_devices
+
+
+def release_daq_devices(daq_devices):
+    for daq_device in daq_devices:
+        if daq_device.is_connected():
+            daq_device.disconnect()
+        daq_device.release()
+
+
+class DeviceScan:
+    '''
+    One DAQ board's part of a session: its queue of channels, circular buffer and ScanWaiter.
+    Polled by its own thread in a_in_main.
 
-                                formatted_raw_data = '{:.6f}'.format(raw_data)
-                                formatted_mapped_data = '{:.6f}'.format(mapped_data)
-                                print(f'chan = {chan}: {formatted_raw_data} | {formatted_mapped_data}' )
-                                data_list_mapped.append(mapped_data)
-                                data_list_raw.append(raw_data)
+    @param index: board number ('device' in the channel table)
 
-                            # write to CSV
-                            mapped_writer.writerow(data_list_mapped)
-                            raw_writer.writerow(data_list_raw)
+    @param specs: ChannelSpecs of the board's channels, in queue order
 
+    @param columns: positions of the board's channels in a merged scan
+    '''
+    def __init__(self, index, daq_device, specs, columns, samples_per_channel):
+        self.index = index
+        self.daq_device = daq_device
+        self.specs = specs
+        self.columns = columns
+        self.channel_count = len(specs)
+        self.samples_per_channel = samples_per_channel
+        self.ai_device = None
+        self.descriptor = daq_device.get_descriptor()
+        self.waiter = None
+        self.status = ScanStatus.IDLE
+        self.scan_start = None
+        self.thread = None
+        self.error = None
+        self.cpu_clock = None
+        self.cpu_time = 0.0
+
+    def load_queue(self):
+        # Get the AiDevice object and verify that it is valid.
+        self.ai_device = self.daq_device.get_ai_device()
 
-                            #data_list_mapped.append(index)
-                            #data_list_raw.append(index)
+        # Verify the specified device supports hardware pacing for analog input.
+        ai_info = self.ai_device.get_info()
 
-                            index_old = index
-                            data_list_mapped.clear()
-                            data_list_raw.clear()
+        # Input mode and range of each channel from the channel table (SINGLE_ENDED / BIP10VOLTS
+        # unless set; brakes are on BIP2VOLTS, see sense_config.yaml)
+        try:
+            self.input_mode = [AiInputMode[spec.input_mode] for spec in self.specs]
+            channel_ranges = [Range[spec.range] for spec in self.specs]
+        except KeyError as e:
+            raise RuntimeError(f'Error: unknown range / input mode {e} in the channel table of sense_config.yaml')
+
+        # Get a list of supported ranges and validate the range of each channel.
+        self.ranges = ai_info.get_ranges(self.input_mode[0])
+        for spec, channel_range in zip(self.specs, channel_ranges):
+            if channel_range not in self.ranges:
+                raise RuntimeError(f'Error: channel {spec.channel}: {channel_range.name} is not supported by '
+                                   f'{self.descriptor.dev_string}')
+
+        # Assign each channel in the queue its input (SE/DIFF) mode and range.
+        queue_list = []
+        for spec, input_mode, channel_range in zip(self.specs, self.input_mode, channel_ranges):
+            queue_element = AiQueueElement()
+            queue_element.channel = channel_input(spec)
+            queue_element.input_mode = input_mode
+            queue_element.range = channel_range
+            queue_list.append(queue_element)
+
+        # Load the queue.
+        self.ai_device.a_in_load_queue(queue_list)
+
+        # Zero-copy (scans, channels) view over the uldaq buffer
+        self.data = create_float_buffer(self.channel_count, self.samples_per_channel)
+        self.data_view = np.ctypeslib.as_array(self.data).reshape(self.samples_per_channel, self.channel_count)
+
+        print('\n', self.descriptor.dev_string, ' ready', sep='')
+        print('    Function demonstrated: ai_device.a_in_load_queue()')
+        for spec, queue_element in zip(self.specs, queue_list):
+            print('        Channel:', spec.channel, '( input', queue_element.channel, ')',
+                  ', Input mode:', AiInputMode(queue_element.input_mode).name,
+                  ', Range:', Range(queue_element.range).name)
+
+    def check_rate(self, rate):
+        '''
+        Checks the rate against the board's maximum scan rate and aggregate throughput.
+        '''
+        ai_info = self.ai_device.get_info()
+        try:
+            max_rate = ai_info.get_max_scan_rate(self.input_mode[0])
+            max_throughput = ai_info.get_max_throughput(self.input_mode[0])
+        except (AttributeError, ULException):
+            return
+        if rate > max_rate:
+            raise RuntimeError(f'Error: {rate} Hz is over the {max_rate:.0f} Hz max scan rate of {self.descriptor.dev_string}')
+        if rate * self.channel_count > max_throughput:
+            raise RuntimeError(f'Error: {self.channel_count} channels at {rate} Hz is over the {max_throughput:.0f} '
+                               f'samples/s max throughput of {self.descriptor.dev_string}')
+
+    def enable_waiter(self, wait_mode, wait_scans):
+        self.waiter = ScanWaiter(wait_mode, wait_scans, self.channel_count, self.daq_device)
+        self.waiter.enable()
+
+    def start_scan(self, rate, scan_options, flags):
+        '''
+        Starts the continuous scan and returns the actual rate. scan_start is the host time it started.
+        '''
+        # When using the queue, the low_channel, high_channel, input_mode, and
+        # range parameters are ignored since they are specified in queue_array.
+        before = time()
+        rate = self.ai_device.a_in_scan(0, 3, self.input_mode[0], self.ranges[0], self.samples_per_channel,
+                                        rate, scan_options, flags, self.data)
+        self.scan_start = (before + time()) / 2
+        self.status = ScanStatus.RUNNING
+        self.waiter.rate = rate
+        return rate
+
+    def cpu_seconds(self):
+        '''
+        CPU time used by the polling thread so far.
+        '''
+        clock = self.cpu_clock
+        if clock is None:
+            return self.cpu_time
+        try:
+            return clock_gettime(clock)
+        except OSError:
+            # Thread just exited
+            return self.cpu_time
 
-                            '''
-                            data_list_mapped = [time() - starttime]
-                            sata_list_raw = [time() - starttime]
+    def stop(self):
+        # Stop the acquisition if it is still running.
+        if self.status == ScanStatus.RUNNING:
+            self.ai_device.scan_stop()
+            self.status = ScanStatus.IDLE
+        if self.waiter:
+            self.waiter.disable()
 
-                            for i in range(channel_count):
-                                chan = channels[i]
-                                raw_data = data[index + i]
-                                mapped_data = channel_map[chan](raw_data)
-                                data_list_mapped.append(mapped_data)
-                                data_list_raw.append(raw_data)
 
-                            mapped_writer.writerow(data_list_mapped)
-                            raw_writer.writerow(data_list_raw)
+class ScanWaiter:
+    '''
+    Waits in the polling loop until the board has put at least wait_scans new scans in the buffer,
+    instead of calling get_scan_status back-to-back.
 
-                            index_old = index
-                            '''
+    spin:  no wait at all, polls flat out (lowest latency, pins a core)
+    sleep: sleeps for as long as the board needs to produce the missing scans at the scan rate
+    event: blocks on uldaq's ON_DATA_AVAILABLE event (falls back to sleep if the device can't do events)
 
+    @param wait_scans: scans per channel to wait for before a block is drained
+    '''
+    modes = ('spin', 'sleep', 'event')
+
+    def __init__(self, mode, wait_scans, channel_count, daq_device):
+        self.mode = mode
+        self.wait_scans = max(1, int(wait_scans))
+        self.channel_count = channel_count
+        self.daq_device = daq_device
+        self.rate = None
+        self.data_available = threading.Event()
+        self.event_enabled = False
+
+    def enable(self):
+        if self.mode != 'event':
+            return
+        try:
+            self.daq_device.enable_event(DaqEventType.ON_DATA_AVAILABLE, self.wait_scans,
+                                         self.on_data_available, None)
+            self.event_enabled = True
+        except ULException as e:
+            print(f'WARNING: data-available events not supported ({e}), using wait_mode sleep')
+            self.mode = 'sleep'
+
+    def disable(self):
+        if self.event_enabled:
+            self.daq_device.disable_event(DaqEventType.ON_DATA_AVAILABLE)
+            self.event_enabled = False
+
+    def on_data_available(self, event_callback_args):
+        self.data_available.set()
+
+    def wait(self, missing_samples):
+        '''
+        @param missing_samples: samples (all channels) still needed to reach wait_scans
+        '''
+        if self.mode == 'spin':
+            return
 
-                            #sleep(0.01)
+        if self.mode == 'event':
+            # Time out after a couple of block periods in case an event is missed.
+            self.data_available.wait(2 * self.wait_scans / self.rate + 0.1)
+            self.data_available.clear()
+        else:
+            sleep(max(missing_samples / self.channel_count / self.rate, 0.0005))
 
-                        #Check to see if index has rolled back to 0
-                        if (index_old == channel_count * (samples_per_channel - 1)):
-                            index_old = -1
 
+def read_new_samples(data_view, samples_read, total_count, channel_count):
+    '''
+    Copies every whole scan the board has written into the circular buffer since the last read.
 
-                    except (ValueError, NameError, SyntaxError):
-                        break
+    @param data_view: (samples_per_channel, channel_count) numpy view over the uldaq float buffer
 
+    @param samples_read: number of samples (all channels) already copied out
 
-            except KeyboardInterrupt:
-                pass
+    @param total_count: transfer_status.current_total_count from get_scan_status
 
-    except RuntimeError as error:
-        print('\n', error)
+    @param channel_count: number of channels in the queue (samples per scan)
 
-    finally:
-        if daq_device:
-            # Stop the acquisition if it is still running.
-            if status == ScanStatus.RUNNING:
-                ai_device.scan_stop()
-            if daq_device.is_connected():
-                daq_device.disconnect()
-            daq_device.release()
-            #end plotter
-           # plotter.stop()
-            #plotter.save_final(f"/home/pi/Nitzan/{filename}")
-        #try:
-            #lp.stop()
-            #lp.save_final(os.path.join(base_dir,filename))
-        #except:
-            #pass
+    @return: ((scans, channels) array of new scans oldest first, scan index of the first one,
+              updated samples_read). The scan index jumps ahead of samples_read after an overrun.
+    '''
+    buffer_scans = len(data_view)
+    scans_read = samples_read // channel_count
+    total_scans = total_count // channel_count
+
+    # If we fell more than a whole buffer behind the oldest scans have already been
+    # overwritten, so skip ahead to the oldest scan that is still intact.
+    if total_scans - scans_read > buffer_scans:
+        scans_read = total_scans - buffer_scans
+
+    start = scans_read % buffer_scans
+    end = start + total_scans - scans_read
+
+    # One copy out of the buffer either way, so the board can keep overwriting it
+    # while the block waits in the writer queue.
+    if end <= buffer_scans:
+        block = data_view[start:end].copy()
+    else:
+        block = np.concatenate((data_view[start:], data_view[:end - buffer_scans]))
+
+    return block, scans_read, total_scans * channel_count
 
 
 def display_scan_options(bit_mask):
@@ -566,4 +1226,8 @@ def clear_eol():
     stdout.write('\x1b[2K')
 
 if __name__ == '__main__':
-    a_in_main()
\ No newline at end of file
+    # bootup.py stops the logger with SIGTERM (and kills it 2 s later): end the session through
+    # the normal shutdown so queued data is written, files are synced and the device released.
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    a_in_main(stop_event=stop_event)
\ No newline at end of file
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Long-running logger service, so a button press starts a scan straight away instead of paying
+for a new python3 logger.py process (interpreter start, importing uldaq / numpy / yaml,
+sense_config.yaml parsing, device inventory and connect) every session.
+
+The daemon imports everything and connects to the DAQ once at startup, then waits for
+commands on a Unix socket (logger.sock in the base dir by default, see 'daemon_socket' in
+test.yaml), one command per connection, one JSON reply line:
+
+    start [press_time]   start a session; replies once the first block is read, with the
+                         latency from press_time (time.time() of the button press) to the scan
+                         starting and to the first block, in ms
+    stop                 end the session (files closed when it replies); the reply has the
+                         file to plot (plot_path)
+    status               whether a session is running
+    quit                 stop any session and exit
+
+bootup.py starts it at boot. By hand:
+
+    python3 logger_daemon.py
+    echo start | nc -U /home/pi/TESTING_DATA/logger.sock
+'''
+import os
+import sys
+import json
+import signal
+import socket
+import argparse
+import threading
+
+import logger
+from calibration import load_channel_table
+
+# How long start waits for the first block before replying anyway
+START_TIMEOUT = 5.0
+# How long stop waits for the session to close its files
+STOP_TIMEOUT = 10.0
+
+
+class LoggerDaemon:
+    '''
+    Keeps the DAQ boards connected and runs one logger.a_in_main session at a time in a thread.
+    '''
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.daq_devices = []
+        self.session = None
+        self.stop_event = None
+        self.session_stats = None
+        self.lock = threading.Lock()
+
+    def connected(self):
+        return bool(self.daq_devices) and all(daq_device.is_connected() for daq_device in self.daq_devices)
+
+    def connect(self, settings):
+        '''
+        (Re)connects to the DAQ boards the channel table uses, unless they are all connected already.
+        '''
+        count = logger.boards_needed(load_channel_table())
+        if self.connected() and len(self.daq_devices) == count:
+            return
+        for daq_device in self.daq_devices:
+            try:
+                daq_device.release()
+            except Exception:
+                pass
+        self.daq_devices = []
+        self.daq_devices = logger.open_daq_devices(logger.get_daq_backend(settings['backend']), count)
+
+    def running(self):
+        return self.session is not None and self.session.is_alive()
+
+    def start(self, press_time=None):
+        with self.lock:
+            if self.running():
+                return {'ok': False, 'error': 'session already running'}
+
+            # Re-read test.yaml so setting changes apply from the next session on
+            settings = logger.load_logger_config()
+            try:
+                self.connect(settings)
+            except Exception as e:
+                return {'ok': False, 'error': f'could not connect to the DAQ device: {e}'}
+
+            first_block = threading.Event()
+            times = {}
+
+            def started(scan_start, first_block_time):
+                times['scan_start'] = scan_start
+                times['first_block'] = first_block_time
+                first_block.set()
+
+            def run():
+                self.session_stats = logger.a_in_main(settings, base_dir=self.base_dir, stop_event=self.stop_event,
+                                                      daq_devices=self.daq_devices, started=started)
+                # Let start stop waiting if the session failed before its first block
+                first_block.set()
+
+            self.stop_event = threading.Event()
+            self.session_stats = None
+            self.session = threading.Thread(target=run, name='logger-session', daemon=True)
+            self.session.start()
+
+        first_block.wait(START_TIMEOUT)
+        if not times:
+            return {'ok': self.running(), 'error': 'no data from the DAQ yet'}
+        reply = {'ok': True}
+        if press_time is not None:
+            reply['scan_start_ms'] = round((times['scan_start'] - press_time) * 1000, 1)
+            reply['first_block_ms'] = round((times['first_block'] - press_time) * 1000, 1)
+            print(f"Start latency: {reply['scan_start_ms']} ms press to scan start, "
+                  f"{reply['first_block_ms']} ms press to first block")
+        return reply
+
+    def stop(self):
+        with self.lock:
+            if not self.running():
+                return {'ok': True, 'running': False}
+            self.stop_event.set()
+            self.session.join(STOP_TIMEOUT)
+            if self.session.is_alive():
+                return {'ok': False, 'error': f'session did not stop within {STOP_TIMEOUT:.0f} s'}
+            stats = self.session_stats or {}
+            return {'ok': True, 'scans_written': stats.get('scans_written'), 'scans_missing': stats.get('scans_missing'),
+                    'plot_path': stats.get('plot_path')}
+
+    def status(self):
+        return {'ok': True, 'running': self.running(),
+                'connected': self.connected(), 'boards': len(self.daq_devices)}
+
+    def close(self):
+        self.stop()
+        logger.release_daq_devices(self.daq_devices)
+        self.daq_devices = []
+
+    def handle(self, line):
+        '''
+        Runs one command line and returns the reply dict.
+        '''
+        words = line.split()
+        command = words[0] if words else ''
+        if command == 'start':
+            try:
+                press_time = float(words[1]) if len(words) > 1 else None
+            except ValueError:
+                return {'ok': False, 'error': f'bad press time {words[1]}'}
+            return self.start(press_time)
+        if command == 'stop':
+            return self.stop()
+        if command == 'status':
+            return self.status()
+        if command == 'quit':
+            return self.stop()
+        return {'ok': False, 'error': f'unknown command {command!r}, expected start, stop, status or quit'}
+
+
+def serve(daemon, socket_path):
+    '''
+    Accepts commands on the Unix socket until a quit command.
+    '''
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(4)
+    print(f'Logger daemon ready on {socket_path}')
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                line = conn.makefile('r').readline().strip()
+                reply = daemon.handle(line)
+                try:
+                    conn.sendall((json.dumps(reply) + '\n').encode('utf-8'))
+                except OSError:
+                    pass
+            if line.split()[:1] == ['quit']:
+                break
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Persistent DAQ logger controlled over a Unix socket')
+    parser.add_argument('--base-dir', default='/home/pi/TESTING_DATA', help='directory the save_fp directory, control file and socket live in')
+    args = parser.parse_args()
+
+    # bootup.py / systemd stop the daemon with SIGTERM; exit through the finally below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    settings = logger.load_logger_config()
+    daemon = LoggerDaemon(args.base_dir)
+    try:
+        # Connect up front so the first press doesn't pay for it; a failure here is retried on start
+        daemon.connect(settings)
+    except Exception as e:
+        print(f'WARNING: could not connect to the DAQ device yet: {e}')
+
+    try:
+        serve(daemon, os.path.join(args.base_dir, settings['daemon_socket']))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+    sys.exit(0)
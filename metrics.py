@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Counters, gauges and timing histograms for the logger's acquisition loop, exposed in the
+Prometheus text format.
+
+MetricsReporter runs a background thread that every interval:
+- rewrites a .prom text file (atomic replace, can be picked up by node_exporter's textfile collector)
+- prints a short console summary (replaces the old per-scan status prints)
+and can optionally serve the same text on http://127.0.0.1:<port>/metrics.
+'''
+import os
+import threading
+from time import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default histogram buckets in seconds, from 100 us up to 1 s
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    '''
+    Monotonic counter.
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, '', self.value)]
+
+
+class Gauge:
+    '''
+    Value that can go up and down, e.g. queue depth.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [(self.name, '', self.value)]
+
+
+class Histogram:
+    '''
+    Fixed bucket histogram (cumulative buckets when rendered, like Prometheus).
+
+    @param buckets: upper bounds, ascending
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def time(self):
+        '''
+        Context manager that observes the time spent in its block.
+        '''
+        return _Timer(self)
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            samples.append((f'{self.name}_bucket', f'{{le="{bound}"}}', cumulative))
+        samples.append((f'{self.name}_bucket', '{le="+Inf"}', count))
+        samples.append((f'{self.name}_sum', '', total))
+        samples.append((f'{self.name}_count', '', count))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time() - self.start)
+        return False
+
+
+class MetricsRegistry:
+    '''
+    Holds all metrics of one logger session and renders them as Prometheus text.
+    '''
+    def __init__(self, prefix='daq_logger'):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._add(Counter(f'{self.prefix}_{name}', help_text))
+
+    def gauge(self, name, help_text):
+        return self._add(Gauge(f'{self.prefix}_{name}', help_text))
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS):
+        return self._add(Histogram(f'{self.prefix}_{name}', help_text, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsReporter:
+    '''
+    Background thread that publishes the registry every interval seconds.
+
+    @param textfile: path of the .prom file to rewrite, None/'' to disable
+
+    @param port: serve /metrics on 127.0.0.1:port, 0 to disable
+
+    @param summary: callable returning the console summary text, None to disable
+    '''
+    def __init__(self, registry, interval=1.0, textfile=None, port=0, summary=None):
+        self.registry = registry
+        self.interval = interval
+        self.textfile = textfile
+        self.port = port
+        self.summary = summary
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def start(self):
+        if self.port:
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            try:
+                self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+                threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            except OSError as e:
+                print(f'WARNING: could not serve metrics on port {self.port}: {e}')
+                self.server = None
+
+        self.thread = threading.Thread(target=self._run, name='metrics-reporter', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if self.server:
+            self.server.shutdown()
+        self.publish()
+
+    def publish(self):
+        # Summary first, it may refresh gauges (rates, cpu) before they are written out.
+        summary = self.summary() if self.summary else None
+        if self.textfile:
+            try:
+                tmp_path = f'{self.textfile}.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.write(self.registry.render())
+                os.replace(tmp_path, self.textfile)
+            except OSError as e:
+                print(f'WARNING: could not write metrics file {self.textfile}: {e}')
+        if summary:
+            print(summary)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.publish()
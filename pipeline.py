@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Producer/consumer pipeline between the DAQ polling loop and everything downstream of it.
+
+The acquisition thread only copies new blocks of scans out of the DAQ buffer and hands them
+to AcquisitionPipeline.put(), which never blocks: if the bounded queue is full the block is
+dropped and counted, so a slow SD card can never stall get_scan_status polling. Worker threads
+take blocks off the queue, run prepare() (calibration / formatting, may run in parallel) and
+then commit() (file output), which always runs one block at a time in acquisition order.
+
+With several DAQ boards each board is polled on its own thread and StreamMerger joins their
+blocks into one stream of whole scans (all channels of all boards) before they are queued.
+'''
+import threading
+import queue
+import numpy as np
+
+
+class ScanBlock:
+    '''
+    One block of consecutive scans copied out of the DAQ buffer.
+
+    @param start_scan: index of the first scan in the block since the start of the scan
+
+    @param poll_time: host time (s since start) of the poll that found the block
+
+    @param raw: (scans, channels) array of raw voltages, owned by the block (not a view)
+
+    @param calibration: (gain, offset, version) in effect when the block was read, so a
+                        calibration reload applies from an exact scan on
+    '''
+    def __init__(self, start_scan, poll_time, raw, calibration=None):
+        self.start_scan = start_scan
+        self.poll_time = poll_time
+        self.raw = raw
+        self.calibration = calibration
+
+    def __len__(self):
+        return len(self.raw)
+
+
+class AcquisitionPipeline:
+    '''
+    Bounded queue of ScanBlocks plus the worker threads that drain it.
+
+    @param prepare: prepare(block) -> result, called on a worker thread, may run concurrently
+
+    @param commit: commit(block, result), called in acquisition order, one block at a time
+
+    @param queue_blocks: maximum number of blocks waiting in the queue before new ones are dropped
+
+    @param worker_threads: number of worker threads running prepare()
+    '''
+    def __init__(self, prepare, commit, queue_blocks=256, worker_threads=1):
+        self.prepare = prepare
+        self.commit = commit
+        self.queue = queue.Queue(maxsize=queue_blocks)
+        self.worker_count = max(1, int(worker_threads))
+        self.workers = []
+
+        # Blocks are numbered as they are queued; commit() runs strictly in that order.
+        self._next_seq = 0
+        self._next_commit = 0
+        self._turn = threading.Condition()
+
+        # Counters, read by the logger for its status output
+        self.blocks_queued = 0
+        self.scans_queued = 0
+        self.blocks_dropped = 0
+        self.scans_dropped = 0
+        self.scans_committed = 0
+        self.max_depth = 0
+        self.error = None
+
+    def start(self):
+        for i in range(self.worker_count):
+            worker = threading.Thread(target=self._worker, name=f'pipeline-worker-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, block):
+        '''
+        Queues a block without blocking. Returns False (and counts the drop) if the queue is full.
+        '''
+        try:
+            self.queue.put_nowait((self._next_seq, block))
+        except queue.Full:
+            self.blocks_dropped += 1
+            self.scans_dropped += len(block)
+            return False
+
+        self._next_seq += 1
+        self.blocks_queued += 1
+        self.scans_queued += len(block)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def depth(self):
+        '''
+        Number of blocks currently waiting in the queue.
+        '''
+        return self.queue.qsize()
+
+    def stop(self):
+        '''
+        Lets the workers finish everything already queued, then joins them.
+        '''
+        for _ in self.workers:
+            self.queue.put((None, None))
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def _worker(self):
+        while True:
+            seq, block = self.queue.get()
+            if block is None:
+                return
+
+            result = None
+            if self.error is None:
+                try:
+                    result = self.prepare(block)
+                except Exception as e:
+                    self.error = e
+
+            with self._turn:
+                while self._next_commit != seq:
+                    self._turn.wait()
+                try:
+                    if self.error is None:
+                        self.commit(block, result)
+                        self.scans_committed += len(block)
+                except Exception as e:
+                    self.error = e
+                finally:
+                    self._next_commit += 1
+                    self._turn.notify_all()
+
+
+class StreamMerger:
+    '''
+    Joins the scans of several DAQ boards, each polled on its own thread, into one stream of
+    scans with every board's channels, aligned on sample counts: scan k of the session is scan
+    k + shifts[d] of board d. The boards run at the same rate, so shifts (scans to drop from the
+    boards that started first) line their scan starts up.
+
+    A scan is only passed on once every board has delivered it; scans missing on any board
+    (buffer overrun, or a board more than max_pending scans behind the others) become gaps.
+    The session ends at the last scan all boards delivered.
+
+    @param columns: per board, the positions of its channels in the merged scan
+
+    @param put: put(start_scan, poll_time, raw) -> False if the block was dropped, called with
+                merged blocks in scan order
+
+    @param gap: gap(start_scan, scan_count, reason), called for scans that can't be merged
+
+    @param shifts: per board, scans recorded before the common start, default none
+
+    @param max_pending: most scans one board may get ahead of the slowest one
+    '''
+    def __init__(self, columns, channel_count, put, gap, shifts=None, max_pending=10000):
+        self.columns = [np.asarray(cols) for cols in columns]
+        self.channel_count = channel_count
+        self.put = put
+        self.gap = gap
+        self.shifts = list(shifts) if shifts is not None else [0] * len(columns)
+        self.max_pending = max_pending
+        self.pending = [[] for _ in columns]
+        self.ends = [0] * len(columns)
+        self.next_scan = 0
+        self.poll_time = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, device, start_scan, poll_time, raw):
+        '''
+        Hands over a block of consecutive scans read from one board.
+        '''
+        with self.lock:
+            start_scan -= self.shifts[device]
+            # Scans before the common start, or already merged without this board
+            skip = max(self.next_scan - start_scan, 0)
+            if skip >= len(raw):
+                return
+            start_scan += skip
+            raw = raw[skip:]
+            self.poll_time = max(self.poll_time, poll_time)
+
+            if len(self.columns) == 1:
+                # One board: nothing to merge, pass the block straight on
+                if start_scan != self.next_scan:
+                    self.gap(self.next_scan, start_scan - self.next_scan, 'buffer overrun')
+                if not self.put(start_scan, poll_time, raw):
+                    self.gap(start_scan, len(raw), 'writer queue full')
+                self.next_scan = start_scan + len(raw)
+                return
+
+            self.pending[device].append((start_scan, raw))
+            self.ends[device] = start_scan + len(raw)
+            self._merge()
+
+    def _merge(self):
+        end = max(min(self.ends), max(self.ends) - self.max_pending)
+        count = end - self.next_scan
+        if count <= 0:
+            return
+
+        merged = np.empty((count, self.channel_count))
+        # Per board, which of the scans it delivered
+        covered = np.zeros((len(self.columns), count), dtype=bool)
+        for device, cols in enumerate(self.columns):
+            keep = []
+            for start, raw in self.pending[device]:
+                lo = max(start, self.next_scan)
+                hi = min(start + len(raw), end)
+                if hi > lo:
+                    merged[lo - self.next_scan:hi - self.next_scan, cols] = raw[lo - start:hi - start]
+                    covered[device, lo - self.next_scan:hi - self.next_scan] = True
+                if start + len(raw) > end:
+                    keep.append((max(start, end), raw[max(end - start, 0):]))
+            self.pending[device] = keep
+
+        # Runs of whole scans go on as blocks, runs with a board missing become gaps
+        complete = covered.all(axis=0)
+        edges = np.flatnonzero(np.diff(complete.view(np.int8))) + 1
+        for lo, hi in zip(np.concatenate(([0], edges)), np.concatenate((edges, [count]))):
+            run_start = self.next_scan + int(lo)
+            if complete[lo]:
+                if not self.put(run_start, self.poll_time, merged[lo:hi]):
+                    self.gap(run_start, int(hi - lo), 'writer queue full')
+            else:
+                missing = [str(device) for device in range(len(self.columns)) if not covered[device, lo]]
+                behind = any(self.ends[int(device)] < end for device in missing)
+                reason = 'board behind' if behind else 'buffer overrun'
+                self.gap(run_start, int(hi - lo), f"{reason} (device {', '.join(missing)})")
+        self.next_scan = end
@@ -1,9 +1,25 @@
 import sys
 import os
+import gc
+import threading
+import re
+import glob
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from time import time
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib
+import matplotlib.image
 import yaml
+from calibration import compile_calibration, load_channel_table
+from recording import (open_recording, load_gaps, record_scan_index, load_calibration_changes, calibrate_records,
+                       load_segments, select_segments, follow_segments, load_summary, load_events, session_base,
+                       SEGMENT_INDEX_SUFFIX)
 matplotlib.use("Agg") # Use Agg since we only want to save the final file
 
 def load_date_test_dir(filename='test.yaml'):
@@ -43,50 +59,212 @@ def get_latest_csv_path():
         sys.exit(1)
 
 
-def save_final_plots(csv_path):
-    """Generates and saves final shock and brake plots from the specified CSV."""
+def iter_session_chunks(path, channels, chunk_rows=200000, time_range=None):
+    """Yields (times, {channel: values}) chunks of a session's mapped data, reading only the Time column
+    and the requested channels, so memory use is bounded by chunk_rows however long the recording is.
 
-    print(f"Processing CSV: {csv_path}")
+    Channel values are float32; Time stays float64 since float32 only resolves ~0.25 ms an hour into
+    a session. Accepts a _MAPPPED.csv, a binary _RAW.bin recording or the _SEGMENTS.csv index of a
+    segmented session, whose segments are read one after another (the mapped CSVs if there are any).
 
-    # Read the completed CSV
-    try:
-        df = pd.read_csv(csv_path)
-    except FileNotFoundError:
-        print(f"Error: CSV data file not found at {csv_path}")
+    time_range: (start, end) seconds, either may be None; only the data in it is yielded, and of a
+    segmented session only the segments overlapping it are read at all."""
+    if time_range is None:
+        yield from iter_file_chunks(path, channels, chunk_rows)
         return
 
-    # Derive the base filename for the output plots
-    # This removes the '.csv' and '_MAPPPED' from the full path/filename
-    base_path = os.path.splitext(csv_path)[0].replace('_MAPPPED', '')
-
-    # Define channels
-    shock_channels = [5, 6, 13, 14]
-    brake_channels = [4, 12]
-    all_channels = [5,6,13,14,4,12]
-
-    channel_names = {
-            5: 'FR Shockpot',
-            13: 'RR Shockpot',
-            6: 'RL Shockpot',
-            14: 'FL Shockpot',
-            12: 'Rear Brake',
-            4: 'Front Brake'
+    start_time, end_time = time_range
+    for times, values in iter_file_chunks(path, channels, chunk_rows, time_range):
+        keep = np.ones(len(times), dtype=bool)
+        if start_time is not None:
+            keep &= times >= start_time
+        if end_time is not None:
+            keep &= times <= end_time
+        if keep.any():
+            yield times[keep], {ch: y[keep] for ch, y in values.items()}
 
-            }
-    channel_name_units = {
-            5: 'Front Right Shock Pot (Inches)',
-            13: 'Rear Right Shock Pot (Inches)',
-            6: 'Rear Left Shock Pot (Inches)',
-            14: 'Front Left Shock Pot (Inches)',
-            12: 'Rear Brake Pressure Sensor (PSI)',
-            4: 'Front Brake Pressure Sensor (PSI)'
 
-            }
+def iter_file_chunks(path, channels, chunk_rows=200000, time_range=None):
+    """iter_session_chunks without the time_range clipping; time_range only picks segments."""
+    if path.endswith(SEGMENT_INDEX_SUFFIX):
+        segments = load_segments(path)
+        kind = 'mapped' if any(segment['kind'] == 'mapped' for segment in segments) else 'binary'
+        for segment in select_segments(segments, kind, *(time_range or (None, None))):
+            yield from iter_file_chunks(segment['file'], channels, chunk_rows)
+        return
+
+    if path.endswith('.bin'):
+        header, data = open_recording(path)
+        cols = [header['channels'].index(ch) for ch in channels if ch in header['channels']]
+        gain, offset = compile_calibration(header['channels'], header['calibration'])
+        gain = gain[cols].astype(np.float32)
+        offset = offset[cols].astype(np.float32)
+        # Calibrations reloaded mid-session apply from the scan they were loaded at
+        changes = [(start_scan, g[cols].astype(np.float32), o[cols].astype(np.float32))
+                   for start_scan, g, o in load_calibration_changes(path)]
+        scan_index = record_scan_index(load_gaps(path), len(data), header.get('first_scan', 0))
+        for start in range(0, len(data), chunk_rows):
+            block_index = scan_index[start:start + chunk_rows]
+            block = calibrate_records(np.asarray(data[start:start + chunk_rows])[:, cols], block_index, changes, gain, offset)
+            times = block_index / header['rate']
+            yield times, {header['channels'][c]: block[:, i] for i, c in enumerate(cols)}
+        return
+
+    columns = pd.read_csv(path, nrows=0).columns
+    present = [str(ch) for ch in channels if str(ch) in columns]
+    dtypes = {'Time': np.float64}
+    dtypes.update({col: np.float32 for col in present})
+    for chunk in pd.read_csv(path, usecols=['Time'] + present, dtype=dtypes, engine='c', chunksize=chunk_rows):
+        yield chunk['Time'].to_numpy(), {int(col): chunk[col].to_numpy() for col in present}
+
+
+class EnvelopeReducer:
+    """Incremental min/max envelope of one series, fed chunk by chunk.
+
+    Keeps the min and max (and when they happened) of fixed-width time bins. The recording length
+    isn't known up front, so bins start at 1 ms and whenever they would run past capacity adjacent
+    pairs are merged and the width doubles. Memory is fixed at capacity bins, and the result has at
+    most 2 points per bin, so peaks like brake spikes and bump-stop hits are always kept."""
+    def __init__(self, n_bins, bin_width=0.001):
+        self.capacity = 2 * max(1, int(n_bins))
+        self.width = bin_width
+        self.t0 = None
+        self.mins = np.full(self.capacity, np.inf)
+        self.maxs = np.full(self.capacity, -np.inf)
+        self.t_min = np.zeros(self.capacity)
+        self.t_max = np.zeros(self.capacity)
+
+    def add(self, t, y):
+        if len(t) == 0:
+            return
+        if self.t0 is None:
+            self.t0 = t[0]
+
+        bins = np.maximum((t - self.t0) // self.width, 0).astype(np.int64)
+        while bins.max() >= self.capacity:
+            self._coarsen()
+            bins //= 2
+
+        # NaNs can never win a min or max
+        y_lo = np.where(np.isnan(y), np.inf, y)
+        y_hi = np.where(np.isnan(y), -np.inf, y)
+
+        # Runs of samples in the same bin, and the min / max of each run (and where it is)
+        starts = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+        counts = np.diff(np.append(starts, len(bins)))
+        ids = bins[starts]
+        run_min = np.minimum.reduceat(y_lo, starts)
+        run_max = np.maximum.reduceat(y_hi, starts)
+        hits = np.flatnonzero(y_lo == np.repeat(run_min, counts))
+        i_min = hits[np.searchsorted(hits, starts)]
+        hits = np.flatnonzero(y_hi == np.repeat(run_max, counts))
+        i_max = hits[np.searchsorted(hits, starts)]
+
+        # .at so a bin that shows up in more than one run (time going backwards) still gets the extreme
+        np.minimum.at(self.mins, ids, run_min)
+        np.maximum.at(self.maxs, ids, run_max)
+        won = run_min == self.mins[ids]
+        self.t_min[ids[won]] = t[i_min[won]]
+        won = run_max == self.maxs[ids]
+        self.t_max[ids[won]] = t[i_max[won]]
+
+    def _coarsen(self):
+        half = self.capacity // 2
+        rows = np.arange(half)
+        for values, times, pick in ((self.mins, self.t_min, np.argmin), (self.maxs, self.t_max, np.argmax)):
+            pairs = values.reshape(half, 2)
+            chosen = pick(pairs, axis=1)
+            merged_values = pairs[rows, chosen]
+            merged_times = times.reshape(half, 2)[rows, chosen]
+            values[:half] = merged_values
+            times[:half] = merged_times
+        self.mins[half:] = np.inf
+        self.maxs[half:] = -np.inf
+        self.width *= 2
+
+    def result(self):
+        """Returns (t, y) with the min and max of every non-empty bin, in time order."""
+        used = np.isfinite(self.mins)
+        t = np.column_stack((self.t_min[used], self.t_max[used]))
+        y = np.column_stack((self.mins[used], self.maxs[used]))
+        swap = t[:, 0] > t[:, 1]
+        t[swap] = t[swap][:, ::-1]
+        y[swap] = y[swap][:, ::-1]
+        return t.ravel(), y.ravel()
+
+
+def load_series(path, channels, n_bins=None, chunk_rows=200000, time_range=None):
+    """Loads the given channels of a session as {channel: (t, y)}, streaming through the file.
+
+    n_bins: reduce each channel to a min/max envelope of about n_bins bins (bounded memory);
+    None loads every sample. The envelope comes from the session's summary pyramid when it has a
+    level fine enough, and only from the full-rate data otherwise (short sessions, narrow windows).
+    time_range: (start, end) seconds to load, see iter_session_chunks."""
+    if n_bins:
+        series = load_summary_series(path, channels, n_bins, time_range)
+        if series is not None:
+            return series
+
+        reducers = {}
+        for times, values in iter_session_chunks(path, channels, chunk_rows, time_range):
+            for ch, y in values.items():
+                reducers.setdefault(ch, EnvelopeReducer(n_bins)).add(times, y)
+        return {ch: reducer.result() for ch, reducer in reducers.items()}
+
+    pieces = {}
+    for times, values in iter_session_chunks(path, channels, chunk_rows, time_range):
+        for ch, y in values.items():
+            pieces.setdefault(ch, []).append((times, y))
+    return {ch: (np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]))
+            for ch, parts in pieces.items()}
+
+
+def load_summary_series(path, channels, n_bins, time_range=None):
+    """Min/max envelope of the given channels from the coarsest level of the session's _SUMMARY.bin
+    with at least two buckets per envelope bin, so nothing is lost against the full-rate data.
+
+    Returns None (read the full-rate data) if there is no complete summary, no level is fine enough,
+    or path is one segment of a segmented session (the summary covers the whole session)."""
+    if SEGMENT_FILE.search(path):
+        return None
+    summary = load_summary(path, time_range=time_range, min_buckets=2 * n_bins)
+    if summary is None or not summary['complete'] or len(summary['time']) < 2 * n_bins:
+        return None
+
+    print(f"Using the {summary['bucket_scans'] / summary['rate']:g} s summary level ({len(summary['time'])} buckets)")
+    times = np.repeat(summary['time'] + summary['bucket_scans'] / summary['rate'] / 2, 2)
+    series = {}
+    for ch in channels:
+        if ch in summary['channels']:
+            i = summary['channels'].index(ch)
+            reducer = EnvelopeReducer(n_bins)
+            reducer.add(times, np.column_stack((summary['min'][:, i], summary['max'][:, i])).ravel())
+            series[ch] = reducer.result()
+    return series
+
+
+def plot_series(ax, series, ch, label):
+    """Plots one channel's (t, y) from load_series."""
+    t, y = series[ch]
+    ax.plot(t, y, label=label)
+
+
+# Define channels (from the channel table in sense_config.yaml)
+channel_table = load_channel_table()
+shock_channels = [spec.channel for spec in channel_table if spec.sensor in ('short_shock', 'long_shock')]
+brake_channels = [spec.channel for spec in channel_table if spec.sensor in ('front_brake', 'rear_brake')]
+all_channels = shock_channels + brake_channels
+
+channel_names = {spec.channel: spec.name for spec in channel_table}
+channel_name_units = {spec.channel: spec.label for spec in channel_table}
+
+
+def plot_shocks(series, base_path):
     # SHOCKS PLOT
     plt.figure()
     for ch in shock_channels:
-        if str(ch) in df.columns:
-            plt.plot(df['Time'], df[str(ch)], label=f'{channel_names[ch]}')
+        if ch in series:
+            plot_series(plt.gca(), series, ch, f'{channel_names[ch]}')
     plt.xlabel('Time (s)')
     plt.ylabel('Shock Pot Length (inches)')
     plt.title('Final Shock Pot Data')
@@ -96,11 +274,13 @@ def save_final_plots(csv_path):
     plt.savefig(f'{base_path}_SHOCKS_FINAL.png')
     plt.close()
 
+
+def plot_brakes(series, base_path):
     # BRAKES PLOT
     plt.figure()
     for ch in brake_channels:
-        if str(ch) in df.columns:
-            plt.plot(df['Time'], df[str(ch)], label=f'{channel_names[ch]}')
+        if ch in series:
+            plot_series(plt.gca(), series, ch, f'{channel_names[ch]}')
     plt.xlabel('Time (s)')
     plt.ylabel('Brake Pressure (PSI)')
     plt.title('Final Brake Pressure Data')
@@ -110,30 +290,31 @@ def save_final_plots(csv_path):
     plt.savefig(f'{base_path}_BRAKES_FINAL.png')
     plt.close()
 
-    '''
+
+'''
+def plot_full(series, base_path):
     # FULL PLOT
     plt.figure()
     for ch in all_channels:
-        if str(ch) in df.columns:
-            plt.plot(df['Time'], df[str(ch)], label=f'{channel_name_units[ch]}')
+        if ch in series:
+            plt.plot(*series[ch], label=f'{channel_name_units[ch]}')
     plt.xlabel('Time (s)')
     plt.ylabel('Brake Pressure (PSI) and Shock Pot Length (inches)')
     plt.legend()
     plt.savefig(f'{base_path}_FULL_PLOT_FINAL.png')
     plt.close()
+'''
 
 
-    print("Plotting complete.")
-    '''
-
+def plot_stacked(series, base_path):
     # STACKED FULL PLOT
     fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True)
     fig.suptitle('Stacked Data Plot (Brakes and Shocks)')
 
     # Plot brakes
     for ch in brake_channels:
-        if str(ch) in df.columns:
-            ax1.plot(df['Time'], df[str(ch)], label=f'{channel_names[ch]}')
+        if ch in series:
+            plot_series(ax1, series, ch, f'{channel_names[ch]}')
 
     ax1.set_xlabel('Time (s)')
     ax1.set_ylabel('Brake Pressure (PSI)')
@@ -142,8 +323,8 @@ def save_final_plots(csv_path):
 
     # Plot shock pots
     for ch in shock_channels:
-        if str(ch) in df.columns:
-            ax2.plot(df['Time'], df[str(ch)], label=f'{channel_names[ch]}')
+        if ch in series:
+            plot_series(ax2, series, ch, f'{channel_names[ch]}')
 
 
     ax2.set_xlabel('Time (s)')
@@ -155,6 +336,445 @@ def save_final_plots(csv_path):
     plt.savefig(f'{base_path}_STACKED_PLOT.png')
     plt.close(fig)
 
+
+# Figures save_final_plots renders, each one can go to its own worker process
+FIGURES = {
+        'shocks': plot_shocks,
+        'brakes': plot_brakes,
+        'stacked': plot_stacked
+        }
+
+
+def share_series(series):
+    """Copies {channel: (t, y)} into one shared memory block so figure workers map the dataset
+    instead of each being sent a pickled copy.
+
+    Returns (SharedMemory, layout), layout being {channel: (t offset, y offset, length, y dtype)}
+    with byte offsets, for attach_series."""
+    layout = {}
+    size = 0
+    for ch, (t, y) in series.items():
+        n = len(t)
+        y_offset = size + n * 8
+        layout[ch] = (size, y_offset, n, y.dtype.str)
+        size = y_offset + -(-n * y.dtype.itemsize // 8) * 8
+
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for ch, (t, y) in series.items():
+        t_offset, y_offset, n, y_dtype = layout[ch]
+        np.ndarray(n, dtype=np.float64, buffer=shm.buf, offset=t_offset)[:] = t
+        np.ndarray(n, dtype=y_dtype, buffer=shm.buf, offset=y_offset)[:] = y
+    return shm, layout
+
+
+def attach_series(shm, layout):
+    """Zero-copy {channel: (t, y)} views of a block made by share_series."""
+    return {ch: (np.ndarray(n, dtype=np.float64, buffer=shm.buf, offset=t_offset),
+                 np.ndarray(n, dtype=y_dtype, buffer=shm.buf, offset=y_offset))
+            for ch, (t_offset, y_offset, n, y_dtype) in layout.items()}
+
+
+def render_figure(figure, shm_name, layout, base_path):
+    """Worker process entry: renders one of FIGURES from the shared dataset."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        series = attach_series(shm, layout)
+        FIGURES[figure](series, base_path)
+    finally:
+        # Matplotlib can hold on to the views until its figures are collected,
+        # and the block can't be closed while they exist.
+        series = None
+        gc.collect()
+        shm.close()
+    return figure
+
+
+def save_final_plots(csv_path, decimate=True, workers=None, time_range=None):
+    """Generates and saves final shock and brake plots from the specified CSV.
+
+    Returns True once the plots are saved, False if a figure could not be made.
+
+    Only Time and the plotted channels are read, a chunk at a time.
+    decimate: reduce each channel to a per-pixel min/max envelope while streaming, so memory and
+    render time stay about the same however long the session is (peaks are kept). False loads
+    every sample of the plotted channels.
+    workers: processes rendering the figures in parallel from one shared copy of the dataset
+    (default one per core, up to one per figure); 1 renders them one after another here.
+    time_range: (start, end) seconds to plot, either may be None; the plot names get a _<start>-<end>s
+    suffix. With a _SEGMENTS.csv index only the segments overlapping it are read."""
+
+    print(f"Processing CSV: {csv_path}")
+    start = time()
+
+    # Derive the base filename for the output plots
+    # This removes the '.csv'/'.bin' and '_MAPPPED'/'_RAW'/'_SEGMENTS' from the full path/filename
+    base_path = os.path.splitext(csv_path)[0].replace('_MAPPPED', '').replace('_RAW', '').replace('_SEGMENTS', '')
+    if time_range is not None:
+        start_time, end_time = time_range
+        base_path += f"_{start_time or 0:g}-{'end' if end_time is None else format(end_time, 'g')}s"
+
+    # Stream in only the plotted channels; with decimate about one envelope bin per pixel of figure width
+    n_bins = int(plt.rcParams['figure.figsize'][0] * plt.rcParams['figure.dpi']) if decimate else None
+    try:
+        series = load_series(csv_path, all_channels, n_bins, time_range=time_range)
+    except FileNotFoundError:
+        print(f"Error: CSV data file not found at {csv_path}")
+        return False
+
+    workers = min(len(FIGURES), workers or os.cpu_count() or 1)
+    if workers <= 1:
+        for plot_figure in FIGURES.values():
+            plot_figure(series, base_path)
+        print(f"Plotting complete in {time() - start:.2f} s")
+        return True
+
+    shm, layout = share_series(series)
+    del series
+    ok = True
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(render_figure, figure, shm.name, layout, base_path): figure for figure in FIGURES}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error: could not render {futures[future]} plot: {e}")
+                    ok = False
+    finally:
+        shm.close()
+        shm.unlink()
+    print(f"Plotting complete in {time() - start:.2f} s")
+    return ok
+
+
+MANIFEST_NAME = '.plot_manifest.json'
+
+
+# Files of one segment of a segmented session, plotted through the session's _SEGMENTS.csv instead
+SEGMENT_FILE = re.compile(r'_S\d{4}_(MAPPPED|RAW)\.')
+
+
+def find_sessions(save_dir):
+    """Lists the sessions in a save_fp directory to plot: every _MAPPPED.csv (recalibrated ones
+    included), binary _RAW.bin recordings that have no mapped CSV, and the _SEGMENTS.csv index of
+    every segmented session."""
+    sessions = [path for path in sorted(glob.glob(os.path.join(save_dir, '*_MAPPPED.csv')))
+                if not SEGMENT_FILE.search(path)]
+    for path in sorted(glob.glob(os.path.join(save_dir, '*_RAW.bin'))):
+        if f'{path[:-len("_RAW.bin")]}_MAPPPED.csv' not in sessions and not SEGMENT_FILE.search(path):
+            sessions.append(path)
+    sessions.extend(sorted(glob.glob(os.path.join(save_dir, f'*{SEGMENT_INDEX_SUFFIX}'))))
+    return sessions
+
+
+def plot_settings(decimate):
+    """Everything besides the data that changes the output, so a manifest entry goes stale with it."""
+    return {
+            'decimate': decimate,
+            'figsize': list(plt.rcParams['figure.figsize']),
+            'dpi': plt.rcParams['figure.dpi'],
+            'figures': list(FIGURES),
+            'channels': all_channels
+            }
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def session_key(path, settings, use_hash=False):
+    """Manifest entry for a session as it is now: size, mtime (or content hash) and the plot settings."""
+    stat = os.stat(path)
+    key = {'size': stat.st_size, 'settings': settings}
+    if use_hash:
+        key['sha1'] = file_hash(path)
+    else:
+        key['mtime_ns'] = stat.st_mtime_ns
+    return key
+
+
+def load_manifest(save_dir):
+    try:
+        with open(os.path.join(save_dir, MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_manifest(save_dir, manifest):
+    # Replace atomically, an interrupted batch keeps what it finished
+    path = os.path.join(save_dir, MANIFEST_NAME)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+
+def plot_session(path, decimate):
+    """Batch worker: plots one session with its figures rendered in this process."""
+    return save_final_plots(path, decimate, workers=1)
+
+
+def plot_segments_as_they_close(path, decimate=True, workers=None):
+    """Plots each segment of a segmented session as soon as it is closed and indexed, while the
+    session is still being logged; returns once the session has ended. Segments are plotted from
+    their mapped CSV, or from the binary recording when the session has no CSV output."""
+    mapped = set()
+    ok = True
+    for segment in follow_segments(path):
+        if segment['kind'] == 'mapped':
+            mapped.add(segment['segment'])
+        elif segment['kind'] == 'raw' or segment['segment'] in mapped:
+            continue
+        ok = save_final_plots(segment['file'], decimate, workers) and ok
+    return ok
+
+
+def plot_events(path, decimate=True, workers=None):
+    """Plots every event of a triggered session on its own (plots named by the event's time window),
+    reading only the segments each event was stored in."""
+    events = load_events(path)
+    if not events:
+        print(f"No events found for {path}")
+        return False
+    ok = True
+    for event in events:
+        print(f"Event {event['event']}: {event['trigger']} at {event['trigger_time']:.3f} s")
+        ok = save_final_plots(f'{session_base(path)}{SEGMENT_INDEX_SUFFIX}', decimate, workers,
+                              (event['start_time'], event['end_time'])) and ok
+    return ok
+
+
+def plot_directory(save_dir, workers=None, decimate=True, force=False, use_hash=False):
+    """Plots every session in save_dir, sessions spread across a process pool.
+
+    A manifest (.plot_manifest.json in save_dir) remembers the size and mtime (or sha1 with
+    use_hash) of each plotted file along with the plot settings; sessions whose entry still
+    matches are skipped unless force is set.
+
+    Returns (sessions plotted, sessions skipped, sessions failed)."""
+    sessions = find_sessions(save_dir)
+    if not sessions:
+        print(f"No _MAPPPED.csv / _RAW.bin / _SEGMENTS.csv sessions found in {save_dir}")
+        return 0, 0, 0
+
+    settings = plot_settings(decimate)
+    manifest = load_manifest(save_dir)
+    todo = {}
+    for path in sessions:
+        name = os.path.basename(path)
+        key = session_key(path, settings, use_hash)
+        if force or manifest.get(name) != key:
+            todo[path] = key
+
+    skipped = len(sessions) - len(todo)
+    print(f"{len(sessions)} session(s) in {save_dir}: {len(todo)} to plot, {skipped} unchanged")
+
+    plotted = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(plot_session, path, decimate): path for path in todo}
+        for future in as_completed(futures):
+            path = futures[future]
+            name = os.path.basename(path)
+            try:
+                ok = future.result()
+            except Exception as e:
+                print(f"Error: could not plot {name}: {e}")
+                ok = False
+            if ok:
+                plotted += 1
+                manifest[name] = todo[path]
+                save_manifest(save_dir, manifest)
+                print(f"Plotted {name}")
+            else:
+                failed += 1
+                manifest.pop(name, None)
+    save_manifest(save_dir, manifest)
+    return plotted, skipped, failed
+
+
+class LivePlotter:
+    """Rolling live view of a running logger session, published as a PNG.
+
+    The logger hands every calibrated block to push() (from its writer thread). push() only copies
+    the block into a fixed size ring buffer holding the last `window` seconds of each channel, so
+    memory never grows and acquisition never waits on drawing. A separate thread redraws at most
+    `fps` times a second, only when new data came in: the axes, labels and legend are drawn once
+    and blitted back each frame, only the lines (a per-pixel min/max envelope of the window) are
+    redrawn, and the frame is written to output_path (atomic replace, so viewers never see a
+    half-written file)."""
+    def __init__(self, channels, rate, output_path, window=10.0, fps=2.0, frame_time=None):
+        self.channels = list(channels)
+        self.rate = rate
+        self.output_path = output_path
+        self.window = window
+        self.frame_interval = 1.0 / max(fps, 0.01)
+        self.frame_time = frame_time
+        self.frames = 0
+
+        # Ring buffer of the last window_scans scans, with each slot's scan index (-1 = empty)
+        self.window_scans = max(2, int(window * rate))
+        self.ring = np.full((self.window_scans, len(self.channels)), np.nan, dtype=np.float32)
+        self.ring_scans = np.full(self.window_scans, -1, dtype=np.int64)
+        self.scans_pushed = 0
+        self.lock = threading.Lock()
+        self.new_data = False
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def push(self, start_scan, mapped_block):
+        block = mapped_block[-self.window_scans:]
+        scan_index = start_scan + len(mapped_block) - len(block) + np.arange(len(block))
+        with self.lock:
+            pos = self.scans_pushed % self.window_scans
+            first = min(len(block), self.window_scans - pos)
+            self.ring[pos:pos + first] = block[:first]
+            self.ring[:len(block) - first] = block[first:]
+            self.ring_scans[pos:pos + first] = scan_index[:first]
+            self.ring_scans[:len(block) - first] = scan_index[first:]
+            self.scans_pushed += len(block)
+            self.new_data = True
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='live-plotter', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        self._setup_figure()
+        next_frame = time()
+        while not self.stop_event.wait(max(0.0, next_frame - time())):
+            next_frame = max(next_frame + self.frame_interval, time())
+            if not self.new_data:
+                continue
+            try:
+                if self.frame_time is not None:
+                    with self.frame_time.time():
+                        self._render()
+                else:
+                    self._render()
+            except Exception as e:
+                print(f"Error: live plot frame failed: {e}")
+                return
+        plt.close(self.fig)
+
+    def _setup_figure(self):
+        # Same layout as the stacked final plot: brakes on top, shock pots below
+        self.fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True)
+        self.fig.suptitle('Live Data (Brakes and Shocks)')
+        self.lines = []
+        for ax, group, ylabel in ((ax1, brake_channels, 'Brake Pressure (PSI)'),
+                                  (ax2, shock_channels, 'Shock Pot Length (Inches)')):
+            for ch in group:
+                if ch in self.channels:
+                    line, = ax.plot([], [], label=channel_names[ch], animated=True)
+                    self.lines.append((ax, self.channels.index(ch), line))
+            ax.set_xlim(-self.window, 0)
+            ax.set_ylabel(ylabel)
+            ax.grid(True)
+            if ax.get_lines():
+                ax.legend(loc='upper left', fontsize='small')
+        ax2.set_xlabel('Time before now (s)')
+        self.clock = self.fig.text(0.99, 0.01, '', ha='right', va='bottom', animated=True)
+        self.fig.tight_layout(rect=[0, 0, 1, 0.96])
+        self.n_bins = max(1, int(ax2.bbox.width))
+        self.ylims = {}
+        self._draw_background()
+
+    def _draw_background(self):
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def _snapshot(self):
+        with self.lock:
+            pos = self.scans_pushed % self.window_scans
+            values = np.concatenate((self.ring[pos:], self.ring[:pos]))
+            scans = np.concatenate((self.ring_scans[pos:], self.ring_scans[:pos]))
+            self.new_data = False
+        return values, scans
+
+    def _render(self):
+        values, scans = self._snapshot()
+        valid = scans >= 0
+        values = values[valid]
+        scans = scans[valid]
+        latest = scans[-1]
+
+        # Per-pixel min/max envelope; NaN padding is ignored by fmin / fmax
+        bin_size = -(-len(scans) // self.n_bins)
+        pad = -len(scans) % bin_size
+        x = (scans[::bin_size] - latest) / self.rate
+        padded = np.concatenate((values, np.full((pad, values.shape[1]), np.nan, dtype=values.dtype)))
+        binned = padded.reshape(-1, bin_size, values.shape[1])
+        y_min = np.fmin.reduce(binned, axis=1)
+        y_max = np.fmax.reduce(binned, axis=1)
+        x = np.repeat(x, 2)
+
+        # Grow an axis' y-limits (and redraw the background) only when data leaves them
+        redraw = False
+        for ax in {ax for ax, _, _ in self.lines}:
+            cols = [col for a, col, _ in self.lines if a is ax]
+            low = np.nanmin(y_min[:, cols]) if np.isfinite(y_min[:, cols]).any() else 0.0
+            high = np.nanmax(y_max[:, cols]) if np.isfinite(y_max[:, cols]).any() else 1.0
+            current = self.ylims.get(ax)
+            if current is None or low < current[0] or high > current[1]:
+                margin = max(high - low, 1e-3) * 0.1
+                self.ylims[ax] = (low - margin, high + margin)
+                ax.set_ylim(*self.ylims[ax])
+                redraw = True
+        if redraw:
+            self._draw_background()
+
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        for ax, col, line in self.lines:
+            line.set_data(x, np.column_stack((y_min[:, col], y_max[:, col])).ravel())
+            ax.draw_artist(line)
+        self.clock.set_text(f't = {latest / self.rate:.1f} s')
+        self.fig.draw_artist(self.clock)
+
+        tmp_path = f'{self.output_path}.tmp'
+        # Fast compression, the frame is replaced again within a second anyway
+        matplotlib.image.imsave(tmp_path, np.asarray(canvas.buffer_rgba()), format='png',
+                                pil_kwargs={'compress_level': 1})
+        os.replace(tmp_path, self.output_path)
+        self.frames += 1
+
+
 if __name__ == '__main__':
-    latest_csv_path = get_latest_csv_path()
-    save_final_plots(latest_csv_path)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Plot the latest session, or every session in a directory')
+    parser.add_argument('path', nargs='?', help='session to plot (_MAPPPED.csv, _RAW.bin or _SEGMENTS.csv, or _EVENTS.csv for one plot per event), default: the latest one from latest_csv_path.txt')
+    parser.add_argument('--batch', metavar='DIR', help='plot every session in DIR (a save_fp directory), skipping unchanged ones')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--force', action='store_true', help='with --batch, replot sessions the manifest says are up to date')
+    parser.add_argument('--hash', action='store_true', help='with --batch, compare file contents (sha1) instead of mtimes')
+    parser.add_argument('--start', type=float, default=None, help='plot from this many seconds into the session')
+    parser.add_argument('--end', type=float, default=None, help='plot up to this many seconds into the session')
+    parser.add_argument('--follow', action='store_true', help='plot each segment of a segmented session as soon as it closes, until the session ends')
+    args = parser.parse_args()
+
+    if args.batch:
+        plotted, skipped, failed = plot_directory(args.batch, args.workers, force=args.force, use_hash=args.hash)
+        print(f"Done: {plotted} plotted, {skipped} skipped, {failed} failed")
+        sys.exit(1 if failed else 0)
+
+    csv_path = args.path or get_latest_csv_path()
+    if args.follow:
+        if not csv_path.endswith(SEGMENT_INDEX_SUFFIX):
+            print(f"Error: --follow needs a segmented session's _SEGMENTS.csv, not {csv_path}")
+            sys.exit(1)
+        sys.exit(0 if plot_segments_as_they_close(csv_path, workers=args.workers) else 1)
+
+    if csv_path.endswith('_EVENTS.csv'):
+        sys.exit(0 if plot_events(csv_path, workers=args.workers) else 1)
+
+    time_range = None if args.start is None and args.end is None else (args.start, args.end)
+    if not save_final_plots(csv_path, workers=args.workers, time_range=time_range):
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Batch recalibration of recorded sessions, for when a calibration in sense_config.yaml turns out
+to be wrong after the fact.
+
+Every _RAW.csv (or binary _RAW.bin, or segmented session) in the directory is streamed in fixed-size chunks through the
+same compile_calibration / apply_calibration the logger uses, with sessions spread across a
+process pool. Derived channels (derived.py) the session was recorded with are recomputed from
+the recalibrated data, in scan order and restarting after gaps, like the logger does.
+For each session it writes, next to the original:
+    <session>_RECAL_MAPPPED.csv    new calibrated data (same layout as _MAPPPED.csv)
+    <session>_RECAL.yaml           copy of the config file that was used
+
+Originals are never touched. Usage:
+
+    python3 recalibrate.py /home/pi/TESTING_DATA/12_17_26_data fixed_config.yaml
+    python3 recalibrate.py <dir> <config.yaml> --workers 4 --chunk-rows 200000 --suffix RECAL2
+'''
+import sys
+import os
+import re
+import csv
+import glob
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+import numpy as np
+import pandas as pd
+import yaml
+
+from calibration import load_calibration_config, compile_calibration, apply_calibration
+from derived import parse_derived_channels, DerivedChannels
+from recording import (open_recording, read_header, load_gaps, record_scan_index, session_base, load_segments,
+                       select_segments, SEGMENT_INDEX_SUFFIX)
+
+
+def find_raw_sessions(save_dir):
+    '''
+    Lists the raw recordings in a save_fp directory, preferring _RAW.csv when a session has both.
+    A segmented session is listed by its _SEGMENTS.csv index.
+    '''
+    sessions = {}
+    for path in sorted(glob.glob(os.path.join(save_dir, '*_RAW.bin')) + glob.glob(os.path.join(save_dir, '*_RAW.csv'))):
+        if not re.search(r'_S\d{4}_RAW\.', path):
+            sessions[session_base(path)] = path
+    for path in glob.glob(os.path.join(save_dir, f'*{SEGMENT_INDEX_SUFFIX}')):
+        sessions[session_base(path)] = path
+    return sorted(sessions.values())
+
+
+def session_raw_files(raw_path):
+    '''
+    Raw files of a session in order: the file itself, or every raw segment of a segmented session.
+    '''
+    if not raw_path.endswith(SEGMENT_INDEX_SUFFIX):
+        return [raw_path]
+    segments = load_segments(raw_path)
+    kind = 'raw' if any(segment['kind'] == 'raw' for segment in segments) else 'binary'
+    return [segment['file'] for segment in select_segments(segments, kind)]
+
+
+def load_session_derived(raw_path, settings_path='test.yaml'):
+    '''
+    Derived channels (derived.py) a session was recorded with, to recompute them after recalibrating.
+
+    A binary recording lists them in its header. A CSV session only has their names, as the
+    columns of its _MAPPPED.csv after the scanned ones, so those are looked up in the
+    derived_channels setting of test.yaml.
+
+    @return: (derived channel configs for parse_derived_channels, scan rate from the header or
+              None for a CSV session)
+    '''
+    files = session_raw_files(raw_path)
+    if not files:
+        return [], None
+    if files[0].endswith('.bin'):
+        header = read_header(files[0])
+        return header.get('derived', []), header['rate']
+
+    mapped_path = re.sub(r'_RAW\.csv$', '_MAPPPED.csv', files[0])
+    try:
+        with open(files[0], 'r', newline='') as f:
+            raw_columns = next(csv.reader(f))
+        with open(mapped_path, 'r', newline='') as f:
+            names = next(csv.reader(f))[len(raw_columns):]
+    except (OSError, StopIteration):
+        return [], None
+    if not names:
+        return [], None
+
+    with open(settings_path, 'r') as f:
+        settings = (yaml.safe_load(f) or {}).get('logger') or {}
+    configs = {str(entry.get('name')): entry for entry in settings.get('derived_channels') or []}
+    missing = [name for name in names if name not in configs]
+    if missing:
+        print(f"WARNING: derived channel(s) {', '.join(missing)} of {os.path.basename(mapped_path)} are not in "
+              f"{settings_path}, left out of the recalibrated data")
+    return [configs[name] for name in names if name in configs], None
+
+
+def iter_raw_chunks(raw_path, chunk_rows):
+    '''
+    Yields (channels, times, raw_block) chunks from a _RAW.csv or _RAW.bin recording, or from
+    every segment of a segmented session in order.
+    '''
+    if raw_path.endswith(SEGMENT_INDEX_SUFFIX):
+        for path in session_raw_files(raw_path):
+            yield from iter_raw_chunks(path, chunk_rows)
+        return
+
+    if raw_path.endswith('.bin'):
+        header, data = open_recording(raw_path)
+        scan_index = record_scan_index(load_gaps(raw_path), len(data), header.get('first_scan', 0))
+        for start in range(0, len(data), chunk_rows):
+            raw_block = np.asarray(data[start:start + chunk_rows], dtype=np.float64)
+            yield header['channels'], scan_index[start:start + len(raw_block)] / header['rate'], raw_block
+        return
+
+    for chunk in pd.read_csv(raw_path, chunksize=chunk_rows, engine='c', dtype=np.float64):
+        channels = [int(col) for col in chunk.columns[1:]]
+        yield channels, chunk['Time'].to_numpy(), chunk.iloc[:, 1:].to_numpy()
+
+
+def recalibrate_session(raw_path, config_path, suffix, chunk_rows):
+    '''
+    Recalibrates one session (runs in a worker process).
+
+    @return: (raw_path, mapped output path, rows written, seconds taken)
+    '''
+    start = time()
+    config = load_calibration_config(config_path)
+    base_path = session_base(raw_path)
+    out_path = f'{base_path}_{suffix}_MAPPPED.csv'
+    tmp_path = f'{out_path}.tmp'
+    derived_config, rate = load_session_derived(raw_path)
+
+    rows = 0
+    calibration = None
+    with open(tmp_path, 'w', newline='') as out_file:
+        writer = csv.writer(out_file)
+        for channels, times, raw_block in iter_raw_chunks(raw_path, chunk_rows):
+            if calibration is None:
+                calibration = compile_calibration(channels, config)
+                if rate is None and len(times) > 1:
+                    # CSV session: times are scan index / rate, so the rate is one over the scan interval
+                    rate = 1.0 / np.median(np.diff(times))
+                derived = DerivedChannels(parse_derived_channels(derived_config if rate else [], channels),
+                                          channels, rate)
+                writer.writerow(['Time'] + [str(chan) for chan in channels] + derived.names)
+            gain, offset = calibration
+            mapped_block = apply_calibration(raw_block, gain, offset)
+            if derived.names:
+                scan_index = np.rint(times * rate).astype(np.int64)
+                mapped_block = np.column_stack((mapped_block, derived.process_records(scan_index, mapped_block)))
+            writer.writerows(np.column_stack((times, mapped_block)).tolist())
+            rows += len(raw_block)
+
+    # Only replace an earlier output once the new one is complete
+    os.replace(tmp_path, out_path)
+    shutil.copyfile(config_path, f'{base_path}_{suffix}.yaml')
+    return raw_path, out_path, rows, time() - start
+
+
+def recalibrate_dir(save_dir, config_path, suffix='RECAL', workers=None, chunk_rows=100000):
+    '''
+    Recalibrates every raw recording in save_dir in parallel.
+
+    @return: list of (raw_path, out_path, rows, seconds) for the sessions that succeeded
+    '''
+    # Fail fast on a bad config rather than once per worker
+    load_calibration_config(config_path)
+
+    sessions = find_raw_sessions(save_dir)
+    if not sessions:
+        print(f'No _RAW.csv / _RAW.bin recordings found in {save_dir}')
+        return []
+
+    print(f'Recalibrating {len(sessions)} session(s) in {save_dir} with {config_path}')
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(recalibrate_session, path, config_path, suffix, chunk_rows): path for path in sessions}
+        for future in as_completed(futures):
+            try:
+                raw_path, out_path, rows, seconds = future.result()
+            except Exception as e:
+                print(f'ERROR: could not recalibrate {futures[future]}: {e}')
+                continue
+            print(f'{os.path.basename(out_path)}: {rows} rows in {seconds:.2f} s')
+            results.append((raw_path, out_path, rows, seconds))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Regenerate mapped CSVs of recorded sessions with a new calibration')
+    parser.add_argument('save_dir', help='directory with the _RAW.csv / _RAW.bin recordings (a save_fp directory)')
+    parser.add_argument('config', help='calibration config file (same layout as sense_config.yaml)')
+    parser.add_argument('--suffix', default='RECAL', help='tag added to the output names (default RECAL)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--chunk-rows', type=int, default=100000, help='rows read per chunk')
+    args = parser.parse_args()
+
+    start = time()
+    results = recalibrate_dir(args.save_dir, args.config, args.suffix, args.workers, args.chunk_rows)
+    print(f'Done: {len(results)} session(s), {sum(r[2] for r in results)} rows in {time() - start:.2f} s')
+    if not results:
+        sys.exit(1)
@@ -0,0 +1,874 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Session recording formats for the logger.
+
+CSV: the original _MAPPPED.csv / _RAW.csv pair, one text row per scan.
+
+Binary (_RAW.bin): a fixed size JSON header followed by fixed-width records of raw
+voltages (one little-endian float32 per channel, in queue order). The header records
+the channels, ranges, input modes, scan rate and a snapshot of the calibration, so the
+file can be opened with np.memmap and mapped / exported to CSV offline:
+
+    python3 recording.py <session>_RAW.bin
+
+Files are written in large buffered batches and fsync'ed every fsync_interval seconds or
+fsync_bytes bytes (SyncedFile). A session that was finalized cleanly (stopped, Ctrl+C or
+SIGTERM) also gets a <session>_END.json marker with its end time, reason and scan counts;
+a session without one was cut off (power loss, SIGKILL) and may be missing its tail.
+
+Time in every format is the scan index divided by the scan rate the board actually ran at,
+i.e. the hardware sample clock. Scans that never made it into the recording (buffer overrun,
+writer queue full) are listed in the _GAPS.csv sidecar, which is also what maps binary record i
+back to its scan index.
+
+The _CALIB.csv sidecar lists the gain/offset of every channel and the scan it applies from: one
+row for the calibration at the start, plus one per sense_config.yaml reload during the session.
+Binary recordings are mapped segment by segment with it (calibrate_records).
+
+Segmented sessions: with segment_seconds / segment_mb set, the output is rotated into numbered
+segments (<session>_S0001_MAPPPED.csv, <session>_S0001_RAW.bin, ...), each a complete file of
+its own, so a power cut can only cost the segment being written. <session>_SEGMENTS.csv indexes
+every closed segment file with its scan range, time range, size and CRC32, and is fsync'ed as
+each segment closes, so readers can pick only the segments they need (load_segments) or process
+each one as soon as it is done (follow_segments). The GAPS / CALIB / END sidecars stay per session.
+
+Trigger mode (trigger.py) stores only event windows, each as its own segment(s), and lists the
+events in <session>_EVENTS.csv (EventLog / load_events).
+
+Summary pyramid: <session>_SUMMARY.bin holds the min / max / mean of every mapped (and derived)
+channel over buckets of a few fixed lengths (summary_levels, by default 10 ms, 100 ms and 1 s),
+built while logging (SummaryWriter) so a whole-session overview never has to read the full-rate
+data (load_summary).
+'''
+import sys
+import os
+import io
+import re
+import csv
+import json
+import zlib
+from time import time, sleep
+import numpy as np
+
+from calibration import compile_calibration, apply_calibration
+from derived import DerivedChannels
+
+BINARY_MAGIC = b'MCCDAQ1\n'
+SUMMARY_MAGIC = b'MCCSUM1\n'
+HEADER_SIZE = 4096
+RECORD_DTYPE = '<f4'
+
+#-----------------
+# DURABLE OUTPUT
+#-----------------
+class SyncedFile:
+    '''
+    Output file written through a large buffer and fsync'ed to the SD card every fsync_interval
+    seconds or fsync_bytes bytes, whichever comes first, so no more than that is at risk if
+    the logger is killed or loses power.
+
+    @param buffer_bytes: write buffer size, i.e. the batch each write() system call carries
+
+    @param fsync_interval: max seconds between fsyncs, 0 to only fsync on close
+
+    @param fsync_bytes: max bytes written between fsyncs, 0 for no byte threshold
+    '''
+    def __init__(self, filename, mode='w', buffer_bytes=1 << 20, fsync_interval=5.0, fsync_bytes=8 << 20):
+        if 'b' in mode:
+            self.file = open(filename, mode, buffering=buffer_bytes)
+        else:
+            self.file = open(filename, mode, buffering=buffer_bytes, newline='')
+        self.fsync_interval = fsync_interval
+        self.fsync_bytes = fsync_bytes
+        self.unsynced = 0
+        self.written = 0
+        self.last_sync = time()
+
+    def write(self, data):
+        self.file.write(data)
+        self.unsynced += len(data)
+        self.written += len(data)
+        if ((self.fsync_bytes and self.unsynced >= self.fsync_bytes)
+                or (self.fsync_interval and time() - self.last_sync >= self.fsync_interval)):
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time()
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+def session_base(filename):
+    '''
+    Path of the session a file belongs to, without its segment number, kind and extension,
+    e.g. <session>_S0003_RAW.bin -> <session>. The session's sidecars are named from it.
+    '''
+    base_path = os.path.splitext(filename)[0].replace('_MAPPPED', '').replace('_RAW', '')
+    base_path = re.sub(r'_(SEGMENTS|SUMMARY|EVENTS)$', '', base_path)
+    return re.sub(r'_S\d{4}$', '', base_path)
+
+
+def write_end_marker(filename, info):
+    '''
+    Writes the <session>_END.json marker of a cleanly finalized session (atomic replace + fsync).
+
+    @param info: dict with at least 'reason'; end_time is added
+    '''
+    marker = dict(info)
+    marker['end_time'] = time()
+    tmp_path = f'{filename}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(marker, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filename)
+
+
+def load_end_marker(filename):
+    '''
+    Reads the _END.json marker of a recording.
+
+    @param filename: path to any file of the session
+
+    @return: marker dict, None if the session was never finalized (or predates markers)
+    '''
+    base_path = session_base(filename)
+    try:
+        with open(f'{base_path}_END.json', 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+#------------------------
+# CSV RECORDING (TEXT)
+#------------------------
+class CsvRecordingWriter:
+    '''
+    Writes the _MAPPPED.csv / _RAW.csv pair, one row per scan with a Time column.
+    Each block is formatted in memory and handed to the file as one batch.
+
+    @param derived: names of derived channels (derived.py), written as extra columns of the
+                    mapped CSV after the scanned channels; write() then takes mapped blocks with
+                    those columns appended
+
+    @param sync_options: buffer_bytes / fsync_interval / fsync_bytes for SyncedFile
+    '''
+    def __init__(self, filename_mapped, filename_raw, channels, derived=(), **sync_options):
+        self.mapped_file = SyncedFile(filename_mapped, 'w', **sync_options)
+        self.raw_file = SyncedFile(filename_raw, 'w', **sync_options)
+
+        header = ['Time'] + [str(chan) for chan in channels]
+        self.mapped_file.write(self._format([header + list(derived)]))
+        self.raw_file.write(self._format([header]))
+        self.mapped_file.sync()
+        self.raw_file.sync()
+
+    @staticmethod
+    def _format(rows):
+        text = io.StringIO()
+        csv.writer(text).writerows(rows)
+        return text.getvalue()
+
+    def write(self, start_scan, scan_times, raw_block, mapped_block):
+        self.mapped_file.write(self._format(np.column_stack((scan_times, mapped_block)).tolist()))
+        self.raw_file.write(self._format(np.column_stack((scan_times, raw_block)).tolist()))
+
+    def size(self):
+        return max(self.mapped_file.written, self.raw_file.written)
+
+    def close(self):
+        self.mapped_file.close()
+        self.raw_file.close()
+
+#----------------------------
+# BINARY RECORDING (MEMMAP)
+#----------------------------
+def pack_header(header, magic=BINARY_MAGIC):
+    '''
+    Packs the header dict into the fixed size block at the start of a binary recording.
+    '''
+    packed = magic + json.dumps(header).encode('utf-8')
+    if len(packed) >= HEADER_SIZE:
+        raise ValueError(f'recording header too large ({len(packed)} bytes, max {HEADER_SIZE - 1})')
+    return packed + b'\n' + b' ' * (HEADER_SIZE - len(packed) - 1)
+
+
+class BinaryRecordingWriter:
+    '''
+    Writes raw voltages as fixed-width float32 records after a JSON header.
+
+    @param header: dict with at least 'channels' and 'rate'; also ranges, input modes,
+                   start time and a 'calibration' snapshot of sense_config.yaml, and for a
+                   segment its 'segment' number and 'first_scan'
+
+    @param sync_options: buffer_bytes / fsync_interval / fsync_bytes for SyncedFile
+    '''
+    def __init__(self, filename, header, **sync_options):
+        self.header = dict(header)
+        self.header['record_dtype'] = RECORD_DTYPE
+        self.header['scan_count'] = 0
+        self.header['complete'] = False
+        self.output = SyncedFile(filename, 'wb', **sync_options)
+        self.output.write(pack_header(self.header))
+        self.output.sync()
+
+    def write(self, start_scan, scan_times, raw_block, mapped_block):
+        self.output.write(np.ascontiguousarray(raw_block, dtype=RECORD_DTYPE).tobytes())
+        self.header['scan_count'] += len(raw_block)
+
+    def size(self):
+        return self.output.written
+
+    def close(self):
+        # Rewrite the header so it carries the final scan count and says the file is complete.
+        self.header['complete'] = True
+        self.output.file.flush()
+        self.output.file.seek(0)
+        self.output.file.write(pack_header(self.header))
+        self.output.close()
+
+
+#--------------------
+# SEGMENTED SESSIONS
+#--------------------
+# File name suffix of each kind of segment file
+SEGMENT_KINDS = {'mapped': '_MAPPPED.csv', 'raw': '_RAW.csv', 'binary': '_RAW.bin'}
+SEGMENT_INDEX_SUFFIX = '_SEGMENTS.csv'
+SEGMENT_COLUMNS = ['segment', 'kind', 'file', 'first_scan', 'last_scan', 'records', 'start_time', 'end_time',
+                   'bytes', 'crc32']
+
+
+def segment_path(base_path, segment, kind):
+    '''
+    Path of one file of a segment, e.g. <session>_S0001_RAW.bin. segment None = unsegmented.
+    '''
+    if segment is None:
+        return f'{base_path}{SEGMENT_KINDS[kind]}'
+    return f'{base_path}_S{segment:04d}{SEGMENT_KINDS[kind]}'
+
+
+def file_crc32(filename, chunk_size=1 << 20):
+    crc = 0
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+class SegmentedRecordingWriter:
+    '''
+    Rotates a session's output files into segments: a new segment starts every segment_scans
+    scans (on multiples of it, so segment k of a gap-free session holds scans k * segment_scans
+    on) and/or once a file of the segment reaches segment_bytes. Closed segments are checksummed
+    and added to the _SEGMENTS.csv index straight away.
+
+    Same write / close interface as the single-file writers.
+
+    @param make_writers: make_writers(segment, first_scan) -> list of (kind, path, writer) for a new segment
+
+    @param segment_scans: scans per segment, 0 for no time based rotation
+
+    @param segment_bytes: max bytes per segment file, 0 for no size based rotation
+    '''
+    def __init__(self, index_filename, make_writers, rate, segment_scans=0, segment_bytes=0):
+        self.make_writers = make_writers
+        self.rate = rate
+        self.segment_scans = int(segment_scans)
+        self.segment_bytes = int(segment_bytes)
+        self.segment = 0
+        self.files = None
+        self.index = SyncedFile(index_filename, 'w', buffer_bytes=1 << 16, fsync_interval=0, fsync_bytes=0)
+        self.index.write(CsvRecordingWriter._format([SEGMENT_COLUMNS]))
+        self.index.sync()
+
+    def _open(self, first_scan):
+        self.segment += 1
+        self.files = self.make_writers(self.segment, first_scan)
+        # One writer may produce several of the files (the CSV pair)
+        self.writers = list({id(writer): writer for kind, path, writer in self.files}.values())
+        self.first_scan = first_scan
+        self.last_scan = first_scan
+        self.records = 0
+        if self.segment_scans:
+            self.boundary = (first_scan // self.segment_scans + 1) * self.segment_scans
+        else:
+            self.boundary = None
+
+    def _close_segment(self):
+        for writer in self.writers:
+            writer.close()
+        rows = []
+        for kind, path, writer in self.files:
+            rows.append([self.segment, kind, os.path.basename(path), self.first_scan, self.last_scan, self.records,
+                         self.first_scan / self.rate, self.last_scan / self.rate, os.path.getsize(path),
+                         file_crc32(path)])
+        self.files = None
+        # On disk before anyone is told the segment is done
+        self.index.write(CsvRecordingWriter._format(rows))
+        self.index.sync()
+
+    def write(self, start_scan, scan_times, raw_block, mapped_block):
+        pos = 0
+        while pos < len(raw_block):
+            scan = start_scan + pos
+            if self.files is not None and self.boundary is not None and scan >= self.boundary:
+                # A gap ran past the end of the segment
+                self._close_segment()
+            if self.files is None:
+                self._open(scan)
+
+            end = len(raw_block) if self.boundary is None else min(len(raw_block), pos + self.boundary - scan)
+            for writer in self.writers:
+                writer.write(scan, scan_times[pos:end], raw_block[pos:end], mapped_block[pos:end])
+            self.records += end - pos
+            self.last_scan = start_scan + end - 1
+            pos = end
+
+            if ((self.boundary is not None and self.last_scan + 1 >= self.boundary)
+                    or (self.segment_bytes and max(writer.size() for writer in self.writers) >= self.segment_bytes)):
+                self._close_segment()
+
+    def end_segment(self):
+        '''
+        Closes the current segment now; the next write starts a new one (trigger mode: one event each).
+        '''
+        if self.files is not None:
+            self._close_segment()
+
+    def close(self):
+        self.end_segment()
+        self.index.close()
+
+
+def load_segments(filename, include_open=True):
+    '''
+    Reads the segment index of a session.
+
+    @param filename: the <session>_SEGMENTS.csv index or any file of the session
+
+    @param include_open: also list segment files that are not in the index (the segment being
+                         written, or cut off by a power loss), with None for the unknown fields
+
+    @return: list of dicts with the SEGMENT_COLUMNS keys in segment order, 'file' as a full path;
+             empty if the session isn't segmented
+    '''
+    base_path = session_base(filename)
+    directory = os.path.dirname(base_path)
+    segments = []
+    try:
+        with open(f'{base_path}{SEGMENT_INDEX_SUFFIX}', 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                segments.append({
+                    'segment': int(row['segment']), 'kind': row['kind'], 'file': os.path.join(directory, row['file']),
+                    'first_scan': int(row['first_scan']), 'last_scan': int(row['last_scan']), 'records': int(row['records']),
+                    'start_time': float(row['start_time']), 'end_time': float(row['end_time']),
+                    'bytes': int(row['bytes']), 'crc32': int(row['crc32']),
+                    })
+    except FileNotFoundError:
+        return []
+
+    if include_open:
+        indexed = {segment['file'] for segment in segments}
+        last = max((segment['segment'] for segment in segments), default=0)
+        for kind, suffix in SEGMENT_KINDS.items():
+            for path in glob_segments(base_path, suffix):
+                number = int(path[len(base_path) + 2:len(base_path) + 6])
+                if path not in indexed and number > last:
+                    segment = dict.fromkeys(SEGMENT_COLUMNS)
+                    segment.update(segment=number, kind=kind, file=path)
+                    segments.append(segment)
+    segments.sort(key=lambda segment: (segment['segment'], segment['kind']))
+    return segments
+
+
+def glob_segments(base_path, suffix):
+    '''
+    Segment files of one kind on disk, indexed or not, in segment order.
+    '''
+    pattern = re.compile(re.escape(os.path.basename(base_path)) + r'_S\d{4}' + re.escape(suffix) + '$')
+    directory = os.path.dirname(base_path) or '.'
+    return sorted(os.path.join(os.path.dirname(base_path), name) for name in os.listdir(directory) if pattern.match(name))
+
+
+def select_segments(segments, kind, start_time=None, end_time=None):
+    '''
+    The segments of one kind that overlap [start_time, end_time] (None = open ended). Segments
+    not in the index yet have no times and are always included.
+    '''
+    selected = []
+    for segment in segments:
+        if segment['kind'] != kind:
+            continue
+        if segment['start_time'] is not None:
+            if end_time is not None and segment['start_time'] > end_time:
+                continue
+            if start_time is not None and segment['end_time'] < start_time:
+                continue
+        selected.append(segment)
+    return selected
+
+
+def verify_segment(segment):
+    '''
+    True if a segment file still matches the size and CRC32 in the index.
+    '''
+    if segment['crc32'] is None:
+        return False
+    return os.path.getsize(segment['file']) == segment['bytes'] and file_crc32(segment['file']) == segment['crc32']
+
+
+def follow_segments(filename, poll_interval=1.0, stop_event=None):
+    '''
+    Yields each segment file of a session as soon as it is closed and indexed, for processing
+    a session while it is still being logged. Ends once the session's _END.json marker is
+    written (or stop_event is set) and every indexed segment has been yielded.
+    '''
+    done = set()
+    while True:
+        finished = load_end_marker(filename) is not None
+        for segment in load_segments(filename, include_open=False):
+            if segment['file'] not in done:
+                done.add(segment['file'])
+                yield segment
+        if finished or (stop_event is not None and stop_event.is_set()):
+            return
+        sleep(poll_interval)
+
+
+#---------------
+# EVENT RECORDS
+#---------------
+EVENT_COLUMNS = ['event', 'trigger', 'trigger_scan', 'trigger_time', 'first_scan', 'last_scan', 'records',
+                 'start_time', 'end_time', 'first_segment', 'last_segment']
+
+
+class EventLog:
+    '''
+    Writes the _EVENTS.csv index of a triggered session, one row per stored event window with
+    the condition that started it and the segments its scans went to.
+    '''
+    def __init__(self, filename, rate):
+        self.rate = rate
+        self.file = open(filename, mode='w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(EVENT_COLUMNS)
+        self.file.flush()
+
+    def record(self, event):
+        self.writer.writerow([event['event'], event['trigger'], event['trigger_scan'], event['trigger_scan'] / self.rate,
+                              event['first_scan'], event['last_scan'], event['records'], event['first_scan'] / self.rate,
+                              event['last_scan'] / self.rate, event['first_segment'], event['last_segment']])
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def load_events(filename):
+    '''
+    Reads the _EVENTS.csv index of a triggered session.
+
+    @param filename: path to any file of the session
+
+    @return: list of dicts with the EVENT_COLUMNS keys, empty if the session wasn't triggered
+    '''
+    base_path = session_base(filename)
+    try:
+        with open(f'{base_path}_EVENTS.csv', 'r', newline='') as f:
+            rows = list(csv.DictReader(f))
+    except FileNotFoundError:
+        return []
+    events = []
+    for row in rows:
+        event = {key: int(row[key]) for key in ('event', 'trigger_scan', 'first_scan', 'last_scan', 'records')}
+        event.update({key: float(row[key]) for key in ('trigger_time', 'start_time', 'end_time')})
+        event.update({key: int(row[key]) if row[key] else None for key in ('first_segment', 'last_segment')})
+        event['trigger'] = row['trigger']
+        events.append(event)
+    return events
+
+
+#-----------------
+# SUMMARY PYRAMID
+#-----------------
+def summary_dtype(channel_count):
+    '''
+    Record of one bucket of the summary file: level (index into the header's levels), bucket
+    number (bucket k covers scans k * bucket_scans to (k + 1) * bucket_scans), scans in it and
+    the per channel min / max / mean.
+    '''
+    return np.dtype([('level', '<u2'), ('count', '<u4'), ('bucket', '<i8'), ('min', '<f4', (channel_count,)),
+                     ('max', '<f4', (channel_count,)), ('mean', '<f4', (channel_count,))])
+
+
+class SummaryWriter:
+    '''
+    Keeps the summary pyramid of a session up to date as blocks are written: per level, the
+    min / max / mean of each column of the mapped blocks over buckets of bucket_scans scans.
+    Each level is reduced straight from the block (vectorized, reduceat per bucket); only the
+    bucket still being filled is held between blocks, finished buckets go to the file. NaNs
+    (e.g. brake balance with the brakes off) are left out of a bucket's min / max / mean.
+
+    Same write / close interface as the recording writers, so it sits in the logger's writer list.
+
+    @param columns: names of the mapped columns (channels, then derived channels)
+
+    @param levels: bucket lengths in scans, finest first
+    '''
+    def __init__(self, filename, columns, rate, levels, **sync_options):
+        self.levels = sorted({max(1, int(level)) for level in levels})
+        self.dtype = summary_dtype(len(columns))
+        self.header = {'channels': list(columns), 'rate': rate, 'levels': self.levels, 'complete': False}
+        # Per level: [bucket, count, min, max, finite sum, finite count] of the bucket being filled
+        self.pending = [None] * len(self.levels)
+        self.buckets_written = 0
+        self.output = SyncedFile(filename, 'wb', **sync_options)
+        self.output.write(pack_header(self.header, SUMMARY_MAGIC))
+        self.output.sync()
+
+    def write(self, start_scan, scan_times, raw_block, mapped_block):
+        rows = []
+        finite = np.isfinite(mapped_block)
+        values = np.where(finite, mapped_block, 0.0)
+        for level, bucket_scans in enumerate(self.levels):
+            ids = (start_scan + np.arange(len(mapped_block))) // bucket_scans
+            starts = np.flatnonzero(np.diff(ids, prepend=ids[0] - 1))
+            stats = [ids[starts], np.diff(np.append(starts, len(ids))),
+                     np.fmin.reduceat(mapped_block, starts, axis=0), np.fmax.reduceat(mapped_block, starts, axis=0),
+                     np.add.reduceat(values, starts, axis=0), np.add.reduceat(finite, starts, axis=0)]
+
+            pending = self.pending[level]
+            if pending is not None and pending[0] == stats[0][0]:
+                # The block carries on the bucket the last one ended in
+                stats[1][0] += pending[1]
+                stats[2][0] = np.fmin(stats[2][0], pending[2])
+                stats[3][0] = np.fmax(stats[3][0], pending[3])
+                stats[4][0] += pending[4]
+                stats[5][0] += pending[5]
+            elif pending is not None:
+                rows.append(self._rows(level, [[value] for value in pending]))
+
+            # The last bucket stays open unless the block ends right on its boundary
+            done = len(starts) if (start_scan + len(mapped_block)) % bucket_scans == 0 else len(starts) - 1
+            rows.append(self._rows(level, [stat[:done] for stat in stats]))
+            self.pending[level] = [stat[done] for stat in stats] if done < len(starts) else None
+        self._write(rows)
+
+    def _rows(self, level, stats):
+        buckets, counts, mins, maxs, sums, finite_counts = stats
+        rows = np.zeros(len(buckets), dtype=self.dtype)
+        rows['level'] = level
+        rows['bucket'] = buckets
+        rows['count'] = counts
+        rows['min'] = mins
+        rows['max'] = maxs
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rows['mean'] = np.asarray(sums) / np.asarray(finite_counts)
+        return rows
+
+    def _write(self, rows):
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=self.dtype)
+        if len(rows):
+            self.output.write(rows.tobytes())
+            self.buckets_written += len(rows)
+
+    def close(self):
+        # Buckets cut short by the end of the session
+        self._write([self._rows(level, [[value] for value in pending])
+                     for level, pending in enumerate(self.pending) if pending is not None])
+        self.header['complete'] = True
+        self.output.file.flush()
+        self.output.file.seek(0)
+        self.output.file.write(pack_header(self.header, SUMMARY_MAGIC))
+        self.output.close()
+
+
+def load_summary(filename, level=None, time_range=None, min_buckets=None):
+    '''
+    Reads one level of a session's summary pyramid.
+
+    @param filename: the <session>_SUMMARY.bin file or any file of the session
+
+    @param level: bucket length in scans, one of the header's levels; None picks the coarsest
+                  level with at least min_buckets buckets in time_range (the finest if none has)
+
+    @param time_range: (start, end) seconds, either may be None
+
+    @return: dict with 'channels', 'rate', 'bucket_scans', 'complete' (False if the logger was
+             cut off before closing it) and per bucket 'time' (start of the bucket), 'count',
+             'min', 'max' and 'mean' ((buckets, channels) arrays), or None if the session has no summary
+    '''
+    path = f'{session_base(filename)}_SUMMARY.bin'
+    try:
+        header = read_header(path, SUMMARY_MAGIC)
+    except (FileNotFoundError, ValueError):
+        return None
+    dtype = summary_dtype(len(header['channels']))
+    # Size from the file, a summary cut off before close() still opens
+    count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    records = np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count,)) if count else np.zeros(0, dtype)
+
+    start_time, end_time = time_range or (None, None)
+    rate = header['rate']
+
+    def select(index):
+        rows = records[records['level'] == index]
+        times = rows['bucket'] * (header['levels'][index] / rate)
+        keep = np.ones(len(rows), dtype=bool)
+        if start_time is not None:
+            keep &= times + header['levels'][index] / rate > start_time
+        if end_time is not None:
+            keep &= times <= end_time
+        return rows[keep], times[keep]
+
+    if level is not None:
+        index = header['levels'].index(level)
+        rows, times = select(index)
+    else:
+        for index in reversed(range(len(header['levels']))):
+            rows, times = select(index)
+            if min_buckets is None or len(rows) >= min_buckets:
+                break
+    order = np.argsort(times, kind='stable')
+    return {
+        'channels': header['channels'], 'rate': rate, 'bucket_scans': header['levels'][index],
+        'complete': header['complete'],
+        'time': times[order], 'count': rows['count'][order],
+        'min': rows['min'][order], 'max': rows['max'][order], 'mean': rows['mean'][order],
+        }
+
+
+#-------------
+# GAP RECORDS
+#-------------
+class GapLog:
+    '''
+    Writes the _GAPS.csv sidecar, one row per run of consecutive scans missing from the recording.
+    An empty file (header only) means the recording has no gaps.
+    '''
+    def __init__(self, filename, rate):
+        self.rate = rate
+        self.gap_count = 0
+        self.scans_missing = 0
+        self.file = open(filename, mode='w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['start_scan', 'scan_count', 'start_time', 'end_time', 'reason'])
+        self.file.flush()
+
+    def record(self, start_scan, scan_count, reason):
+        self.gap_count += 1
+        self.scans_missing += scan_count
+        self.writer.writerow([start_scan, scan_count, start_scan / self.rate,
+                              (start_scan + scan_count) / self.rate, reason])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_gaps(filename):
+    '''
+    Reads the _GAPS.csv sidecar of a recording as a list of (start_scan, scan_count).
+
+    @param filename: path to any file of the session, e.g. <session>_RAW.bin
+
+    @return: empty list if the session has no gaps file (older recordings)
+    '''
+    base_path = session_base(filename)
+    try:
+        with open(f'{base_path}_GAPS.csv', 'r', newline='') as f:
+            return [(int(row['start_scan']), int(row['scan_count'])) for row in csv.DictReader(f)]
+    except FileNotFoundError:
+        return []
+
+
+def record_scan_index(gaps, record_count, first_scan=0):
+    '''
+    Scan index of each record in a binary recording, skipping over the gaps from load_gaps.
+
+    @param first_scan: scan index of the first record (header 'first_scan' of a segment)
+    '''
+    scan_index = first_scan + np.arange(record_count, dtype=np.int64)
+    for start_scan, scan_count in sorted(gaps):
+        # Gaps before the segment's first record are already in first_scan
+        if start_scan >= first_scan:
+            scan_index[scan_index >= start_scan] += scan_count
+    return scan_index
+
+
+class CalibrationLog:
+    '''
+    Writes the _CALIB.csv sidecar, one row per calibration used in the session with the scan it
+    applies from.
+    '''
+    def __init__(self, filename, channels, rate):
+        self.rate = rate
+        self.version = None
+        self.changes = 0
+        self.file = open(filename, mode='w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['start_scan', 'start_time', 'version']
+                             + [f'gain_{chan}' for chan in channels] + [f'offset_{chan}' for chan in channels])
+        self.file.flush()
+
+    def record(self, start_scan, gain, offset, version):
+        self.version = version
+        self.changes += 1
+        self.writer.writerow([start_scan, start_scan / self.rate, version] + list(gain) + list(offset))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_calibration_changes(filename):
+    '''
+    Reads the _CALIB.csv sidecar of a recording as a list of (start_scan, gain, offset).
+
+    @param filename: path to any file of the session, e.g. <session>_RAW.bin
+
+    @return: empty list if the session has no calibration file (older recordings)
+    '''
+    base_path = session_base(filename)
+    try:
+        with open(f'{base_path}_CALIB.csv', 'r', newline='') as f:
+            reader = csv.reader(f)
+            columns = next(reader)
+            gain_cols = [i for i, col in enumerate(columns) if col.startswith('gain_')]
+            offset_cols = [i for i, col in enumerate(columns) if col.startswith('offset_')]
+            return [(int(row[0]), np.array([float(row[i]) for i in gain_cols]),
+                     np.array([float(row[i]) for i in offset_cols])) for row in reader if row]
+    except (FileNotFoundError, StopIteration):
+        return []
+
+
+def calibrate_records(raw_block, scan_index, changes, gain, offset, out=None):
+    '''
+    Maps raw records with the calibration in effect at each record's scan.
+
+    @param scan_index: scan index of each record (record_scan_index)
+
+    @param changes: list of (start_scan, gain, offset) from load_calibration_changes
+
+    @param gain, offset: calibration for scans before the first change (the header snapshot)
+    '''
+    if not changes:
+        return apply_calibration(raw_block, gain, offset, out)
+    if out is None:
+        out = np.empty(raw_block.shape, dtype=np.result_type(raw_block, gain))
+    starts = np.array([change[0] for change in changes])
+    # Index of the change in effect at each record, -1 = before the first one
+    segment = np.searchsorted(starts, scan_index, side='right') - 1
+    for i in np.unique(segment):
+        rows = segment == i
+        seg_gain, seg_offset = (gain, offset) if i < 0 else changes[i][1:]
+        out[rows] = apply_calibration(raw_block[rows], seg_gain, seg_offset)
+    return out
+
+
+def read_header(filename, magic=BINARY_MAGIC):
+    '''
+    Reads the JSON header of a binary recording (or, with SUMMARY_MAGIC, of a summary file).
+    '''
+    with open(filename, 'rb') as f:
+        block = f.read(HEADER_SIZE)
+    if not block.startswith(magic):
+        raise ValueError(f'{filename} is not a binary DAQ recording')
+    return json.loads(block[len(magic):].decode('utf-8'))
+
+
+def open_recording(filename):
+    '''
+    Opens a binary recording without reading it into memory.
+
+    @return: (header dict, read-only (scans, channels) np.memmap of raw voltages)
+    '''
+    header = read_header(filename)
+    channel_count = len(header['channels'])
+    record_size = channel_count * np.dtype(header['record_dtype']).itemsize
+
+    # Size from the file rather than the header, so a recording that was cut off
+    # before close() still opens (minus any partial trailing record).
+    scan_count = (os.path.getsize(filename) - HEADER_SIZE) // record_size
+    if scan_count == 0:
+        return header, np.zeros((0, channel_count), dtype=header['record_dtype'])
+
+    data = np.memmap(filename, dtype=header['record_dtype'], mode='r', offset=HEADER_SIZE,
+                     shape=(scan_count, channel_count))
+    return header, data
+
+
+def load_recording(filename, mapped=True):
+    '''
+    Loads a binary recording as (times, values), calibrated with the snapshot in its header.
+
+    @param mapped: True for calibrated values, False for raw voltages
+    '''
+    header, data = open_recording(filename)
+    scan_index = record_scan_index(load_gaps(filename), len(data), header.get('first_scan', 0))
+    times = scan_index / header['rate']
+    if not mapped:
+        return header, times, data
+    gain, offset = compile_calibration(header['channels'], header['calibration'])
+    return header, times, calibrate_records(data, scan_index, load_calibration_changes(filename), gain, offset)
+
+
+def export_csv(filename, chunk_scans=100000):
+    '''
+    Offline export of a binary recording to the usual _MAPPPED.csv / _RAW.csv pair, with the
+    derived channels listed in its header recomputed as extra mapped columns.
+
+    @param filename: path to a <session>_RAW.bin file
+
+    @return: path of the mapped CSV
+    '''
+    header, data = open_recording(filename)
+    gain, offset = compile_calibration(header['channels'], header['calibration'])
+    changes = load_calibration_changes(filename)
+    scan_index = record_scan_index(load_gaps(filename), len(data), header.get('first_scan', 0))
+
+    derived = DerivedChannels(header.get('derived', []), header['channels'], header['rate'])
+
+    base_path = os.path.splitext(filename)[0].replace('_RAW', '')
+    filename_mapped = f'{base_path}_MAPPPED.csv'
+    writer = CsvRecordingWriter(filename_mapped, f'{base_path}_RAW.csv', header['channels'], derived.names)
+    try:
+        for start in range(0, len(data), chunk_scans):
+            raw_block = np.asarray(data[start:start + chunk_scans], dtype=np.float64)
+            block_index = scan_index[start:start + len(raw_block)]
+            mapped_block = calibrate_records(raw_block, block_index, changes, gain, offset)
+            if derived.names:
+                mapped_block = np.column_stack((mapped_block, derived.process_records(block_index, mapped_block)))
+            writer.write(block_index[0], block_index / header['rate'], raw_block, mapped_block)
+    finally:
+        writer.close()
+    return filename_mapped
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python3 recording.py <session>_RAW.bin | <session>_SEGMENTS.csv [...]')
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        if not path.endswith(SEGMENT_INDEX_SUFFIX):
+            print(f'Exported {path} -> {export_csv(path)}')
+            continue
+        # Segmented session: check every binary segment against the index, then export it
+        segments = load_segments(path)
+        mapped = {segment['segment'] for segment in segments if segment['kind'] == 'mapped'}
+        for segment in select_segments(segments, 'binary'):
+            if segment['segment'] in mapped:
+                print(f"Skipped {segment['file']}, the session already has its CSVs")
+                continue
+            if segment['crc32'] is not None and not verify_segment(segment):
+                print(f"WARNING: {segment['file']} does not match its checksum in {path}")
+            print(f"Exported {segment['file']} -> {export_csv(segment['file'])}")
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Simulated MCC DAQ backend: a drop-in for the parts of uldaq the logger uses, so the logger,
+plotter and benchmarks can run on a laptop without a board plugged in.
+
+The simulated AiDevice fills the circular buffer passed to a_in_scan from a background thread
+at the requested rate, with synthetic shock pot travel (slow body motion + road noise + the odd
+bump) and brake pressure (periodic brake applications) waveforms, and fires ON_DATA_AVAILABLE
+events like the real library. Select it with 'backend: sim' in the logger section of test.yaml.
+
+The enums, AiQueueElement, create_float_buffer and ULException are uldaq's own when uldaq is
+installed, so queue elements and buffers are interchangeable between the two backends.
+'''
+import threading
+from collections import namedtuple
+from enum import IntEnum, IntFlag
+from time import time, sleep
+import numpy as np
+
+from calibration import load_channel_table, channel_input
+
+try:
+    from uldaq import (AInScanFlag, AiInputMode, AiQueueElement, create_float_buffer,
+                       ScanOption, ScanStatus, InterfaceType, Range, DaqEventType,
+                       ULException)
+except ImportError:
+    # Stand-ins with the same names, for machines without uldaq / the MCC library.
+    import ctypes
+
+    class AInScanFlag(IntFlag):
+        DEFAULT = 0
+
+    class AiInputMode(IntEnum):
+        DIFFERENTIAL = 1
+        SINGLE_ENDED = 2
+        PSEUDO_DIFFERENTIAL = 3
+
+    class ScanOption(IntFlag):
+        DEFAULTIO = 0
+        SINGLEIO = 1
+        BLOCKIO = 2
+        BURSTIO = 4
+        CONTINUOUS = 8
+        EXTCLOCK = 16
+        EXTTRIGGER = 32
+        RETRIGGER = 64
+        BURSTMODE = 128
+
+    class ScanStatus(IntEnum):
+        IDLE = 0
+        RUNNING = 1
+
+    class InterfaceType(IntFlag):
+        USB = 1
+        BLUETOOTH = 2
+        ETHERNET = 4
+        ANY = 7
+
+    class Range(IntEnum):
+        BIP10VOLTS = 5
+        BIP5VOLTS = 6
+        BIP2VOLTS = 10
+        BIP1VOLTS = 12
+
+    class DaqEventType(IntFlag):
+        NONE = 0
+        ON_DATA_AVAILABLE = 1
+        ON_INPUT_SCAN_ERROR = 2
+        ON_END_OF_INPUT_SCAN = 4
+
+    class ULException(Exception):
+        def __init__(self, error_code=0, description='simulated device error'):
+            super().__init__(description)
+            self.error_code = error_code
+            self.description = description
+
+    class AiQueueElement:
+        def __init__(self, channel=0, input_mode=AiInputMode.SINGLE_ENDED, range=Range.BIP10VOLTS):
+            self.channel = channel
+            self.input_mode = input_mode
+            self.range = range
+
+    def create_float_buffer(number_of_channels, samples_per_channel):
+        return (ctypes.c_double * (number_of_channels * samples_per_channel))()
+
+
+TransferStatus = namedtuple('TransferStatus', ['current_scan_count', 'current_total_count', 'current_index'])
+EventCallbackArgs = namedtuple('EventCallbackArgs', ['event_type', 'event_data', 'user_data'])
+DaqDeviceDescriptor = namedtuple('DaqDeviceDescriptor', ['product_name', 'product_id', 'dev_interface',
+                                                         'dev_string', 'unique_id'])
+
+# Full scale of each range in volts, for clipping the synthetic signals like the ADC would
+range_volts = {Range.BIP10VOLTS: 10.0, Range.BIP5VOLTS: 5.0, Range.BIP2VOLTS: 2.0, Range.BIP1VOLTS: 1.0}
+
+# Number of boards get_daq_device_inventory reports
+simulated_device_count = 1
+
+# Pacer clock the achievable scan rates are derived from (rate = clock / integer divisor)
+PACER_CLOCK_HZ = 1000000.0
+# Max per-channel scan rate and aggregate samples/s, like a USB-1608 class board
+SIM_MAX_SCAN_RATE = 100000.0
+SIM_MAX_THROUGHPUT = 400000.0
+
+
+def get_daq_device_inventory(interface_type, number_of_devices=100):
+    '''
+    Lists the simulated boards, same call as uldaq.get_daq_device_inventory.
+    '''
+    count = min(simulated_device_count, number_of_devices)
+    return [DaqDeviceDescriptor('SIM-1608', 0x1608, interface_type, f'SIM-1608 ({i})', f'SIM{i:05d}')
+            for i in range(count)]
+
+
+#-----------------------
+# SYNTHETIC WAVEFORMS
+#-----------------------
+def input_sensors(table, board, inputs):
+    '''
+    Sensor type wired to each of a board's inputs, from the channel table (calibration.load_channel_table).
+    None for inputs that are unmapped or not in the table.
+    '''
+    sensors = {channel_input(spec): spec.sensor for spec in table if spec.device == board}
+    return [sensors.get(chan) for chan in inputs]
+
+
+def synthetic_scans(channels, sensors, start_scan, scan_count, rate, seed=0):
+    '''
+    Generates raw voltages for a run of scans. Deterministic in the scan index, so the same
+    scan always gets the same value (handy for checking nothing was dropped or reordered).
+
+    @param sensors: sensor type of each channel (input_sensors), picks its waveform
+
+    @return: (scan_count, len(channels)) float64 array
+    '''
+    t = (start_scan + np.arange(scan_count)) / rate
+    block = np.empty((scan_count, len(channels)))
+    noise = np.random.default_rng(seed * 1000003 + start_scan).standard_normal((scan_count, len(channels)))
+
+    for i, (chan, sensor) in enumerate(zip(channels, sensors)):
+        phase = 0.7 * chan
+        if sensor in ('short_shock', 'long_shock'):
+            # body motion + road texture + a sharp bump every 7 s, around mid travel (5 V)
+            bump = np.exp(-((t + 0.3 * chan) % 7.0 - 3.5) ** 2 / 0.002)
+            block[:, i] = (5.0 + 2.5 * np.sin(2 * np.pi * 1.3 * t + phase) + 0.4 * np.sin(2 * np.pi * 11.0 * t + phase)
+                           + 2.0 * bump + 0.01 * noise[:, i])
+        elif sensor in ('front_brake', 'rear_brake'):
+            # brake application every 8 s: ramp up, hold, release; rear a bit lower than front
+            cycle = t % 8.0
+            pressure = np.clip(np.minimum(cycle - 4.0, 6.0 - cycle) * 4.0, 0.0, 1.0)
+            share = 1.0 if sensor == 'front_brake' else 0.6
+            block[:, i] = 0.27 + 1.0 * share * pressure + 0.002 * noise[:, i]
+        else:
+            block[:, i] = 0.05 * np.sin(2 * np.pi * 3.0 * t + phase) + 0.005 * noise[:, i]
+    return block
+
+
+#--------------------
+# SIMULATED DEVICES
+#--------------------
+class AiInfo:
+    def get_num_chans_by_mode(self, input_mode):
+        return 8 if input_mode == AiInputMode.DIFFERENTIAL else 16
+
+    def get_max_scan_rate(self, input_mode):
+        return SIM_MAX_SCAN_RATE
+
+    def get_max_throughput(self, input_mode):
+        return SIM_MAX_THROUGHPUT
+
+    def get_ranges(self, input_mode):
+        return [Range.BIP10VOLTS, Range.BIP5VOLTS, Range.BIP2VOLTS, Range.BIP1VOLTS]
+
+    def get_queue_types(self):
+        return []
+
+    def has_pacer(self):
+        return True
+
+
+class AiDevice:
+    '''
+    Simulated analog input subsystem. Supports a loaded queue + continuous a_in_scan.
+    '''
+    def __init__(self, daq_device, board):
+        self.daq_device = daq_device
+        # Board number (serial number order, the channel table's 'device'), also seeds the noise
+        self.board = board
+        self.queue_list = []
+        self.lock = threading.Lock()
+        self.status = ScanStatus.IDLE
+        self.total_count = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def get_info(self):
+        return AiInfo()
+
+    def a_in_load_queue(self, queue_list):
+        self.queue_list = list(queue_list)
+
+    def a_in_scan(self, low_channel, high_channel, input_mode, analog_range, samples_per_channel,
+                  rate, options, flags, data):
+        if self.status == ScanStatus.RUNNING:
+            raise ULException(description='scan already running')
+
+        if self.queue_list:
+            channels = [q.channel for q in self.queue_list]
+            limits = [range_volts.get(Range(q.range), 10.0) for q in self.queue_list]
+        else:
+            channels = list(range(low_channel, high_channel + 1))
+            limits = [range_volts.get(Range(analog_range), 10.0)] * len(channels)
+
+        # Like a real pacer, the board can only hit rates that divide its clock.
+        actual_rate = PACER_CLOCK_HZ / max(1, round(PACER_CLOCK_HZ / rate))
+
+        self.channels = channels
+        # Waveforms follow the sensors wired to the inputs in sense_config.yaml's channel table
+        self.sensors = input_sensors(load_channel_table(), self.board, channels)
+        self.limits = np.array(limits)
+        self.rate = actual_rate
+        self.buffer = np.ctypeslib.as_array(data).reshape(-1, len(channels))
+        self.continuous = bool(options & ScanOption.CONTINUOUS)
+        self.scan_limit = None if self.continuous else samples_per_channel
+        self.total_count = 0
+        self.stop_event.clear()
+        self.status = ScanStatus.RUNNING
+        self.start_time = time()
+        self.thread = threading.Thread(target=self._fill, name='sim-daq', daemon=True)
+        self.thread.start()
+        return actual_rate
+
+    def get_scan_status(self):
+        with self.lock:
+            total_count = self.total_count
+        if self.thread is None:
+            return self.status, TransferStatus(0, 0, -1)
+        channel_count = len(self.channels)
+        scan_count = total_count // channel_count
+        buffer_samples = self.buffer.size
+        index = ((scan_count - 1) * channel_count) % buffer_samples if scan_count else -1
+        return self.status, TransferStatus(scan_count, total_count, index)
+
+    def scan_stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.status = ScanStatus.IDLE
+
+    def _fill(self):
+        channel_count = len(self.channels)
+        buffer_scans = len(self.buffer)
+        scans_done = 0
+        next_event = self.daq_device.event_scans
+
+        while not self.stop_event.is_set():
+            target = int((time() - self.start_time) * self.rate)
+            if self.scan_limit is not None:
+                target = min(target, self.scan_limit)
+
+            # Never write more than a buffer's worth at once (the oldest would be overwritten anyway)
+            while scans_done < target:
+                count = min(target - scans_done, buffer_scans)
+                block = synthetic_scans(self.channels, self.sensors, scans_done, count, self.rate, self.board)
+                np.clip(block, -self.limits, self.limits, out=block)
+
+                start = scans_done % buffer_scans
+                first = min(count, buffer_scans - start)
+                self.buffer[start:start + first] = block[:first]
+                self.buffer[:count - first] = block[first:]
+
+                scans_done += count
+                with self.lock:
+                    self.total_count = scans_done * channel_count
+
+            if next_event and scans_done >= next_event:
+                self.daq_device.fire_event(DaqEventType.ON_DATA_AVAILABLE, scans_done * channel_count)
+                next_event = (scans_done // self.daq_device.event_scans + 1) * self.daq_device.event_scans
+
+            if self.scan_limit is not None and scans_done >= self.scan_limit:
+                self.status = ScanStatus.IDLE
+                self.daq_device.fire_event(DaqEventType.ON_END_OF_INPUT_SCAN, scans_done)
+                return
+
+            sleep(0.0005)
+
+
+class DaqDevice:
+    '''
+    Simulated DAQ device, same methods as uldaq.DaqDevice that the logger calls.
+    '''
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+        self.connected = False
+        self.event_callbacks = {}
+        self.event_scans = 0
+        self.ai_device = AiDevice(self, board=int(str(descriptor.unique_id)[3:] or 0))
+
+    def get_descriptor(self):
+        return self.descriptor
+
+    def get_ai_device(self):
+        return self.ai_device
+
+    def connect(self, connection_code=0):
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+    def release(self):
+        self.connected = False
+
+    def enable_event(self, event_types, event_parameter, event_callback_function, event_callback_user_data):
+        for event_type in (DaqEventType.ON_DATA_AVAILABLE, DaqEventType.ON_INPUT_SCAN_ERROR,
+                           DaqEventType.ON_END_OF_INPUT_SCAN):
+            if event_types & event_type:
+                self.event_callbacks[event_type] = (event_callback_function, event_callback_user_data)
+        if event_types & DaqEventType.ON_DATA_AVAILABLE:
+            self.event_scans = max(1, int(event_parameter))
+
+    def disable_event(self, event_types):
+        for event_type in list(self.event_callbacks):
+            if event_types & event_type:
+                del self.event_callbacks[event_type]
+        if event_types & DaqEventType.ON_DATA_AVAILABLE:
+            self.event_scans = 0
+
+    def fire_event(self, event_type, event_data):
+        callback = self.event_callbacks.get(event_type)
+        if callback:
+            function, user_data = callback
+            function(EventCallbackArgs(event_type, event_data, user_data))
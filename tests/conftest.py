@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules under test are top-level scripts in the repository root
+sys.path.insert(0, REPO)
+
+
+@pytest.fixture
+def logger(monkeypatch):
+    # logger.py (and the simulated boards) read test.yaml and sense_config.yaml from the working directory
+    monkeypatch.chdir(REPO)
+    import logger
+    return logger
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from derived import parse_derived_channels, DerivedChannels
+
+RATE = 1000.0
+CHANNELS = [5, 4, 12]
+CONFIG = [
+    {'name': 'fl_travel_lp', 'type': 'lowpass', 'source': 5, 'window': 0.02},
+    {'name': 'fl_velocity', 'type': 'velocity', 'source': 5, 'window': 0.01, 'smooth': 0.005},
+    {'name': 'brake_balance', 'type': 'balance', 'front': 4, 'rear': 12, 'min_total': 50},
+    ]
+
+
+def derived_channels():
+    return DerivedChannels(parse_derived_channels(CONFIG, CHANNELS), CHANNELS, RATE)
+
+
+def session(scans, seed=0):
+    # Travel around 40 mm, brake pressures 0-100
+    rng = np.random.default_rng(seed)
+    return np.column_stack((40.0 + rng.normal(0.0, 5.0, scans), rng.uniform(0.0, 100.0, (scans, 2))))
+
+
+def test_output_does_not_depend_on_block_split():
+    mapped = session(3000)
+    whole = derived_channels().process(0, mapped)
+
+    derived = derived_channels()
+    edges = [0, 1, 7, 8, 300, 1024, 1025, 2999, 3000]
+    blocks = [derived.process(start, mapped[start:end]) for start, end in zip(edges[:-1], edges[1:])]
+    # Equal up to the rounding of the running sums
+    np.testing.assert_allclose(np.concatenate(blocks), whole, rtol=1e-9, atol=1e-9)
+
+
+def test_lowpass_is_a_moving_average():
+    mapped = session(500)
+    out = derived_channels().process(0, mapped)[:, 0]
+    # 20 scan window; before it fills, the first sample is held
+    expected = np.convolve(mapped[:, 0], np.ones(20) / 20, mode='valid')
+    np.testing.assert_allclose(out[19:], expected)
+    padded = np.concatenate((np.full(19, mapped[0, 0]), mapped[:19, 0]))
+    np.testing.assert_allclose(out[:19], np.convolve(padded, np.ones(20) / 20, mode='valid'))
+
+
+def test_velocity_of_a_ramp_is_its_slope():
+    mapped = session(400)
+    # 250 mm/s
+    mapped[:, 0] = 3.0 + 250.0 * np.arange(400) / RATE
+    out = derived_channels().process(0, mapped)[:, 1]
+    # Settled once both the 5 scan smoothing and the 10 scan slope window are full
+    np.testing.assert_allclose(out[15:], 250.0)
+    assert out[0] == 0.0
+
+
+def test_balance_is_nan_below_min_total():
+    mapped = session(4)
+    mapped[:, 1:] = [[60.0, 40.0], [30.0, 10.0], [25.0, 25.0], [0.0, 0.0]]
+    out = derived_channels().process(0, mapped)[:, 2]
+    assert out[0] == 60.0
+    assert np.isnan(out[1:]).all()
+
+
+def test_gap_restarts_the_filters():
+    mapped = session(1000)
+    derived = derived_channels()
+    derived.process(0, mapped[:500])
+    # Scans 500-599 are missing: the next block is filtered as if the session started there
+    after_gap = derived.process(600, mapped[600:])
+    np.testing.assert_array_equal(after_gap, derived_channels().process(600, mapped[600:]))
+
+
+def test_process_records_restarts_at_each_gap():
+    mapped = session(1000)
+    scan_index = np.concatenate((np.arange(300), np.arange(350, 700), np.arange(705, 1000)))
+    out = derived_channels().process_records(scan_index, mapped[scan_index])
+
+    runs = [(0, 300), (350, 700), (705, 1000)]
+    expected = np.concatenate([derived_channels().process(start, mapped[start:end]) for start, end in runs])
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_parse_fills_in_defaults():
+    specs = parse_derived_channels([{'name': 'rear_lp', 'type': 'lowpass', 'source': 12}], CHANNELS)
+    assert specs == [{'name': 'rear_lp', 'type': 'lowpass', 'source': 12, 'window': 0.02}]
+    assert parse_derived_channels(None, CHANNELS) == []
+
+
+@pytest.mark.parametrize('entry, message', [
+    ({'type': 'lowpass', 'source': 5}, 'has no name'),
+    ({'name': '5', 'type': 'lowpass', 'source': 5}, 'already used'),
+    ({'name': 'x', 'type': 'highpass', 'source': 5}, "unknown type 'highpass'"),
+    ({'name': 'x', 'type': 'lowpass', 'source': 5, 'smooth': 0.01}, 'unknown parameter'),
+    ({'name': 'x', 'type': 'velocity', 'source': 7}, 'source channel 7 is not scanned'),
+    ({'name': 'x', 'type': 'lowpass', 'source': 5, 'window': -0.01}, 'window must be >= 0'),
+    ])
+def test_parse_rejects_bad_entries(entry, message):
+    with pytest.raises(ValueError, match=message):
+        parse_derived_channels([entry], CHANNELS)
+
+
+def test_parse_rejects_duplicate_names():
+    with pytest.raises(ValueError, match='already used'):
+        parse_derived_channels(CONFIG + CONFIG[:1], CHANNELS)
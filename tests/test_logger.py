@@ -0,0 +1,41 @@
+import json
+import os
+import signal
+import threading
+
+
+def test_sigterm_stop_writes_every_scan(logger, tmp_path):
+    '''
+    Stopping with SIGTERM (as bootup.py does) drains the scans still in the board's buffer:
+    the session holds every scan the board produced, even with a long wait_scans.
+    '''
+    import sim_daq
+
+    settings = logger.load_logger_config()
+    settings.update(backend='sim', console=False, wait_scans=500, record_format='binary', metrics_file='',
+                    calibration_reload=False, profiles={'standard': {'self_test_seconds': 0}})
+    channel_table = logger.load_channel_table()
+    daq_devices = logger.open_daq_devices(sim_daq, len({spec.device for spec in channel_table}))
+
+    stop_event = threading.Event()
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    timer = threading.Timer(2.5, os.kill, (os.getpid(), signal.SIGTERM))
+    try:
+        timer.start()
+        stats = logger.a_in_main(settings, base_dir=str(tmp_path), stop_event=stop_event, daq_devices=daq_devices)
+    finally:
+        timer.cancel()
+        signal.signal(signal.SIGTERM, previous)
+        logger.release_daq_devices(daq_devices)
+
+    board_scans = [daq_device.get_ai_device().total_count // len(daq_device.get_ai_device().channels)
+                   for daq_device in daq_devices]
+    assert stats['scans_written'] == min(board_scans)
+    assert stats['scans_missing'] == 0
+
+    end_files = list(tmp_path.rglob('*_END.json'))
+    assert len(end_files) == 1
+    end = json.loads(end_files[0].read_text())
+    assert end['reason'] == 'stopped'
+    assert end['scans_written'] == min(board_scans)
+    assert end['scans_missing'] == 0
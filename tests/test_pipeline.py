@@ -0,0 +1,140 @@
+import threading
+
+import numpy as np
+
+from pipeline import StreamMerger
+from sim_daq import synthetic_scans
+
+RATE = 1000.0
+# Board 0 inputs 0-2 and board 1 inputs 0-1, interleaved in the merged scan
+COLUMNS = [[0, 2, 4], [1, 3]]
+
+
+def board_scans(board, count):
+    # What simulated board <board> puts in its buffer, unmapped waveforms
+    inputs = list(range(len(COLUMNS[board])))
+    return synthetic_scans(inputs, [None] * len(inputs), 0, count, RATE, seed=board)
+
+
+def run_merger(blocks, shifts=None):
+    '''
+    Feeds (board, start_scan, raw) blocks to a StreamMerger in the given order.
+
+    @return: (list of (start_scan, merged block) passed on, list of gaps)
+    '''
+    out, gaps = [], []
+    merger = StreamMerger(COLUMNS, 5, lambda start, poll_time, raw: out.append((start, raw.copy())) or True,
+                          lambda start, count, reason: gaps.append((start, count, reason)), shifts=shifts)
+    for board, start, raw in blocks:
+        merger.add(board, start, 0.0, raw)
+    return out, gaps
+
+
+def split(board, data, size, skip=()):
+    # Blocks of a board's scans as the polling thread reads them; blocks starting in skip are lost
+    return [(board, start, data[start:start + size]) for start in range(0, len(data), size) if start not in skip]
+
+
+def interleave(*streams):
+    blocks = []
+    for group in zip(*streams):
+        blocks.extend(group)
+    return blocks
+
+
+def test_merges_two_boards_in_scan_order():
+    b0, b1 = board_scans(0, 600), board_scans(1, 600)
+    # Different block sizes, so the boards run ahead of each other
+    out, gaps = run_merger(interleave(split(0, b0, 30), split(1, b1, 50)) + split(0, b0, 30)[12:])
+
+    assert gaps == []
+    starts = [start for start, raw in out]
+    assert starts == list(np.cumsum([0] + [len(raw) for start, raw in out[:-1]]))
+    merged = np.concatenate([raw for start, raw in out])
+    assert len(merged) == 600
+    np.testing.assert_array_equal(merged[:, COLUMNS[0]], b0)
+    np.testing.assert_array_equal(merged[:, COLUMNS[1]], b1)
+
+
+def test_aligns_boards_that_started_apart():
+    # Board 1 started 7 scans before board 0
+    b0, b1 = board_scans(0, 300), board_scans(1, 307)
+    out, gaps = run_merger(interleave(split(0, b0, 100), split(1, b1, 100)) + split(1, b1, 100)[3:], shifts=[0, 7])
+
+    assert gaps == []
+    merged = np.concatenate([raw for start, raw in out])
+    assert out[0][0] == 0 and len(merged) == 300
+    np.testing.assert_array_equal(merged[:, COLUMNS[0]], b0)
+    np.testing.assert_array_equal(merged[:, COLUMNS[1]], b1[7:])
+
+
+def test_overrun_on_one_board_becomes_a_gap():
+    b0, b1 = board_scans(0, 400), board_scans(1, 400)
+    # Board 1 lost scans 100-149 (overwritten in its buffer before they were read)
+    out, gaps = run_merger(interleave(split(0, b0, 50), split(1, b1, 50, skip=(100,))) + split(0, b0, 50)[7:])
+
+    assert gaps == [(100, 50, 'buffer overrun (device 1)')]
+    assert [start for start, raw in out] == [0, 50, 150, 200, 250, 300, 350]
+    scan_index = np.concatenate([start + np.arange(len(raw)) for start, raw in out])
+    merged = np.concatenate([raw for start, raw in out])
+    np.testing.assert_array_equal(merged[:, COLUMNS[0]], b0[scan_index])
+    np.testing.assert_array_equal(merged[:, COLUMNS[1]], b1[scan_index])
+
+
+def ramp_scans(channels, sensors, start_scan, scan_count, rate, seed=0):
+    # Voltage that encodes the scan index and the input: 2 mV per scan, 0.2 mV per input
+    scans = start_scan + np.arange(scan_count)
+    return ((scans % 9000) * 0.002 - 9.0)[:, None] + 0.0002 * np.asarray(channels, dtype=float)[None, :]
+
+
+def decode_ramp(data):
+    # (scan index, input) of every value written by ramp_scans
+    volts = data.astype(np.float64) + 9.0
+    scans = np.floor(volts / 0.002 + 1e-4)
+    return scans.astype(np.int64), np.rint((volts - scans * 0.002) / 0.0002).astype(np.int64)
+
+
+def test_two_simulated_boards_in_one_session(logger, tmp_path, monkeypatch):
+    '''
+    A session on two simulated boards: every record has both boards' channels of the same scan,
+    in the right columns, records in scan order with nothing missing.
+    '''
+    import sim_daq
+    from calibration import channel_spec
+    from recording import open_recording, load_gaps
+
+    monkeypatch.setattr(sim_daq, 'simulated_device_count', 2)
+    monkeypatch.setattr(sim_daq, 'synthetic_scans', ramp_scans)
+    channels = [channel_spec([], 5)._replace(device=0, input=5), channel_spec([], 101)._replace(device=1, input=1),
+                channel_spec([], 4)._replace(device=0, input=4), channel_spec([], 102)._replace(device=1, input=2)]
+    settings = logger.load_logger_config()
+    settings.update(backend='sim', console=False, record_format='binary', metrics_file='', calibration_reload=False,
+                    summary_levels=[], profiles={'standard': {'self_test_seconds': 0}})
+
+    stop_event = threading.Event()
+    timer = threading.Timer(1.5, stop_event.set)
+    timer.start()
+    try:
+        stats = logger.a_in_main(settings, base_dir=str(tmp_path), stop_event=stop_event, rate=RATE, channels=channels)
+    finally:
+        timer.cancel()
+
+    assert stats['devices'] == 2
+    assert stats['scans_missing'] == 0
+    recordings = list(tmp_path.rglob('*_RAW.bin'))
+    assert len(recordings) == 1
+    header, data = open_recording(str(recordings[0]))
+    assert header['channels'] == [5, 101, 4, 102]
+    assert len(data) == stats['scans_written'] > 500
+    assert load_gaps(str(recordings[0])) == []
+
+    scans, inputs = decode_ramp(np.asarray(data))
+    # Each column holds its own input
+    assert (inputs == [[5, 1, 4, 2]]).all()
+    # Each board's columns come from the same scan of that board, consecutive from record to record
+    for cols in ([0, 2], [1, 3]):
+        assert (scans[:, cols] == scans[:, cols[:1]]).all()
+        np.testing.assert_array_equal(np.diff(scans[:, cols[0]]), 1)
+    # and the boards stay aligned: a fixed offset (the scans dropped to line up their starts)
+    offsets = scans[:, 0] - scans[:, 1]
+    assert (offsets == offsets[0]).all() and abs(offsets[0]) < 50
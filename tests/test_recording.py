@@ -0,0 +1,254 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from calibration import load_calibration_config, compile_calibration
+from recording import (BinaryRecordingWriter, GapLog, load_gaps, open_recording, record_scan_index, export_csv,
+                       SegmentedRecordingWriter, load_segments, select_segments, verify_segment, segment_path,
+                       SEGMENT_INDEX_SUFFIX, HEADER_SIZE, SummaryWriter, load_summary)
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_record_scan_index_gap_at_first_scan():
+    # Scans 0-4 were lost before the first record was written
+    assert record_scan_index([(0, 5)], 3).tolist() == [5, 6, 7]
+
+
+def test_record_scan_index_segment_skips_earlier_gaps():
+    # A segment starting at scan 100: the gap at 10 is before it, the one at 102 inside it
+    scan_index = record_scan_index([(10, 4), (102, 3)], 5, first_scan=100)
+    assert scan_index.tolist() == [100, 101, 105, 106, 107]
+    assert scan_index.dtype == np.int64
+
+
+def test_gap_log_round_trip(tmp_path):
+    base = str(tmp_path / 'session')
+    gap_log = GapLog(f'{base}_GAPS.csv', 1000.0)
+    gap_log.record(100, 50, 'buffer overrun')
+    gap_log.record(400, 7, 'writer queue full')
+    gap_log.close()
+
+    assert (gap_log.gap_count, gap_log.scans_missing) == (2, 57)
+    # Read back through any file of the session
+    assert load_gaps(f'{base}_RAW.bin') == [(100, 50), (400, 7)]
+    assert load_gaps(str(tmp_path / 'older_session_RAW.bin')) == []
+
+
+def test_binary_recording_with_a_gap_exports_hardware_times(tmp_path):
+    base = str(tmp_path / 'session')
+    channels, rate = [5, 4], 500.0
+    config = load_calibration_config(os.path.join(REPO, 'sense_config.yaml'))
+    raw = np.column_stack((np.linspace(1.0, 9.0, 250), np.linspace(0.3, 1.5, 250)))
+
+    # Scans 100-149 never made it into the recording
+    writer = BinaryRecordingWriter(f'{base}_RAW.bin', {'channels': channels, 'rate': rate, 'calibration': config})
+    gap_log = GapLog(f'{base}_GAPS.csv', rate)
+    for start, end in ((0, 100), (150, 250)):
+        if start == 150:
+            gap_log.record(100, 50, 'buffer overrun')
+        scans = np.arange(start, end)
+        writer.write(start, scans / rate, raw[start:end], raw[start:end])
+    writer.close()
+    gap_log.close()
+
+    header, data = open_recording(f'{base}_RAW.bin')
+    assert header['complete'] and header['scan_count'] == 200
+    scan_index = record_scan_index(load_gaps(f'{base}_RAW.bin'), len(data))
+    np.testing.assert_array_equal(scan_index, np.concatenate((np.arange(100), np.arange(150, 250))))
+    np.testing.assert_array_equal(data, raw[scan_index].astype(np.float32))
+
+    mapped = pd.read_csv(export_csv(f'{base}_RAW.bin'))
+    np.testing.assert_array_equal(mapped['Time'], scan_index / rate)
+    gain, offset = compile_calibration(channels, config)
+    np.testing.assert_allclose(mapped[['5', '4']], data.astype(np.float64) * gain + offset)
+
+
+def segmented_session(base, channels, rate, **rotation):
+    # A binary-only segmented session, as logger.py sets it up
+    def make_writers(segment, first_scan):
+        path = segment_path(base, segment, 'binary')
+        header = {'channels': channels, 'rate': rate, 'segment': segment, 'first_scan': first_scan}
+        return [('binary', path, BinaryRecordingWriter(path, header))]
+    return SegmentedRecordingWriter(f'{base}{SEGMENT_INDEX_SUFFIX}', make_writers, rate, **rotation)
+
+
+def write_blocks(writer, raw, size, rate, skip=()):
+    # raw[start:start + size] for each block, blocks starting in skip are lost
+    for start in range(0, len(raw), size):
+        if start not in skip:
+            block = raw[start:start + size]
+            writer.write(start, (start + np.arange(len(block))) / rate, block, block)
+
+
+def test_segments_split_on_multiples_of_segment_scans(tmp_path):
+    base = str(tmp_path / 'session')
+    rate = 1000.0
+    raw = np.arange(560, dtype=np.float64).reshape(280, 2)
+    writer = segmented_session(base, [5, 4], rate, segment_scans=100)
+    # Scans 120-159 are missing
+    write_blocks(writer, raw, 40, rate, skip=(120,))
+
+    # The segment being written is listed, but not indexed yet
+    segments = load_segments(f'{base}{SEGMENT_INDEX_SUFFIX}')
+    assert [(s['segment'], s['first_scan'], s['crc32'] is None) for s in segments] == [(1, 0, False), (2, 100, False),
+                                                                                        (3, None, True)]
+    assert not verify_segment(segments[-1])
+    writer.close()
+
+    segments = load_segments(f'{base}_RAW.bin')
+    assert [(s['segment'], s['first_scan'], s['last_scan'], s['records']) for s in segments] == [
+        (1, 0, 99, 100), (2, 100, 199, 60), (3, 200, 279, 80)]
+    assert segments[1]['start_time'] == 0.1 and segments[1]['end_time'] == 0.199
+    for segment in segments:
+        assert segment['file'] == segment_path(base, segment['segment'], 'binary')
+        assert verify_segment(segment)
+        header, data = open_recording(segment['file'])
+        assert header['complete'] and header['first_scan'] == segment['first_scan']
+        assert len(data) == segment['records']
+    header, data = open_recording(segments[1]['file'])
+    np.testing.assert_array_equal(data, np.concatenate((raw[100:120], raw[160:200])))
+
+
+def test_verify_segment_detects_a_changed_file(tmp_path):
+    base = str(tmp_path / 'session')
+    writer = segmented_session(base, [5, 4], 1000.0, segment_scans=100)
+    write_blocks(writer, np.ones((200, 2)), 50, 1000.0)
+    writer.close()
+
+    first, second = load_segments(base)
+    assert verify_segment(first) and verify_segment(second)
+    # Same size, one byte flipped
+    with open(first['file'], 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xff]))
+    assert not verify_segment(first)
+    # Cut short
+    with open(second['file'], 'r+b') as f:
+        f.truncate(second['bytes'] - 8)
+    assert not verify_segment(second)
+
+
+def test_select_segments_by_time(tmp_path):
+    base = str(tmp_path / 'session')
+    writer = segmented_session(base, [5], 1000.0, segment_scans=100)
+    write_blocks(writer, np.zeros((350, 1)), 50, 1000.0)
+    writer.close()
+
+    segments = load_segments(base)
+    select = lambda *times: [s['segment'] for s in select_segments(segments, 'binary', *times)]
+    assert select() == [1, 2, 3, 4]
+    assert select(0.15, 0.21) == [2, 3]
+    assert select(0.3) == [4]
+    assert select(None, 0.05) == [1]
+    assert select_segments(segments, 'mapped') == []
+
+
+def test_segments_rotate_on_size(tmp_path):
+    base = str(tmp_path / 'session')
+    # A full segment: the header and 100 records of 2 float32 channels
+    writer = segmented_session(base, [5, 4], 1000.0, segment_bytes=HEADER_SIZE + 100 * 8)
+    write_blocks(writer, np.ones((450, 2)), 50, 1000.0)
+    writer.close()
+
+    segments = load_segments(base)
+    assert [(s['first_scan'], s['records']) for s in segments] == [(0, 100), (100, 100), (200, 100), (300, 100),
+                                                                    (400, 50)]
+    assert all(verify_segment(segment) for segment in segments)
+
+
+def summary_session(base, mapped, scans, edges, levels=(10, 100), rate=1000.0):
+    # Writes mapped[scans] in blocks split at edges (positions in scans), as the logger passes them
+    writer = SummaryWriter(f'{base}_SUMMARY.bin', ['5', 'brake_balance'], rate, levels)
+    for start, end in zip(edges[:-1], edges[1:]):
+        writer.write(scans[start], scans[start:end] / rate, mapped[scans[start:end]], mapped[scans[start:end]])
+    return writer
+
+
+def bucket_stats(mapped, scans, bucket_scans):
+    # Per bucket of the scans written: (bucket, count, min, max, mean), NaNs left out
+    buckets = scans // bucket_scans
+    stats = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for bucket in np.unique(buckets):
+            values = mapped[scans[buckets == bucket]]
+            stats.append((bucket, len(values), np.nanmin(values, axis=0), np.nanmax(values, axis=0),
+                          np.nanmean(values, axis=0)))
+    return stats
+
+
+def summary_mapped():
+    rng = np.random.default_rng(1)
+    mapped = np.column_stack((rng.normal(40.0, 5.0, 1000), rng.uniform(40.0, 70.0, 1000)))
+    # Brakes off: no balance for a while, one bucket of the finest level has none at all
+    mapped[195:260, 1] = np.nan
+    return mapped
+
+
+def test_summary_matches_the_data_per_bucket(tmp_path):
+    base = str(tmp_path / 'session')
+    mapped = summary_mapped()
+    # Scans 300-349 are missing
+    scans = np.concatenate((np.arange(300), np.arange(350, 1000)))
+    summary_session(base, mapped, scans, [0, 3, 40, 41, 250, 300, 333, 777, 950]).close()
+
+    for bucket_scans in (10, 100):
+        summary = load_summary(f'{base}_RAW.bin', level=bucket_scans)
+        assert summary['bucket_scans'] == bucket_scans and summary['complete']
+        assert summary['channels'] == ['5', 'brake_balance']
+        expected = bucket_stats(mapped, scans, bucket_scans)
+        np.testing.assert_allclose(summary['time'], [row[0] * bucket_scans / 1000.0 for row in expected])
+        np.testing.assert_array_equal(summary['count'], [row[1] for row in expected])
+        for i, key in enumerate(('min', 'max', 'mean'), 2):
+            np.testing.assert_allclose(summary[key], [row[i] for row in expected], equal_nan=True)
+    assert np.isnan(load_summary(base, level=10)['mean'][20:26, 1]).all()
+
+
+def test_summary_does_not_depend_on_block_split(tmp_path):
+    mapped = summary_mapped()
+    scans = np.arange(1000)
+    summary_session(str(tmp_path / 'one'), mapped, scans, [0, 1000]).close()
+    summary_session(str(tmp_path / 'many'), mapped, scans, [0, 1, 9, 10, 11, 99, 100, 101, 555, 1000]).close()
+
+    for bucket_scans in (10, 100):
+        one, many = load_summary(str(tmp_path / 'one'), bucket_scans), load_summary(str(tmp_path / 'many'), bucket_scans)
+        for key in ('time', 'count', 'min', 'max'):
+            np.testing.assert_array_equal(one[key], many[key])
+        np.testing.assert_allclose(one['mean'], many['mean'], equal_nan=True)
+
+
+def test_summary_level_selection_and_time_range(tmp_path):
+    base = str(tmp_path / 'session')
+    summary_session(base, summary_mapped(), np.arange(1000), [0, 1000]).close()
+
+    # The coarsest level that still gives min_buckets buckets
+    assert load_summary(base)['bucket_scans'] == 100
+    assert load_summary(base, min_buckets=10)['bucket_scans'] == 100
+    assert load_summary(base, min_buckets=11)['bucket_scans'] == 10
+    assert load_summary(base, time_range=(0.2, 0.4), min_buckets=5)['bucket_scans'] == 10
+    # Buckets overlapping the range
+    np.testing.assert_allclose(load_summary(base, level=100, time_range=(0.25, 0.5))['time'], [0.2, 0.3, 0.4, 0.5])
+    np.testing.assert_allclose(load_summary(base, level=100, time_range=(None, 0.1))['time'], [0.0, 0.1])
+    assert load_summary(str(tmp_path / 'no_summary')) is None
+
+
+def test_summary_of_a_session_cut_off(tmp_path):
+    base = str(tmp_path / 'session')
+    writer = summary_session(base, summary_mapped(), np.arange(1000), [0, 250])
+
+    # Readable while logging (or after a power loss): the buckets finished so far, not complete
+    writer.output.sync()
+    summary = load_summary(base, level=100)
+    assert not summary['complete']
+    np.testing.assert_array_equal(summary['count'], [100, 100])
+    np.testing.assert_array_equal(load_summary(base, level=10)['count'], [10] * 25)
+
+    writer.close()
+    summary = load_summary(base, level=100)
+    assert summary['complete']
+    np.testing.assert_array_equal(summary['count'], [100, 100, 50])
@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+
+from recording import EventLog, load_events
+from trigger import parse_trigger_conditions, TriggerRecorder
+
+RATE = 1000.0
+COLUMNS = [4, 5, 'fl_velocity']
+CONFIG = [{'channel': 4, 'above': 200}, {'channel': 'fl_velocity', 'abs_above': 10}]
+
+
+class SegmentRecorder:
+    '''
+    Stands in for the SegmentedRecordingWriter: keeps the scans written to each segment.
+    '''
+    def __init__(self):
+        self.segment = 0
+        self.segments = []
+        self.open = False
+        self.closed = False
+
+    def write(self, start_scan, scan_times, raw_block, mapped_block):
+        if not self.open:
+            self.segment += 1
+            self.segments.append([])
+            self.open = True
+        self.segments[-1].append((start_scan, raw_block.copy()))
+
+    def end_segment(self):
+        self.open = False
+
+    def close(self):
+        self.closed = True
+
+    def scans(self):
+        # Scan index of what went into each segment, checked against the scan number stored in the data
+        out = []
+        for blocks in self.segments:
+            index = np.concatenate([start + np.arange(len(raw)) for start, raw in blocks])
+            np.testing.assert_array_equal(np.concatenate([raw[:, 0] for start, raw in blocks]), index)
+            out.append(index)
+        return out
+
+
+def run_triggered(tmp_path, mapped, block_scans=64, skip=(), pre_trigger=0.1, post_trigger=0.2):
+    '''
+    Feeds mapped in blocks through a TriggerRecorder; the raw data is the scan number.
+
+    @return: (recorder, SegmentRecorder, events from the _EVENTS.csv)
+    '''
+    writer = SegmentRecorder()
+    events_file = str(tmp_path / 'session_EVENTS.csv')
+    recorder = TriggerRecorder([writer], EventLog(events_file, RATE), parse_trigger_conditions(CONFIG, COLUMNS), RATE,
+                               pre_trigger, post_trigger)
+    raw = np.arange(len(mapped), dtype=float)[:, None]
+    for start in range(0, len(mapped), block_scans):
+        if start not in skip:
+            end = min(start + block_scans, len(mapped))
+            recorder.write(start, np.arange(start, end) / RATE, raw[start:end], mapped[start:end])
+    recorder.close()
+    assert writer.closed
+    return recorder, writer, load_events(events_file)
+
+
+def test_stores_only_event_windows(tmp_path):
+    mapped = np.zeros((3000, 3))
+    mapped[500, 0] = 250.0
+    # Shock velocity trigger inside the first window extends it
+    mapped[650, 2] = -20.0
+    mapped[2000:2003, 0] = 300.0
+    recorder, writer, events = run_triggered(tmp_path, mapped)
+
+    # 100 scans before the first trigger to 200 after the last one of the event
+    scans = writer.scans()
+    assert len(scans) == 2
+    np.testing.assert_array_equal(scans[0], np.arange(400, 850))
+    np.testing.assert_array_equal(scans[1], np.arange(1900, 2202))
+    assert (recorder.events, recorder.scans_stored) == (2, 752)
+
+    assert [(e['event'], e['trigger'], e['trigger_scan'], e['first_scan'], e['last_scan'], e['records'],
+             e['first_segment'], e['last_segment']) for e in events] == [
+        (1, '4 above 200', 500, 400, 849, 450, 1, 1), (2, '4 above 200', 2000, 1900, 2201, 302, 2, 2)]
+    assert events[1]['trigger_time'] == 2.0 and events[1]['start_time'] == 1.9
+
+
+def test_lead_in_does_not_repeat_the_last_event(tmp_path):
+    mapped = np.zeros((1500, 3))
+    mapped[500, 0] = 250.0
+    # Fires after the first window (400-699) ended, 50 scans into it
+    mapped[750, 2] = 15.0
+    recorder, writer, events = run_triggered(tmp_path, mapped)
+
+    first, second = writer.scans()
+    np.testing.assert_array_equal(first, np.arange(400, 700))
+    np.testing.assert_array_equal(second, np.arange(700, 950))
+    assert [e['trigger'] for e in events] == ['4 above 200', 'fl_velocity abs_above 10']
+
+
+def test_trigger_at_the_start_and_an_event_cut_off_by_the_end(tmp_path):
+    mapped = np.zeros((3000, 3))
+    mapped[30, 0] = 250.0
+    mapped[2900, 0] = 250.0
+    recorder, writer, events = run_triggered(tmp_path, mapped)
+
+    first, second = writer.scans()
+    np.testing.assert_array_equal(first, np.arange(0, 230))
+    np.testing.assert_array_equal(second, np.arange(2800, 3000))
+    assert [(e['first_scan'], e['last_scan']) for e in events] == [(0, 229), (2800, 2999)]
+
+
+def test_gap_ends_an_event(tmp_path):
+    mapped = np.zeros((1000, 3))
+    mapped[100, 0] = 250.0
+    # Block 256-511 is lost; the window would have run to scan 299
+    recorder, writer, events = run_triggered(tmp_path, mapped, block_scans=256, skip=(256,))
+
+    scans, = writer.scans()
+    np.testing.assert_array_equal(scans, np.arange(0, 256))
+    assert [(e['first_scan'], e['last_scan'], e['records']) for e in events] == [(0, 255, 256)]
+
+
+def test_no_trigger_stores_nothing(tmp_path):
+    recorder, writer, events = run_triggered(tmp_path, np.zeros((2000, 3)))
+    assert writer.segments == [] and events == []
+    assert (recorder.events, recorder.scans_stored) == (0, 0)
+
+
+def test_parse_trigger_conditions():
+    assert parse_trigger_conditions(CONFIG + [{'channel': 5, 'below': '0.5'}], COLUMNS) == [
+        (0, 'above', 200.0, '4 above 200'), (2, 'abs_above', 10.0, 'fl_velocity abs_above 10'),
+        (1, 'below', 0.5, '5 below 0.5')]
+    assert parse_trigger_conditions(None, COLUMNS) == []
+
+
+@pytest.mark.parametrize('entry, message', [
+    ({'channel': 7, 'above': 1}, 'channel 7 is not scanned or derived'),
+    ({'above': 1}, 'channel None is not scanned'),
+    ({'channel': 4}, 'needs exactly one of'),
+    ({'channel': 4, 'above': 1, 'below': 2}, 'needs exactly one of'),
+    ({'channel': 4, 'above': 1, 'hold': 0.5}, 'needs exactly one of'),
+    ])
+def test_parse_rejects_bad_conditions(entry, message):
+    with pytest.raises(ValueError, match=message):
+        parse_trigger_conditions([entry], COLUMNS)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+'''
+Trigger mode: instead of recording everything between button presses, only event windows are
+stored, from pre_trigger seconds before a trigger condition fires to post_trigger seconds after
+it last fired. A trigger within an event's window extends the event.
+
+The last pre_trigger seconds of blocks are kept in a ring (references to the blocks, bounded by
+pre_trigger * rate scans plus one block), so the lead-in to an event is still there when the
+trigger fires. Conditions are checked on the calibrated block (derived channels included, so a
+shock velocity channel from derived.py can trigger on travel rate), vectorized over the block.
+
+Each event is written as its own segment(s) of a segmented session (recording.py), so the
+_SEGMENTS.csv index, plotter and recalibrate.py handle triggered sessions as they are, and
+<session>_EVENTS.csv lists the events (recording.EventLog).
+
+Conditions are configured in test.yaml (logger: trigger_conditions:), any of them starts an event:
+    {channel: 4, above: 200}                   brake pressure over 200 psi
+    {channel: fl_velocity, abs_above: 10}      shock travel rate over 10 in/s either way
+    {channel: 5, below: 0.5}
+'''
+from collections import deque
+import numpy as np
+
+condition_tests = ('above', 'below', 'abs_above')
+
+
+def parse_trigger_conditions(config, columns):
+    '''
+    Checks the trigger_conditions setting against the mapped columns.
+
+    @param columns: channels, then derived channel names, i.e. the columns of the mapped blocks
+
+    @return: list of (column index, test, threshold, description)
+    '''
+    conditions = []
+    for entry in config or []:
+        entry = dict(entry)
+        channel = entry.pop('channel', None)
+        if channel not in columns:
+            raise ValueError(f'trigger condition {entry}: channel {channel} is not scanned or derived')
+        tests = [test for test in condition_tests if test in entry]
+        if len(tests) != 1 or len(entry) != 1:
+            raise ValueError(f"trigger condition on channel {channel}: needs exactly one of {', '.join(condition_tests)}")
+        test = tests[0]
+        threshold = float(entry[test])
+        conditions.append((columns.index(channel), test, threshold, f'{channel} {test} {threshold:g}'))
+    return conditions
+
+
+class TriggerRecorder:
+    '''
+    Passes only the scans of event windows on to the session's writers.
+
+    Same write / close interface as the recording writers; each event ends the writers' current
+    segment (end_segment) so it starts in a new one.
+
+    @param writers: writers the event scans go to (a SegmentedRecordingWriter)
+
+    @param event_log: recording.EventLog for the events index
+
+    @param conditions: from parse_trigger_conditions
+    '''
+    def __init__(self, writers, event_log, conditions, rate, pre_trigger=1.0, post_trigger=2.0):
+        self.writers = writers
+        self.event_log = event_log
+        self.conditions = conditions
+        self.pre_scans = max(0, int(round(pre_trigger * rate)))
+        self.post_scans = max(1, int(round(post_trigger * rate)))
+        self.ring = deque()
+        self.ring_scans = 0
+        # Open event: dict with its trigger and the scan it ends at (exclusive), None between events
+        self.event = None
+        # Scans before this one were already stored with an earlier event
+        self.stored_until = 0
+        self.events = 0
+        self.scans_stored = 0
+
+    def _fired(self, mapped_block):
+        masks = np.empty((len(self.conditions), len(mapped_block)), dtype=bool)
+        for i, (column, test, threshold, description) in enumerate(self.conditions):
+            values = mapped_block[:, column]
+            if test == 'above':
+                masks[i] = values > threshold
+            elif test == 'below':
+                masks[i] = values < threshold
+            else:
+                masks[i] = np.abs(values) > threshold
+        return masks
+
+    def _store(self, start_scan, scan_times, raw_block, mapped_block):
+        if len(raw_block) == 0:
+            return
+        for writer in self.writers:
+            writer.write(start_scan, scan_times, raw_block, mapped_block)
+        self.event['first_scan'] = min(self.event['first_scan'], start_scan)
+        self.event['last_scan'] = start_scan + len(raw_block) - 1
+        self.event['records'] += len(raw_block)
+        self.scans_stored += len(raw_block)
+        self.stored_until = start_scan + len(raw_block)
+        if self.event['first_segment'] is None:
+            self.event['first_segment'] = self._segment()
+
+    def _segment(self):
+        return getattr(self.writers[0], 'segment', None) if self.writers else None
+
+    def _open(self, trigger_scan, condition):
+        self.events += 1
+        self.event = {'event': self.events, 'trigger_scan': trigger_scan, 'trigger': self.conditions[condition][3],
+                      'end_scan': trigger_scan + self.post_scans, 'first_scan': trigger_scan, 'last_scan': None,
+                      'records': 0, 'first_segment': None}
+        # Lead-in from the ring, not overlapping what the last event already stored
+        first_scan = max(trigger_scan - self.pre_scans, self.stored_until)
+        for start, times, raw, mapped in self.ring:
+            lo = max(first_scan - start, 0)
+            if lo < len(raw):
+                self._store(start + lo, times[lo:], raw[lo:], mapped[lo:])
+        return first_scan
+
+    def _close(self):
+        for writer in self.writers:
+            if hasattr(writer, 'end_segment'):
+                writer.end_segment()
+        if self.event['records']:
+            self.event['last_segment'] = self._segment()
+            self.event_log.record(self.event)
+        self.event = None
+
+    def write(self, start_scan, scan_times, raw_block, mapped_block):
+        masks = self._fired(mapped_block)
+        hits = start_scan + np.flatnonzero(masks.any(axis=0))
+        n = len(raw_block)
+        pos = 0
+        while pos < n:
+            if self.event is not None and start_scan + pos >= self.event['end_scan']:
+                # A gap ran past the end of the event
+                self._close()
+            if self.event is None:
+                # Next trigger in the block, if any
+                following = hits[np.searchsorted(hits, start_scan + pos):]
+                if len(following) == 0:
+                    break
+                hit = int(following[0]) - start_scan
+                first_scan = self._open(start_scan + hit, int(np.argmax(masks[:, hit])))
+                pos = max(pos, first_scan - start_scan)
+
+            # Every trigger before the end of the window pushes the end out to post_scans after it
+            while True:
+                inside = np.searchsorted(hits, self.event['end_scan'])
+                if inside == 0 or hits[inside - 1] + self.post_scans <= self.event['end_scan']:
+                    break
+                self.event['end_scan'] = int(hits[inside - 1]) + self.post_scans
+
+            end = min(n, self.event['end_scan'] - start_scan)
+            self._store(start_scan + pos, scan_times[pos:end], raw_block[pos:end], mapped_block[pos:end])
+            pos = end
+            if start_scan + pos >= self.event['end_scan']:
+                self._close()
+
+        # Ring of the last pre_trigger seconds for the next event's lead-in
+        self.ring.append((start_scan, scan_times, raw_block, mapped_block))
+        self.ring_scans += n
+        while self.ring and self.ring_scans - len(self.ring[0][2]) >= self.pre_scans:
+            self.ring_scans -= len(self.ring.popleft()[2])
+
+    def close(self):
+        if self.event is not None:
+            self._close()
+        for writer in self.writers:
+            writer.close()
+        self.event_log.close()